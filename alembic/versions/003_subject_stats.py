@@ -0,0 +1,37 @@
+"""subject score histograms
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '003'
+down_revision = '002'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.add_column('scores', sa.Column('previous_score', sa.Integer(), nullable=True))
+    op.create_index('ix_scores_subject_score', 'scores', ['subject', 'score'])
+    # Гистограммы баллов по предметам, заполняем по уже сохраненным баллам
+    op.create_table(
+        'subject_score_counts',
+        sa.Column('subject', sa.String(), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('subject', 'score')
+    )
+    op.execute(
+        "INSERT INTO subject_score_counts (subject, score, count) "
+        "SELECT subject, score, COUNT(*) FROM scores GROUP BY subject, score"
+    )
+
+def downgrade() -> None:
+    op.drop_table('subject_score_counts')
+    op.drop_index('ix_scores_subject_score', table_name='scores')
+    op.drop_column('scores', 'previous_score')
@@ -0,0 +1,153 @@
+"""subjects dictionary
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+# Копия справочника, алиасов и правил нормализации из app.subjects на момент этой ревизии:
+# повторный прогон миграции должен давать те же строки subjects и те же склейки, как бы
+# ни менялись код приложения и окружение (SUBJECT_ALIASES здесь не читается)
+SUBJECTS = [
+    "Математика",
+    "Русский язык",
+    "Информатика",
+    "Физика",
+    "Химия",
+    "Биология",
+    "История",
+    "Обществознание",
+    "География",
+    "Литература",
+    "Английский язык",
+    "Немецкий язык",
+    "Французский язык",
+    "Испанский язык",
+    "Китайский язык",
+]
+
+ALIASES = {
+    "матем": "математика",
+    "математика профиль": "математика",
+    "профильная математика": "математика",
+    "русский": "русский язык",
+    "рус яз": "русский язык",
+    "инфа": "информатика",
+    "икт": "информатика",
+    "информатика и икт": "информатика",
+    "физ": "физика",
+    "хим": "химия",
+    "био": "биология",
+    "общество": "обществознание",
+    "общ": "обществознание",
+    "гео": "география",
+    "литра": "литература",
+    "английский": "английский язык",
+    "англ": "английский язык",
+    "немецкий": "немецкий язык",
+    "французский": "французский язык",
+    "испанский": "испанский язык",
+    "китайский": "китайский язык",
+}
+
+def clean(name: str) -> str:
+    name = " ".join(name.split())
+    return name[:1].upper() + name[1:]
+
+def normalize(name: str) -> str:
+    return " ".join(name.replace("ё", "е").replace("Ё", "Е").split()).casefold()
+
+def subject_key(name: str) -> str:
+    key = normalize(name)
+    return ALIASES.get(key, key)
+
+def upgrade() -> None:
+    bind = op.get_bind()
+
+    # Справочник предметов со smallint-ключом, заполняем каноническими именами
+    subjects = op.create_table(
+        'subjects',
+        sa.Column('id', sa.SmallInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key')
+    )
+    rows = {subject_key(name): clean(name) for name in SUBJECTS}
+    # Предметы из уже сохраненных баллов: варианты написания сводим по нормализованному ключу
+    existing = [name for (name,) in bind.execute(sa.text("SELECT DISTINCT subject FROM scores"))]
+    for name in existing:
+        rows.setdefault(subject_key(name), clean(name))
+    op.bulk_insert(subjects, [{"key": key, "name": name} for key, name in rows.items()])
+    ids = {key: subject_id for subject_id, key in bind.execute(sa.text("SELECT id, key FROM subjects"))}
+
+    op.add_column('scores', sa.Column('subject_id', sa.SmallInteger(), nullable=True))
+    for name in existing:
+        bind.execute(
+            sa.text("UPDATE scores SET subject_id = :subject_id WHERE subject = :subject"),
+            {"subject_id": ids[subject_key(name)], "subject": name},
+        )
+    # После нормализации у юзера могут оказаться два балла по одному предмету — оставляем последний
+    op.execute(
+        "DELETE FROM scores WHERE id NOT IN (SELECT MAX(id) FROM scores GROUP BY user_id, subject_id)"
+    )
+
+    op.drop_index('ix_scores_subject_score', table_name='scores')
+    with op.batch_alter_table('scores') as batch_op:
+        batch_op.drop_constraint('_user_subject_uc', type_='unique')
+        batch_op.drop_column('subject')
+        batch_op.alter_column('subject_id', existing_type=sa.SmallInteger(), nullable=False)
+        batch_op.create_foreign_key('fk_scores_subject_id', 'subjects', ['subject_id'], ['id'])
+        batch_op.create_unique_constraint('_user_subject_uc', ['user_id', 'subject_id'])
+    op.create_index('ix_scores_subject_score', 'scores', ['subject_id', 'score'])
+
+    # Гистограммы пересобираем по новым ключам
+    op.drop_table('subject_score_counts')
+    op.create_table(
+        'subject_score_counts',
+        sa.Column('subject_id', sa.SmallInteger(), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['subject_id'], ['subjects.id'], ),
+        sa.PrimaryKeyConstraint('subject_id', 'score')
+    )
+    op.execute(
+        "INSERT INTO subject_score_counts (subject_id, score, count) "
+        "SELECT subject_id, score, COUNT(*) FROM scores GROUP BY subject_id, score"
+    )
+
+def downgrade() -> None:
+    op.drop_table('subject_score_counts')
+    op.create_table(
+        'subject_score_counts',
+        sa.Column('subject', sa.String(), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('subject', 'score')
+    )
+
+    op.add_column('scores', sa.Column('subject', sa.String(), nullable=True))
+    op.execute("UPDATE scores SET subject = (SELECT name FROM subjects WHERE subjects.id = scores.subject_id)")
+    op.drop_index('ix_scores_subject_score', table_name='scores')
+    with op.batch_alter_table('scores') as batch_op:
+        batch_op.drop_constraint('_user_subject_uc', type_='unique')
+        batch_op.drop_constraint('fk_scores_subject_id', type_='foreignkey')
+        batch_op.drop_column('subject_id')
+        batch_op.alter_column('subject', existing_type=sa.String(), nullable=False)
+        batch_op.create_unique_constraint('_user_subject_uc', ['user_id', 'subject'])
+    op.create_index('ix_scores_subject_score', 'scores', ['subject', 'score'])
+    op.execute(
+        "INSERT INTO subject_score_counts (subject, score, count) "
+        "SELECT subject, score, COUNT(*) FROM scores GROUP BY subject, score"
+    )
+    op.drop_table('subjects')
@@ -0,0 +1,50 @@
+"""score history
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from datetime import UTC, datetime
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # История попыток: только добавление строк, scores остается проекцией последней попытки
+    op.create_table(
+        'score_history',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('subject_id', sa.SmallInteger(), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['subject_id'], ['subjects.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # Прошлых попыток не сохранилось — история начинается с текущего балла
+    op.get_bind().execute(
+        sa.text(
+            "INSERT INTO score_history (user_id, subject_id, score, created_at) "
+            "SELECT user_id, subject_id, score, :now FROM scores ORDER BY id"
+        ),
+        {"now": datetime.now(UTC).replace(tzinfo=None)},
+    )
+    # Индексы после заливки — так быстрее на большой таблице
+    op.create_index(
+        'ix_score_history_user_subject_time', 'score_history', ['user_id', 'subject_id', 'created_at', 'id']
+    )
+    op.create_index('ix_score_history_user_time', 'score_history', ['user_id', 'created_at', 'id'])
+
+def downgrade() -> None:
+    op.drop_index('ix_score_history_user_time', table_name='score_history')
+    op.drop_index('ix_score_history_user_subject_time', table_name='score_history')
+    op.drop_table('score_history')
@@ -0,0 +1,24 @@
+"""user platform
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # Платформа регистрации для рассылок; у существующих юзеров она неизвестна (NULL)
+    # и проставляется при повторной регистрации
+    op.add_column('users', sa.Column('platform', sa.String(length=2), nullable=True))
+
+def downgrade() -> None:
+    op.drop_column('users', 'platform')
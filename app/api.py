@@ -1,24 +1,389 @@
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Literal
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app import crud, schemas
-from app.database import get_db
+from app import crud, export, replicas, schemas
+from app.bulk import BulkParseError, chunked, iter_json_array, iter_ndjson
+from app.cache import make_etag, scores_cache, scores_key, user_id_cache
+from app.config import settings
+from app.database import AsyncSessionLocal, engine, get_db, pool_status, warmup_pool
+from app.encoders import RowEncoder
+from app.idempotency import IdempotencyInProgress, IdempotencyKeyReused, StoredResponse, create_idempotency, fingerprint
+from app.logger import dropped_records, setup_logger
+from app.metrics import CONTENT_TYPE, callback_gauge, gauge, histogram, registry
+from app.replicas import get_read_db
+from app.subjects import subject_cache
+from app.write_combiner import ScoreWriteCombiner
 
-app = FastAPI(title="EGE Tracker API")
+logger = setup_logger("api")
+
+async def _warmup(app: FastAPI):
+    try:
+        await warmup_pool(engine, settings.DB_WARMUP_CONNECTIONS)
+        app.state.ready = True
+    except Exception as e:
+        logger.error(f"Не удалось прогреть пул БД: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    await _warmup(app)
+    await replicas.replica_router.start()
+    if idempotency is not None:
+        await idempotency.start()
+    yield
+    if score_writer is not None:
+        await score_writer.close()
+    if idempotency is not None:
+        await idempotency.close()
+    await replicas.replica_router.close()
+    await engine.dispose()
+
+request_latency = histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запросов API", ("method", "route", "status")
+)
+requests_in_flight = gauge("http_requests_in_flight", "Запросы API в обработке")
+callback_gauge("scores_cache_hits_total", "Попадания в кэш баллов", lambda: scores_cache.stats()["hits"], "counter")
+callback_gauge("scores_cache_misses_total", "Промахи кэша баллов", lambda: scores_cache.stats()["misses"], "counter")
+callback_gauge("user_id_cache_hits_total", "Попадания в кэш users.id", lambda: user_id_cache.hits, "counter")
+callback_gauge("user_id_cache_misses_total", "Промахи кэша users.id", lambda: user_id_cache.misses, "counter")
+callback_gauge("db_pool_checked_out", "Занятые соединения пула БД", lambda: pool_status(engine).get("checked_out", 0))
+callback_gauge("log_records_dropped_total", "Отброшенные записи лога", dropped_records, "counter")
+callback_gauge(
+    "score_write_queue_depth",
+    "POST /scores/, ждущие записи пачкой",
+    lambda: score_writer.queue_depth if score_writer is not None else 0,
+)
+
+class MetricsMiddleware:
+    # Чистый ASGI-middleware: латентность по шаблону маршрута и число запросов в обработке
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_flight.dec()
+            route = scope.get("route")
+            request_latency.observe(
+                time.perf_counter() - start, scope["method"], route.path if route else "unmatched", status
+            )
+
+app = FastAPI(title="EGE Tracker API", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+# Списки отдаем через RowEncoder: crud возвращает кортежи в порядке полей модели ответа
+scores_encoder = RowEncoder(schemas.ScoreResponse)
+
+# Склейка конкурентных записей баллов в пачки (SCORE_WRITE_COMBINING), иначе каждый
+# POST /scores/ пишется своей транзакцией
+score_writer = (
+    ScoreWriteCombiner(
+        AsyncSessionLocal,
+        window=settings.SCORE_WRITE_WINDOW,
+        max_batch=settings.SCORE_WRITE_MAX_BATCH,
+        flush_concurrency=settings.SCORE_WRITE_FLUSH_CONCURRENCY,
+    )
+    if settings.SCORE_WRITE_COMBINING
+    else None
+)
+
+# Ответы на записи с Idempotency-Key: повтор и дубль запроса бота не пишут второй раз
+idempotency = create_idempotency(engine)
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+@app.get("/ready")
+async def ready(response: Response):
+    # Готовность: пул прогрет и соединения проверены; заодно отдаем загрузку пула
+    if not getattr(app.state, "ready", False):
+        await _warmup(app)
+    if not app.state.ready:
+        response.status_code = 503
+    status = {"ready": app.state.ready, "db_pool": pool_status(engine)}
+    if replicas.replica_router.replicas:
+        status["replicas"] = replicas.replica_router.stats()
+    return status
+
+async def _idempotent(key: str | None, route: str, payload: BaseModel, handler, response_model) -> Response:
+    # Выполняет запись один раз на ключ; повторам отдаем сохраненный ответ, в том числе 4xx
+    if key is None or idempotency is None:
+        return await handler()
+
+    async def call() -> StoredResponse:
+        try:
+            result = await handler()
+        except HTTPException as e:
+            return StoredResponse(e.status_code, json.dumps({"detail": e.detail}).encode())
+        return StoredResponse(200, response_model.model_validate(result).model_dump_json().encode())
+
+    try:
+        stored, replayed = await idempotency.run(key, fingerprint(route, payload.model_dump_json().encode()), call)
+    except IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request") from e
+    except IdempotencyInProgress as e:
+        raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is in progress") from e
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(content=stored.body, status_code=stored.status_code, media_type="application/json", headers=headers)
 
 @app.post("/users/", response_model=schemas.UserResponse)
-async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
-    return await crud.create_user(db, user)
+async def register_user(
+    user: schemas.UserCreate,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: str | None = Header(default=None, max_length=255),
+):
+    return await _idempotent(
+        idempotency_key, "/users/", user, lambda: _register_user(db, user), schemas.UserResponse
+    )
+
+async def _register_user(db: AsyncSession, user: schemas.UserCreate):
+    result = await crud.create_user(db, user)
+    replicas.replica_router.mark_write(user.telegram_id)
+    return result
 
 @app.post("/scores/", response_model=schemas.ScoreResponse)
-async def add_score(score: schemas.ScoreCreate, db: AsyncSession = Depends(get_db)):
-    result = await crud.add_or_update_score(db, score)
+async def add_score(
+    score: schemas.ScoreCreate,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: str | None = Header(default=None, max_length=255),
+):
+    return await _idempotent(
+        idempotency_key, "/scores/", score, lambda: _add_score(db, score), schemas.ScoreResponse
+    )
+
+async def _add_score(db: AsyncSession, score: schemas.ScoreCreate):
+    try:
+        if score_writer is not None:
+            result = await _add_score_combined(db, score)
+        else:
+            result = await crud.add_or_update_score(db, score)
+    except crud.UnknownSubjectError as e:
+        raise HTTPException(status_code=422, detail=f"Unknown subject: {e}") from e
     if not result:
         raise HTTPException(status_code=404, detail="User not found. Please register first.")
+    replicas.replica_router.mark_write(score.telegram_id)
     return result
 
+async def _add_score_combined(db: AsyncSession, score: schemas.ScoreCreate) -> schemas.ScoreResponse | None:
+    # Предмет проверяем сразу, чтобы 422 получил только этот вызов, а не вся пачка
+    subject_id = (await crud.resolve_subject_ids(db, [score.subject])).get(score.subject)
+    if subject_id is None:
+        raise crud.UnknownSubjectError(score.subject)
+    # Соединение запроса на время ожидания пачки не держим: пачка пишется своей сессией
+    if db.in_transaction():
+        await db.rollback()
+    if not await score_writer.submit(score):
+        return None
+    return schemas.ScoreResponse(subject=subject_cache.get_name(subject_id), score=score.score)
+
+@app.post("/scores/bulk", response_model=schemas.BulkScoreResponse)
+async def add_scores_bulk(request: Request, db: AsyncSession = Depends(get_db)):
+    # Принимает JSON-массив или NDJSON (application/x-ndjson) из ScoreCreate;
+    # тело читается потоком, в памяти держим не больше одного чанка и BULK_MAX_ERRORS
+    # ошибок. Каждый чанк коммитится сам: если тело оборвалось на середине, уже
+    # записанные чанки остаются, и 400 несет отчет о них (detail.report)
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        items = iter_ndjson(request.stream())
+    else:
+        items = iter_json_array(request.stream())
+
+    report = schemas.BulkScoreResponse()
+    try:
+        async for chunk in chunked(items, settings.BULK_CHUNK_SIZE):
+            await _process_bulk_chunk(db, chunk, report)
+    except BulkParseError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": f"Некорректное тело запроса после {report.total} элементов: {e}",
+                "report": report.model_dump(),
+            },
+        ) from e
+    return report
+
+def _add_bulk_error(report: schemas.BulkScoreResponse, **fields):
+    if len(report.errors) < settings.BULK_MAX_ERRORS:
+        report.errors.append(schemas.BulkItemResult(**fields))
+    else:
+        report.errors_omitted += 1
+
+async def _process_bulk_chunk(db: AsyncSession, chunk: list, report: schemas.BulkScoreResponse):
+    valid = []
+    for offset, raw in enumerate(chunk):
+        index = report.total + offset
+        if isinstance(raw, BulkParseError):
+            report.invalid += 1
+            _add_bulk_error(report, index=index, status="invalid", detail=str(raw))
+            continue
+        try:
+            valid.append((index, schemas.ScoreCreate.model_validate(raw)))
+        except ValidationError as e:
+            report.invalid += 1
+            detail = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            _add_bulk_error(report, index=index, status="invalid", detail=detail)
+    report.total += len(chunk)
+
+    if not valid:
+        return
+    try:
+        subject_ids = await crud.resolve_subject_ids(db, list({item.subject for _, item in valid}))
+        for index, item in valid:
+            if item.subject not in subject_ids:
+                report.invalid += 1
+                _add_bulk_error(
+                    report, index=index, telegram_id=item.telegram_id, status="invalid", detail="Unknown subject"
+                )
+        valid = [(index, item) for index, item in valid if item.subject in subject_ids]
+        not_found = await crud.bulk_upsert_scores(db, [item for _, item in valid])
+    except Exception as e:
+        logger.error(f"Ошибка массовой загрузки чанка из {len(valid)} баллов: {e}")
+        await db.rollback()
+        report.failed += len(valid)
+        for index, item in valid:
+            _add_bulk_error(report, index=index, telegram_id=item.telegram_id, status="error", detail=str(e))
+        return
+
+    for index, item in valid:
+        if item.telegram_id in not_found:
+            report.not_found += 1
+            _add_bulk_error(report, index=index, telegram_id=item.telegram_id, status="not_found")
+        else:
+            report.upserted += 1
+            replicas.replica_router.mark_write(item.telegram_id)
+
 @app.get("/scores/{telegram_id}", response_model=list[schemas.ScoreResponse])
-async def get_scores(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    scores = await crud.get_user_scores(db, telegram_id)
-    return scores
+async def get_scores(
+    telegram_id: int,
+    if_none_match: str | None = Header(default=None),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Read-through кэш: храним уже сериализованный ответ, инвалидация — в crud при записи
+    key = scores_key(telegram_id)
+    body = await scores_cache.get(key)
+    if body is None:
+        rows = await crud.get_user_score_rows(db, telegram_id)
+        body = scores_encoder.encode(rows)
+        await scores_cache.set(key, body)
+
+    etag = make_etag(body)
+    if if_none_match and _etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@app.get("/scores/{telegram_id}/history", response_model=schemas.ScoreHistoryPage)
+async def score_history(
+    telegram_id: int,
+    subject: str | None = None,
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Все попытки юзера от новых к старым; следующая страница — по next_cursor
+    subject_id = None
+    if subject is not None:
+        subject_id = (await crud.resolve_subject_ids(db, [subject], create=False)).get(subject)
+        if subject_id is None:
+            raise HTTPException(status_code=404, detail="Unknown subject")
+    before = None
+    if cursor is not None:
+        try:
+            before = crud.parse_history_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+    # Берем на строку больше, чтобы без COUNT знать, есть ли следующая страница
+    rows = await crud.get_score_history(db, telegram_id, subject_id, limit + 1, before)
+    page = schemas.ScoreHistoryPage(
+        items=[
+            schemas.ScoreHistoryEntry(subject=name, score=score, created_at=created_at)
+            for _, name, score, created_at in rows[:limit]
+        ]
+    )
+    if len(rows) > limit:
+        history_id, _, _, created_at = rows[limit - 1]
+        page.next_cursor = crud.history_cursor(created_at, history_id)
+    return page
+
+@app.get("/scores/{telegram_id}/trends", response_model=list[schemas.SubjectTrend])
+async def score_trends(
+    telegram_id: int, points: int = Query(default=5, ge=1, le=20), db: AsyncSession = Depends(get_read_db)
+):
+    trends = await crud.get_score_trends(db, telegram_id, points)
+    return [schemas.SubjectTrend(subject=subject, scores=scores) for subject, scores in trends]
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+@app.get("/stats/{subject}", response_model=schemas.SubjectStats)
+async def subject_stats(subject: str, db: AsyncSession = Depends(get_read_db)):
+    stats = await crud.get_subject_stats(db, subject)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No scores for this subject")
+    return stats
+
+@app.get("/stats/{subject}/top", response_model=list[schemas.LeaderboardEntry])
+async def subject_leaderboard(
+    subject: str, limit: int = Query(default=10, ge=1, le=100), db: AsyncSession = Depends(get_read_db)
+):
+    return await crud.get_leaderboard(db, subject, limit)
+
+@app.get("/users/{telegram_id}/stats", response_model=list[schemas.UserSubjectStats])
+async def user_stats(telegram_id: int, db: AsyncSession = Depends(get_read_db)):
+    return await crud.get_user_stats(db, telegram_id)
+
+@app.get("/export/scores")
+async def export_scores(
+    format: Literal["csv", "ndjson"] = "csv",
+    subject: str | None = None,
+    min_score: int | None = Query(default=None, ge=schemas.SCORE_MIN, le=schemas.SCORE_MAX),
+    max_score: int | None = Query(default=None, ge=schemas.SCORE_MIN, le=schemas.SCORE_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Потоковая выгрузка всех баллов: строки читаются курсором пачками и сразу
+    # отдаются клиенту, память не зависит от объема выгрузки
+    subject_id = None
+    if subject is not None:
+        subject_id = (await crud.resolve_subject_ids(db, [subject], create=False)).get(subject)
+        if subject_id is None:
+            raise HTTPException(status_code=404, detail="Unknown subject")
+
+    batches = crud.stream_scores(db, subject_id, min_score, max_score, settings.EXPORT_BATCH_SIZE)
+    return StreamingResponse(
+        export.encode(batches, format),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="scores.{format}"'},
+    )
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"scores": scores_cache.stats(), "user_ids": user_id_cache.stats(), "subjects": subject_cache.stats()}
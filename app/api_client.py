@@ -0,0 +1,210 @@
+import asyncio
+import time
+import uuid
+
+import httpx
+
+from app.config import settings
+from app.logger import setup_logger
+from app.metrics import counter, histogram
+from app.schemas import ScoreResponse, SubjectTrend, UserResponse, UserSubjectStats
+
+logger = setup_logger("api_client")
+
+api_call_latency = histogram(
+    "bot_api_request_duration_seconds", "Время запросов ботов к API", ("endpoint", "status")
+)
+api_call_retries = counter("bot_api_retries_total", "Повторы и дубли запросов ботов к API", ("endpoint", "reason"))
+
+# Ответы, после которых запрос можно повторить: API перегружен или недоступен за
+# балансировщиком, 409 — дубль по тому же Idempotency-Key еще выполняется
+RETRY_STATUSES = frozenset({409, 502, 503, 504})
+
+class ApiError(Exception):
+    def __init__(self, status_code: int, detail: str = ""):
+        super().__init__(f"API вернул код {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+class ApiClient:
+    # Общий клиент API для обоих ботов: держит пул keep-alive соединений
+    # вместо нового TCP-подключения на каждое сообщение.
+
+    def __init__(
+        self,
+        base_url: str,
+        *,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 10.0,
+        connect_timeout: float = 3.0,
+        retries: int = 3,
+        retry_backoff: float = 0.1,
+        retry_backoff_max: float = 2.0,
+        hedge_delay: float = 0.0,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.hedge_delay = hedge_delay
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=self.limits,
+                timeout=self.timeout,
+                transport=self._transport,
+            )
+        return self._client
+
+    async def start(self, warmup_connections: int = 0):
+        # Прогрев: заранее открываем соединения, чтобы первые сообщения не платили за connect
+        if warmup_connections <= 0:
+            return
+        results = await asyncio.gather(
+            *(self._request("GET", "/health", "health") for _ in range(warmup_connections)),
+            return_exceptions=True,
+        )
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logger.warning(f"Прогрев API: {len(failed)} из {warmup_connections} соединений не открыты: {failed[0]}")
+        else:
+            logger.info(f"Прогрев API: открыто {warmup_connections} соединений к {self.base_url}")
+
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("Соединения с API закрыты")
+        self._client = None
+
+    async def _request(
+        self, method: str, path: str, endpoint: str, *, idempotency_key: str | None = None, **kwargs
+    ) -> httpx.Response:
+        # Записи идут с Idempotency-Key, одним на все повторы и дубли: API выполнит ее один раз
+        if idempotency_key is not None:
+            kwargs["headers"] = {**kwargs.get("headers", {}), "Idempotency-Key": idempotency_key}
+        safe = method == "GET" or idempotency_key is not None
+        start = time.perf_counter()
+        status = "error"
+        try:
+            if safe and self.hedge_delay > 0 and idempotency_key is not None:
+                response = await self._send_hedged(method, path, endpoint, **kwargs)
+            else:
+                response = await self._send(method, path, endpoint, safe, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            api_call_latency.observe(time.perf_counter() - start, endpoint, status)
+
+    async def _send(self, method: str, path: str, endpoint: str, safe: bool = False, **kwargs) -> httpx.Response:
+        # Ошибки подключения повторяем всегда: запрос до сервера не дошел. Таймауты,
+        # обрывы и RETRY_STATUSES — только для безопасных запросов (GET и записи с
+        # Idempotency-Key): сервер мог запрос уже выполнить
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                if not safe or response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                reason, error = "status", f"код {response.status_code}"
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt >= self.retries:
+                    raise
+                reason, error = "connect", f"нет соединения: {e}"
+            except (httpx.TimeoutException, httpx.RemoteProtocolError, httpx.ReadError) as e:
+                if not safe or attempt >= self.retries:
+                    raise
+                reason, error = "timeout", f"{type(e).__name__}: {e}"
+            delay = min(self.retry_backoff * 2**attempt, self.retry_backoff_max)
+            attempt += 1
+            api_call_retries.inc(endpoint, reason)
+            logger.warning(
+                f"Запрос {endpoint} к API не удался ({error}), повтор {attempt}/{self.retries} через {delay:.2f}с"
+            )
+            await asyncio.sleep(delay)
+
+    async def _send_hedged(self, method: str, path: str, endpoint: str, **kwargs) -> httpx.Response:
+        # Если ответа нет дольше hedge_delay, отправляем дубль и берем первый ответ.
+        # Дубль по тому же Idempotency-Key сервер склеивает с первым запросом, поэтому
+        # выигрыш — когда первый застрял в сети или на мертвом соединении
+        attempts = {asyncio.create_task(self._send(method, path, endpoint, True, **kwargs))}
+        done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay)
+        if not done:
+            api_call_retries.inc(endpoint, "hedge")
+            attempts.add(asyncio.create_task(self._send(method, path, endpoint, True, **kwargs)))
+        error = None
+        try:
+            while attempts:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def register_user(
+        self, telegram_id: int, first_name: str, last_name: str, platform: str | None = None
+    ) -> UserResponse:
+        payload = {"telegram_id": telegram_id, "first_name": first_name, "last_name": last_name, "platform": platform}
+        response = await self._request(
+            "POST", "/users/", "register_user", idempotency_key=uuid.uuid4().hex, json=payload
+        )
+        if response.status_code != 200:
+            raise ApiError(response.status_code, response.text)
+        return UserResponse.model_validate_json(response.content)
+
+    async def add_score(self, telegram_id: int, subject: str, score: int) -> ScoreResponse | None:
+        payload = {"telegram_id": telegram_id, "subject": subject, "score": score}
+        response = await self._request("POST", "/scores/", "add_score", idempotency_key=uuid.uuid4().hex, json=payload)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise ApiError(response.status_code, response.text)
+        return ScoreResponse.model_validate_json(response.content)
+
+    async def get_scores(self, telegram_id: int) -> list[ScoreResponse]:
+        response = await self._request("GET", f"/scores/{telegram_id}", "get_scores")
+        if response.status_code != 200:
+            raise ApiError(response.status_code, response.text)
+        return [ScoreResponse.model_validate(item) for item in response.json()]
+
+    async def get_stats(self, telegram_id: int) -> list[UserSubjectStats]:
+        response = await self._request("GET", f"/users/{telegram_id}/stats", "get_stats")
+        if response.status_code != 200:
+            raise ApiError(response.status_code, response.text)
+        return [UserSubjectStats.model_validate(item) for item in response.json()]
+
+    async def get_trends(self, telegram_id: int, points: int = 5) -> list[SubjectTrend]:
+        response = await self._request("GET", f"/scores/{telegram_id}/trends", "get_trends", params={"points": points})
+        if response.status_code != 200:
+            raise ApiError(response.status_code, response.text)
+        return [SubjectTrend.model_validate(item) for item in response.json()]
+
+api_client = ApiClient(
+    settings.API_BASE_URL,
+    max_connections=settings.API_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.API_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.API_KEEPALIVE_EXPIRY,
+    timeout=settings.API_TIMEOUT,
+    connect_timeout=settings.API_CONNECT_TIMEOUT,
+    retries=settings.API_RETRIES,
+    retry_backoff=settings.API_RETRY_BACKOFF,
+    retry_backoff_max=settings.API_RETRY_BACKOFF_MAX,
+    hedge_delay=settings.API_HEDGE_DELAY,
+)
@@ -0,0 +1,94 @@
+from typing import Protocol
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import crud
+from app.api_client import ApiError, api_client
+from app.config import settings
+from app.database import AsyncSessionLocal, warmup_pool
+from app.logger import setup_logger
+from app.schemas import ScoreCreate, ScoreResponse, SubjectTrend, UserCreate, UserResponse, UserSubjectStats
+
+logger = setup_logger("backend")
+
+class ScoresBackend(Protocol):
+    # Интерфейс, через который боты работают с баллами: по HTTP (ApiClient) или напрямую (EmbeddedBackend)
+
+    async def start(self, warmup_connections: int = 0) -> None: ...
+
+    async def close(self) -> None: ...
+
+    async def register_user(
+        self, telegram_id: int, first_name: str, last_name: str, platform: str | None = None
+    ) -> UserResponse: ...
+
+    async def add_score(self, telegram_id: int, subject: str, score: int) -> ScoreResponse | None: ...
+
+    async def get_scores(self, telegram_id: int) -> list[ScoreResponse]: ...
+
+    async def get_stats(self, telegram_id: int) -> list[UserSubjectStats]: ...
+
+    async def get_trends(self, telegram_id: int, points: int = 5) -> list[SubjectTrend]: ...
+
+class EmbeddedBackend:
+    # Встроенный режим для небольших инсталляций: бот вызывает crud в своем процессе
+    # через собственный пул соединений, без HTTP-похода в API
+
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession] = AsyncSessionLocal):
+        self.session_factory = session_factory
+
+    @property
+    def engine(self):
+        return self.session_factory.kw["bind"]
+
+    async def start(self, warmup_connections: int = 0):
+        if warmup_connections > 0:
+            await warmup_pool(self.engine, warmup_connections)
+
+    async def close(self):
+        await self.engine.dispose()
+        logger.info("Соединения с БД закрыты")
+
+    async def register_user(
+        self, telegram_id: int, first_name: str, last_name: str, platform: str | None = None
+    ) -> UserResponse:
+        async with self.session_factory() as db:
+            user = await crud.create_user(
+                db,
+                UserCreate(telegram_id=telegram_id, first_name=first_name, last_name=last_name, platform=platform),
+            )
+            return UserResponse.model_validate(user)
+
+    async def add_score(self, telegram_id: int, subject: str, score: int) -> ScoreResponse | None:
+        async with self.session_factory() as db:
+            try:
+                result = await crud.add_or_update_score(
+                    db, ScoreCreate(telegram_id=telegram_id, subject=subject, score=score)
+                )
+            except crud.UnknownSubjectError as e:
+                # Как 422 от API: бот одинаково отвечает в обоих режимах
+                raise ApiError(422, f"Unknown subject: {e}") from e
+            return ScoreResponse.model_validate(result) if result is not None else None
+
+    async def get_scores(self, telegram_id: int) -> list[ScoreResponse]:
+        async with self.session_factory() as db:
+            rows = await crud.get_user_score_rows(db, telegram_id)
+            return [ScoreResponse.model_construct(subject=subject, score=score) for subject, score in rows]
+
+    async def get_stats(self, telegram_id: int) -> list[UserSubjectStats]:
+        async with self.session_factory() as db:
+            stats = await crud.get_user_stats(db, telegram_id)
+            return [UserSubjectStats.model_validate(item) for item in stats]
+
+    async def get_trends(self, telegram_id: int, points: int = 5) -> list[SubjectTrend]:
+        async with self.session_factory() as db:
+            trends = await crud.get_score_trends(db, telegram_id, points)
+            return [SubjectTrend(subject=subject, scores=scores) for subject, scores in trends]
+
+def create_backend() -> ScoresBackend:
+    if settings.BOT_BACKEND == "embedded":
+        logger.info("Боты работают во встроенном режиме (crud напрямую)")
+        return EmbeddedBackend()
+    return api_client
+
+backend = create_backend()
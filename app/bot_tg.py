@@ -1,19 +1,64 @@
 import asyncio
+import time
 
-import httpx
-from aiogram import Bot, Dispatcher, Router, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+from app.api_client import ApiError
+from app.backend import backend
 from app.config import settings
-from app.logger import setup_logger
+from app.database import engine
+from app.fsm_storage import FSMFlushMiddleware, SQLStorage
+from app.logger import sampled, setup_logger
+from app.metrics import histogram, start_metrics_server
+from app.schemas import SCORE_MAX
+from app.tg_webhook import run_webhook
+from app.update_dispatcher import OrderedDispatcher, setup_ordered_dispatch
 
 logger = setup_logger("bot_tg")
+msg_logger = sampled(logger)
+
+handler_latency = histogram("bot_handler_duration_seconds", "Время работы обработчиков бота", ("bot", "handler"))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_latency.observe(time.perf_counter() - start, "tg", data["handler"].callback.__name__)
 
 bot = Bot(token=settings.BOT_TOKEN)
-dp = Dispatcher()
+if settings.FSM_STORAGE == "sql":
+    fsm_storage = SQLStorage(
+        engine,
+        cache_size=settings.FSM_CACHE_SIZE,
+        cache_ttl=settings.FSM_CACHE_TTL,
+        state_ttl=settings.FSM_STATE_TTL,
+        purge_interval=settings.FSM_PURGE_INTERVAL,
+    )
+    dp = Dispatcher(storage=fsm_storage)
+else:
+    fsm_storage = None
+    dp = Dispatcher()
+if settings.BOT_ORDERED_DISPATCH:
+    # Очередь чата охватывает и чтение, и запись состояния FSM
+    update_dispatcher = OrderedDispatcher(
+        "tg",
+        max_in_flight=settings.BOT_MAX_IN_FLIGHT,
+        max_pending=settings.BOT_MAX_PENDING,
+        shards=settings.BOT_DISPATCH_SHARDS,
+        dedup_window=settings.BOT_DEDUP_WINDOW,
+    )
+    setup_ordered_dispatch(dp, update_dispatcher)
+else:
+    update_dispatcher = None
+if fsm_storage is not None:
+    dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
 router = Router()
+router.message.middleware(HandlerMetricsMiddleware())
 
 class RegisterState(StatesGroup):
     waiting_for_name = State()
@@ -24,25 +69,27 @@ class ScoreState(StatesGroup):
 
 @router.message(Command("start"))
 async def cmd_start(message: types.Message):
-    logger.info(f"ТГ Бот: Юзер {message.from_user.id} вызвал /start")
+    msg_logger.info(f"ТГ Бот: Юзер {message.from_user.id} вызвал /start")
     await message.answer(
         "Привет! Я бот для учета баллов ЕГЭ.\n"
         "Доступные команды:\n"
         "/register - Регистрация\n"
         "/enter_scores - Ввести баллы\n"
-        "/view_scores - Посмотреть мои баллы"
+        "/view_scores - Посмотреть мои баллы\n"
+        "/history - Динамика баллов по предметам\n"
+        "/stats - Мое место среди учеников"
     )
 
 # Регистрация
 @router.message(Command("register"))
 async def cmd_register(message: types.Message, state: FSMContext):
-    logger.info(f"ТГ Бот: Юзер {message.from_user.id} начал /register")
+    msg_logger.info(f"ТГ Бот: Юзер {message.from_user.id} начал /register")
     await message.answer("Введите Имя и Фамилию (например: Имя Фамилия):")
     await state.set_state(RegisterState.waiting_for_name)
 
 @router.message(RegisterState.waiting_for_name)
 async def process_name(message: types.Message, state: FSMContext):
-    logger.info(f"ТГ Бот: Юзер {message.from_user.id} ввел имя: {message.text}")
+    msg_logger.info(f"ТГ Бот: Юзер {message.from_user.id} ввел имя: {message.text}")
     full_name = message.text
     parts = full_name.split()
     if len(parts) < 2:
@@ -53,31 +100,24 @@ async def process_name(message: types.Message, state: FSMContext):
     first_name, last_name = parts[0], parts[1]
     telegram_id = message.from_user.id
 
-    async with httpx.AsyncClient() as client:
-        payload = {
-            "telegram_id": telegram_id,
-            "first_name": first_name,
-            "last_name": last_name
-        }
-        try:
-            logger.info(f"ТГ Бот: Отправка регистрации в API для {telegram_id}")
-            response = await client.post(f"{settings.API_BASE_URL}/users/", json=payload)
-            if response.status_code == 200:
-                logger.info(f"ТГ Бот: Юзер {telegram_id} успешно создан")
-                await message.answer(f"Ученик {first_name} {last_name} успешно зарегистрирован!")
-            else:
-                logger.error(f"ТГ Бот: Ошибка API {response.status_code} при регистрации {telegram_id}")
-                await message.answer("Ошибка при регистрации на сервере.")
-        except Exception as e:
-            logger.error(f"ТГ Бот: Критическая ошибка соединения с API: {e}")
-            await message.answer(f"Ошибка соединения: {e}")
+    try:
+        msg_logger.info(f"ТГ Бот: Отправка регистрации в API для {telegram_id}")
+        await backend.register_user(telegram_id, first_name, last_name, platform="tg")
+        msg_logger.info(f"ТГ Бот: Юзер {telegram_id} успешно создан")
+        await message.answer(f"Ученик {first_name} {last_name} успешно зарегистрирован!")
+    except ApiError as e:
+        logger.error(f"ТГ Бот: Ошибка API {e.status_code} при регистрации {telegram_id}")
+        await message.answer("Ошибка при регистрации на сервере.")
+    except Exception as e:
+        logger.error(f"ТГ Бот: Критическая ошибка соединения с API: {e}")
+        await message.answer(f"Ошибка соединения: {e}")
 
     await state.clear()
 
 # Ввод баллов
 @router.message(Command("enter_scores"))
 async def cmd_enter_scores(message: types.Message, state: FSMContext):
-    logger.info(f"ТГ Бот: Юзер {message.from_user.id} вызвал /enter_scores")
+    msg_logger.info(f"ТГ Бот: Юзер {message.from_user.id} вызвал /enter_scores")
     keyboard = types.ReplyKeyboardMarkup(
         keyboard=[
             [types.KeyboardButton(text="Математика"), types.KeyboardButton(text="Русский язык")],
@@ -91,16 +131,16 @@ async def cmd_enter_scores(message: types.Message, state: FSMContext):
 
 @router.message(ScoreState.waiting_for_subject)
 async def process_subject(message: types.Message, state: FSMContext):
-    logger.info(f"ТГ Бот: Юзер {message.from_user.id} выбрал предмет {message.text}")
+    msg_logger.info(f"ТГ Бот: Юзер {message.from_user.id} выбрал предмет {message.text}")
     await state.update_data(subject=message.text)
     await message.answer("Введите количество баллов (число):", reply_markup=types.ReplyKeyboardRemove())
     await state.set_state(ScoreState.waiting_for_score)
 
 @router.message(ScoreState.waiting_for_score)
 async def process_score(message: types.Message, state: FSMContext):
-    if not message.text.isdigit():
-        logger.warning(f"ТГ Бот: Юзер {message.from_user.id} ввел не число в баллы: {message.text}")
-        await message.answer("Пожалуйста, введите число.")
+    if not message.text.isdigit() or int(message.text) > SCORE_MAX:
+        logger.warning(f"ТГ Бот: Юзер {message.from_user.id} ввел некорректные баллы: {message.text}")
+        await message.answer(f"Пожалуйста, введите число от 0 до {SCORE_MAX}.")
         return
 
     score = int(message.text)
@@ -108,27 +148,21 @@ async def process_score(message: types.Message, state: FSMContext):
     subject = data['subject']
     telegram_id = message.from_user.id
 
-    async with httpx.AsyncClient() as client:
-        payload = {
-            "telegram_id": telegram_id,
-            "subject": subject,
-            "score": score
-        }
-        try:
-            logger.info(f"ТГ Бот: Отправка баллов в API для {telegram_id} ({subject})")
-            response = await client.post(f"{settings.API_BASE_URL}/scores/", json=payload)
-            if response.status_code == 200:
-                logger.info(f"ТГ Бот: Баллы для {telegram_id} сохранены")
-                await message.answer(f"Балл сохранен: {subject} - {score}")
-            elif response.status_code == 404:
-                logger.warning(f"ТГ Бот: Юзер {telegram_id} пытался ввести баллы без регистрации")
-                await message.answer("Сначала нужно зарегистрироваться! (/register)")
-            else:
-                logger.error(f"ТГ Бот: Ошибка API {response.status_code} при вводе баллов")
-                await message.answer("Ошибка сохранения.")
-        except Exception as e:
-            logger.error(f"ТГ Бот: Ошибка соединения при вводе баллов: {e}")
-            await message.answer(f"Ошибка соединения: {e}")
+    try:
+        msg_logger.info(f"ТГ Бот: Отправка баллов в API для {telegram_id} ({subject})")
+        result = await backend.add_score(telegram_id, subject, score)
+        if result is not None:
+            msg_logger.info(f"ТГ Бот: Баллы для {telegram_id} сохранены")
+            await message.answer(f"Балл сохранен: {subject} - {score}")
+        else:
+            logger.warning(f"ТГ Бот: Юзер {telegram_id} пытался ввести баллы без регистрации")
+            await message.answer("Сначала нужно зарегистрироваться! (/register)")
+    except ApiError as e:
+        logger.error(f"ТГ Бот: Ошибка API {e.status_code} при вводе баллов")
+        await message.answer("Ошибка сохранения.")
+    except Exception as e:
+        logger.error(f"ТГ Бот: Ошибка соединения при вводе баллов: {e}")
+        await message.answer(f"Ошибка соединения: {e}")
 
     await state.clear()
 
@@ -136,34 +170,103 @@ async def process_score(message: types.Message, state: FSMContext):
 @router.message(Command("view_scores"))
 async def cmd_view_scores(message: types.Message):
     telegram_id = message.from_user.id
-    logger.info(f"ТГ Бот: Юзер {telegram_id} запросил свои баллы")
+    msg_logger.info(f"ТГ Бот: Юзер {telegram_id} запросил свои баллы")
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{settings.API_BASE_URL}/scores/{telegram_id}")
-            if response.status_code == 200:
-                scores = response.json()
-                logger.info(f"ТГ Бот: Получено {len(scores)} предметов для {telegram_id}")
-                if not scores:
-                    await message.answer("У вас пока нет сохраненных баллов.")
-                    return
-
-                text = "Ваши баллы:\n"
-                for item in scores:
-                    text += f"-- {item['subject']}: {item['score']}\n"
-                await message.answer(text)
-            else:
-                logger.error(f"ТГ Бот: Не удалось получить баллы для {telegram_id}, код {response.status_code}")
-                await message.answer("Не удалось получить данные.")
-        except Exception as e:
-            logger.error(f"ТГ Бот: Ошибка сети при просмотре баллов: {e}")
-            await message.answer(f"Ошибка соединения: {e}")
+    try:
+        scores = await backend.get_scores(telegram_id)
+        msg_logger.info(f"ТГ Бот: Получено {len(scores)} предметов для {telegram_id}")
+        if not scores:
+            await message.answer("У вас пока нет сохраненных баллов.")
+            return
+
+        text = "Ваши баллы:\n"
+        for item in scores:
+            text += f"-- {item.subject}: {item.score}\n"
+        await message.answer(text)
+    except ApiError as e:
+        logger.error(f"ТГ Бот: Не удалось получить баллы для {telegram_id}, код {e.status_code}")
+        await message.answer("Не удалось получить данные.")
+    except Exception as e:
+        logger.error(f"ТГ Бот: Ошибка сети при просмотре баллов: {e}")
+        await message.answer(f"Ошибка соединения: {e}")
+
+# Статистика
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    telegram_id = message.from_user.id
+    msg_logger.info(f"ТГ Бот: Юзер {telegram_id} запросил статистику")
+
+    try:
+        stats = await backend.get_stats(telegram_id)
+        if not stats:
+            await message.answer("У вас пока нет сохраненных баллов.")
+            return
+
+        text = "Ваше место по предметам:\n"
+        for item in stats:
+            text += (
+                f"-- {item.subject}: {item.score} — место {item.rank} из {item.total} "
+                f"(средний {item.mean}, медиана {item.median})\n"
+            )
+        await message.answer(text)
+    except ApiError as e:
+        logger.error(f"ТГ Бот: Не удалось получить статистику для {telegram_id}, код {e.status_code}")
+        await message.answer("Не удалось получить данные.")
+    except Exception as e:
+        logger.error(f"ТГ Бот: Ошибка сети при запросе статистики: {e}")
+        await message.answer(f"Ошибка соединения: {e}")
+
+# Динамика баллов
+@router.message(Command("history"))
+async def cmd_history(message: types.Message):
+    telegram_id = message.from_user.id
+    msg_logger.info(f"ТГ Бот: Юзер {telegram_id} запросил динамику баллов")
+
+    try:
+        trends = await backend.get_trends(telegram_id)
+        if not trends:
+            await message.answer("У вас пока нет сохраненных баллов.")
+            return
+
+        text = "Динамика по предметам (последние попытки):\n"
+        for trend in trends:
+            text += f"-- {trend.subject}: {' → '.join(map(str, trend.scores))}"
+            if len(trend.scores) > 1:
+                text += f" ({trend.scores[-1] - trend.scores[0]:+d})"
+            text += "\n"
+        await message.answer(text)
+    except ApiError as e:
+        logger.error(f"ТГ Бот: Не удалось получить динамику для {telegram_id}, код {e.status_code}")
+        await message.answer("Не удалось получить данные.")
+    except Exception as e:
+        logger.error(f"ТГ Бот: Ошибка сети при запросе динамики: {e}")
+        await message.answer(f"Ошибка соединения: {e}")
+
+async def on_startup():
+    await start_metrics_server(settings.BOT_METRICS_PORT)
+    await backend.start(warmup_connections=settings.API_WARMUP_CONNECTIONS)
+    if fsm_storage is not None:
+        await fsm_storage.start()
+
+async def on_shutdown():
+    if update_dispatcher is not None:
+        await update_dispatcher.close()
+    await backend.close()
 
 async def main():
     dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if settings.TG_MODE == "webhook":
+        logger.info("ТГ Бот: Запуск в режиме webhook...")
+        await run_webhook(dp, bot)
+        return
+
     logger.info("ТГ Бот: Запуск поллинга...")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # Апдейты, пришедшие во время рестарта, не теряем
+    await bot.delete_webhook(drop_pending_updates=False)
+    # С диспетчером апдейт только ставится в очередь чата, задачи на апдейт не нужны
+    await dp.start_polling(bot, handle_as_tasks=update_dispatcher is None)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+
+import httpx
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.config import settings
+from app.crud import resolve_subject_ids
+from app.database import AsyncSessionLocal
+from app.logger import setup_logger
+from app.metrics import counter
+from app.models import Score, User
+
+logger = setup_logger("broadcast")
+
+broadcast_messages = counter(
+    "broadcast_messages_total", "Сообщения рассылки по результату", ("platform", "status")
+)
+
+# Рассылка всем зарегистрированным ученикам (или сдававшим предмет) в Telegram или VK.
+# Получатели — только юзеры своей платформы (users.platform): ВК-бот хранит vk_id в том же
+# telegram_id, и чужой id может совпасть с реальным посторонним чатом. Юзеры без отметки
+# (до миграции 007, из импорта) получают рассылку только с --include-unknown-platform.
+#
+#   python -m app.broadcast --platform tg --text "Завтра пробный ЕГЭ" --checkpoint tg_reminder.json
+#   python -m app.broadcast --platform vk --subject Физика --text "..." --checkpoint vk_physics.json
+#
+# Юзеры читаются пачками по id (keyset), каждая пачка — своей короткой сессией, отправка
+# идет через token bucket с общим лимитом платформы и лимитом на чат. Прогресс пишется
+# в файл после того, как отправлена вся пачка, поэтому доставка — at-least-once:
+# рассылка, прерванная посреди пачки, с тем же файлом начинает эту пачку заново,
+# и до --batch-size юзеров получат сообщение повторно.
+
+class FloodWait(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"flood wait {retry_after}s")
+        self.retry_after = retry_after
+
+class PermanentSendError(Exception):
+    # Юзер заблокировал бота, чат не найден и т.п. — повторять бессмысленно
+    pass
+
+class RetryableSendError(Exception):
+    # Ответ не разобрать (ошибка прокси, HTML вместо JSON) — повторяем для этого чата
+    pass
+
+def _json_body(response: httpx.Response) -> dict:
+    try:
+        body = response.json()
+    except ValueError as e:
+        raise RetryableSendError(f"код {response.status_code}, тело не JSON") from e
+    if not isinstance(body, dict):
+        raise RetryableSendError(f"код {response.status_code}, неожиданное тело ответа")
+    return body
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # После flood wait платформа блокирует весь бот, поэтому тормозим всех отправителей
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class PerChatLimiter:
+    # Минимальный интервал между сообщениями в один чат; помним только недавние чаты
+    def __init__(self, interval: float, max_entries: int = 10000):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._next_allowed: OrderedDict[int, float] = OrderedDict()
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        allowed_at = max(now, self._next_allowed.get(chat_id, 0.0))
+        self._next_allowed[chat_id] = allowed_at + self.interval
+        self._next_allowed.move_to_end(chat_id)
+        while len(self._next_allowed) > self.max_entries:
+            self._next_allowed.popitem(last=False)
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+class RateLimiter:
+    def __init__(self, rate: float, per_chat_interval: float):
+        self.bucket = TokenBucket(rate)
+        self.per_chat = PerChatLimiter(per_chat_interval)
+
+    async def acquire(self, chat_id: int):
+        await self.per_chat.wait(chat_id)
+        await self.bucket.acquire()
+
+class TelegramSender:
+    platform = "tg"
+
+    def __init__(self, token: str, base_url: str = "https://api.telegram.org", transport=None):
+        self.url = f"{base_url.rstrip('/')}/bot{token}/sendMessage"
+        self.client = httpx.AsyncClient(timeout=settings.API_TIMEOUT, transport=transport)
+
+    async def send(self, chat_id: int, text: str):
+        response = await self.client.post(self.url, json={"chat_id": chat_id, "text": text})
+        if response.status_code == 200:
+            return
+        # 5xx и прочие неожиданные коды — httpx.HTTPStatusError, deliver повторит
+        if response.status_code not in (400, 403, 429):
+            response.raise_for_status()
+            raise RetryableSendError(f"код {response.status_code}")
+        body = _json_body(response)
+        if response.status_code == 429:
+            raise FloodWait(float(body.get("parameters", {}).get("retry_after", 1)))
+        raise PermanentSendError(body.get("description", response.status_code))
+
+    async def close(self):
+        await self.client.aclose()
+
+class VKSender:
+    platform = "vk"
+    # 6 — слишком много запросов в секунду, 9 — flood control
+    FLOOD_CODES = {6, 9}
+
+    def __init__(self, token: str, base_url: str = "https://api.vk.com/method", version: str = "5.199", transport=None):
+        self.url = f"{base_url.rstrip('/')}/messages.send"
+        self.params = {"access_token": token, "v": version}
+        self.client = httpx.AsyncClient(timeout=settings.API_TIMEOUT, transport=transport)
+
+    async def send(self, chat_id: int, text: str):
+        data = {**self.params, "peer_id": chat_id, "message": text, "random_id": random.getrandbits(31)}
+        response = await self.client.post(self.url, data=data)
+        response.raise_for_status()
+        error = _json_body(response).get("error")
+        if error is None:
+            return
+        if error.get("error_code") in self.FLOOD_CODES:
+            raise FloodWait(1.0)
+        raise PermanentSendError(error.get("error_msg", error.get("error_code")))
+
+    async def close(self):
+        await self.client.aclose()
+
+class Broadcast:
+    def __init__(
+        self,
+        sender,
+        limiter: RateLimiter,
+        text: str,
+        *,
+        session_factory: async_sessionmaker[AsyncSession] = AsyncSessionLocal,
+        subject: str | None = None,
+        include_unknown_platform: bool = False,
+        batch_size: int = 500,
+        concurrency: int = 20,
+        max_retries: int = 5,
+        retry_backoff: float = 1.0,
+        checkpoint_path: str = "",
+    ):
+        self.sender = sender
+        self.limiter = limiter
+        self.text = text
+        self.session_factory = session_factory
+        self.subject = subject
+        self.include_unknown_platform = include_unknown_platform
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.checkpoint_path = checkpoint_path
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.job_id = hashlib.blake2b(f"{sender.platform}|{subject}|{text}".encode(), digest_size=8).hexdigest()
+        self.progress = {"job_id": self.job_id, "last_user_id": 0, "sent": 0, "failed": 0, "skipped": 0}
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("job_id") != self.job_id:
+            logger.warning(f"Рассылка: Чекпоинт {self.checkpoint_path} от другой рассылки, начинаем сначала")
+            return
+        self.progress = saved
+        logger.info(f"Рассылка: Продолжаем после юзера {saved['last_user_id']} (отправлено {saved['sent']})")
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.progress, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def users_query(self, subject_id: int | None = None):
+        query = select(User.id, User.telegram_id).where(User.id > self.progress["last_user_id"])
+        platform = User.platform == self.sender.platform
+        if self.include_unknown_platform:
+            platform = or_(platform, User.platform.is_(None))
+        query = query.where(platform)
+        if subject_id is not None:
+            query = query.where(User.id.in_(select(Score.user_id).where(Score.subject_id == subject_id)))
+        return query.order_by(User.id).limit(self.batch_size)
+
+    async def deliver(self, chat_id: int) -> str:
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire(chat_id)
+                try:
+                    await self.sender.send(chat_id, self.text)
+                    return "sent"
+                except FloodWait as e:
+                    logger.warning(f"Рассылка: Flood wait {e.retry_after}с на чате {chat_id}")
+                    self.limiter.bucket.pause(e.retry_after)
+                except PermanentSendError as e:
+                    logger.info(f"Рассылка: Чат {chat_id} пропущен: {e}")
+                    return "skipped"
+                except (httpx.HTTPError, RetryableSendError) as e:
+                    logger.warning(f"Рассылка: Ошибка отправки в чат {chat_id} (попытка {attempt + 1}): {e}")
+                    await asyncio.sleep(self.retry_backoff * 2**attempt)
+            return "failed"
+
+    async def run(self) -> dict:
+        self.load_checkpoint()
+        start = time.perf_counter()
+        sent_before = self.progress["sent"]
+        subject_id = None
+        if self.subject is not None:
+            async with self.session_factory() as db:
+                subject_id = (await resolve_subject_ids(db, [self.subject], create=False)).get(self.subject)
+            if subject_id is None:
+                logger.warning(f"Рассылка: Предмет {self.subject} не найден, отправлять некому")
+                return self.progress
+        while True:
+            # Пачка юзеров — отдельная короткая сессия: соединение и транзакция не живут
+            # всю рассылку, следующая пачка — по id после последнего отправленного
+            async with self.session_factory() as db:
+                batch = (await db.execute(self.users_query(subject_id))).all()
+            if not batch:
+                break
+            statuses = await asyncio.gather(*(self.deliver(row.telegram_id) for row in batch))
+            for status in statuses:
+                self.progress[status] += 1
+                broadcast_messages.inc(self.sender.platform, status)
+            self.progress["last_user_id"] = batch[-1].id
+            self.save_checkpoint()
+
+            elapsed = time.perf_counter() - start
+            rate = (self.progress["sent"] - sent_before) / elapsed if elapsed else 0.0
+            logger.info(
+                f"Рассылка: Отправлено {self.progress['sent']}, пропущено {self.progress['skipped']}, "
+                f"ошибок {self.progress['failed']}, {rate:.1f} сообщ/с"
+            )
+        elapsed = time.perf_counter() - start
+        self.progress["rate"] = round((self.progress["sent"] - sent_before) / elapsed, 2) if elapsed else 0.0
+        return self.progress
+
+def create_sender(platform: str, api_url: str | None = None):
+    if platform == "vk":
+        return VKSender(settings.VK_TOKEN, api_url or settings.VK_API_BASE_URL, settings.VK_API_VERSION)
+    return TelegramSender(settings.BOT_TOKEN, api_url or settings.TG_API_BASE_URL)
+
+async def run(args) -> dict:
+    sender = create_sender(args.platform, args.api_url)
+    if args.platform == "vk":
+        limiter = RateLimiter(settings.VK_BROADCAST_RATE, settings.VK_PER_CHAT_INTERVAL)
+    else:
+        limiter = RateLimiter(settings.TG_BROADCAST_RATE, settings.TG_PER_CHAT_INTERVAL)
+    broadcast = Broadcast(
+        sender,
+        limiter,
+        args.text,
+        subject=args.subject,
+        include_unknown_platform=args.include_unknown_platform,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_retries=settings.BROADCAST_MAX_RETRIES,
+        checkpoint_path=args.checkpoint,
+    )
+    try:
+        return await broadcast.run()
+    finally:
+        await sender.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Рассылка сообщения зарегистрированным ученикам")
+    parser.add_argument("--platform", choices=["tg", "vk"], required=True)
+    parser.add_argument("--text", required=True)
+    parser.add_argument("--subject", help="Только ученикам с баллами по предмету")
+    parser.add_argument(
+        "--include-unknown-platform",
+        action="store_true",
+        help="Слать и юзерам без отметки платформы (до миграции 007, из импорта): их id может быть "
+        "id другой платформы и совпасть с посторонним чатом",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="",
+        help="Файл прогресса для продолжения после остановки; пишется после каждой пачки, "
+        "при обрыве посреди пачки ее юзеры получат сообщение повторно",
+    )
+    parser.add_argument("--batch-size", type=int, default=settings.BROADCAST_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--api-url", help="Базовый URL Bot API / VK API (например, локальный фейковый сервер)")
+    args = parser.parse_args()
+
+    progress = asyncio.run(run(args))
+    logger.info(f"Рассылка завершена: {progress}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import codecs
+import json
+from collections.abc import AsyncIterable, AsyncIterator
+
+# Потоковый разбор тела запроса для массовой загрузки: в памяти держим только
+# текущий кусок входных данных, а не весь JSON целиком.
+
+# Верхняя граница размера одного элемента: дальше считаем JSON битым, а не недокачанным
+MAX_ITEM_SIZE = 64 * 1024
+
+class BulkParseError(ValueError):
+    pass
+
+async def _iter_text(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+async def iter_ndjson(chunks: AsyncIterable[bytes]) -> AsyncIterator[object]:
+    # Некорректная строка не прерывает загрузку: отдаем исключение как элемент
+    buffer = ""
+    async for text in _iter_text(chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                yield _loads_line(line)
+    if buffer.strip():
+        yield _loads_line(buffer)
+
+def _loads_line(line: str) -> object:
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return BulkParseError(f"Некорректная строка NDJSON: {e}")
+
+async def iter_json_array(chunks: AsyncIterable[bytes]) -> AsyncIterator[object]:
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = finished = False
+    expect_value = empty = True
+    async for text in _iter_text(chunks):
+        buffer += text
+        pos = 0
+        while not finished:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise BulkParseError("Ожидался JSON-массив")
+                started = True
+                pos += 1
+            elif char == "]" and (not expect_value or empty):
+                finished = True
+                pos += 1
+            elif char == "," and not expect_value:
+                expect_value = True
+                pos += 1
+            elif expect_value:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    # Элемент пришел не полностью — ждем следующий кусок
+                    if len(buffer) - pos > MAX_ITEM_SIZE:
+                        raise BulkParseError(f"Некорректный элемент JSON-массива: {e}") from e
+                    break
+                if end == len(buffer) and char not in "{[\"":
+                    # Число или литерал на границе куска может быть обрезан
+                    break
+                yield item
+                pos = end
+                expect_value = empty = False
+            else:
+                raise BulkParseError(f"Неожиданный символ {char!r} в JSON-массиве")
+        buffer = buffer[pos:]
+        if finished and buffer.strip():
+            raise BulkParseError("Лишние данные после JSON-массива")
+    if not finished:
+        raise BulkParseError("JSON-массив не завершен")
+
+async def chunked(items: AsyncIterable[object], size: int) -> AsyncIterator[list[object]]:
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,201 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Protocol
+
+from app.config import settings
+from app.logger import setup_logger
+
+logger = setup_logger("cache")
+
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> bytes | None: ...
+
+    async def set(self, key: str, value: bytes) -> None: ...
+
+    async def delete(self, *keys: str) -> None: ...
+
+    async def clear(self) -> None: ...
+
+    def stats(self) -> dict: ...
+
+class MemoryCache:
+    # Кэш внутри процесса: LRU по числу записей + TTL на каждую запись
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class RedisCache:
+    # Общий для всех воркеров API кэш. Ограничение по числу записей задается
+    # на стороне Redis (maxmemory + allkeys-lru), TTL ставится на каждый ключ.
+
+    def __init__(self, url: str, ttl: float = 60.0, prefix: str = "ege:cache:"):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("Для CACHE_BACKEND=redis нужен пакет redis (pip install redis)") from e
+        self._redis = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = self.misses = 0
+
+    async def get(self, key: str) -> bytes | None:
+        value = await self._redis.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes) -> None:
+        await self._redis.set(self.prefix + key, value, px=int(self.ttl * 1000))
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self._redis.delete(*(self.prefix + key for key in keys))
+
+    async def clear(self) -> None:
+        keys = [key async for key in self._redis.scan_iter(match=self.prefix + "*")]
+        if keys:
+            await self._redis.delete(*keys)
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+class NullCache:
+    def __init__(self):
+        self.misses = 0
+
+    async def get(self, key: str) -> bytes | None:
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: bytes) -> None:
+        pass
+
+    async def delete(self, *keys: str) -> None:
+        pass
+
+    async def clear(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "none", "hits": 0, "misses": self.misses}
+
+class UserIdCache:
+    # Identity map telegram_id -> users.id: связь не меняется после создания юзера,
+    # поэтому положительные записи живут до вытеснения по LRU. Отсутствующих юзеров
+    # запоминаем ненадолго, чтобы незарегистрированные не ходили в БД на каждое сообщение.
+
+    def __init__(self, max_entries: int = 100000, negative_ttl: float = 5.0):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._ids: OrderedDict[int, int] = OrderedDict()
+        self._missing: OrderedDict[int, float] = OrderedDict()
+        self.hits = self.misses = self.negative_hits = 0
+
+    def get(self, telegram_id: int) -> int | None:
+        user_id = self._ids.get(telegram_id)
+        if user_id is None:
+            self.misses += 1
+            return None
+        self._ids.move_to_end(telegram_id)
+        self.hits += 1
+        return user_id
+
+    def is_missing(self, telegram_id: int) -> bool:
+        expires_at = self._missing.get(telegram_id)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._missing[telegram_id]
+            return False
+        self.negative_hits += 1
+        return True
+
+    def add(self, telegram_id: int, user_id: int) -> None:
+        self._missing.pop(telegram_id, None)
+        self._ids[telegram_id] = user_id
+        self._ids.move_to_end(telegram_id)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+
+    def add_missing(self, telegram_id: int) -> None:
+        if self.negative_ttl <= 0:
+            return
+        self._missing[telegram_id] = time.monotonic() + self.negative_ttl
+        self._missing.move_to_end(telegram_id)
+        while len(self._missing) > self.max_entries:
+            self._missing.popitem(last=False)
+
+    def clear(self) -> None:
+        self._ids.clear()
+        self._missing.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._ids),
+            "negative_entries": len(self._missing),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+        }
+
+def create_cache() -> CacheBackend:
+    if settings.CACHE_BACKEND == "redis":
+        logger.info("Кэш баллов: Redis")
+        return RedisCache(settings.CACHE_REDIS_URL, ttl=settings.CACHE_TTL)
+    if settings.CACHE_BACKEND == "none":
+        return NullCache()
+    return MemoryCache(max_entries=settings.CACHE_MAX_ENTRIES, ttl=settings.CACHE_TTL)
+
+def scores_key(telegram_id: int) -> str:
+    return f"scores:{telegram_id}"
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+scores_cache = create_cache()
+user_id_cache = UserIdCache(max_entries=settings.USER_ID_CACHE_SIZE, negative_ttl=settings.USER_ID_NEGATIVE_TTL)
@@ -1,5 +1,11 @@
+from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+# Предел параметров в одном запросе (Postgres/asyncpg — 32767, SQLite >= 3.32 — 32766)
+MAX_BIND_PARAMS = 32766
+# Параметров на строку в multi-row upsert баллов: user_id, subject_id, score
+SCORE_ROW_PARAMS = 3
+
 
 class Settings(BaseSettings):
     BOT_TOKEN: str
@@ -10,6 +16,155 @@ class Settings(BaseSettings):
     DB_HOST: str
     DB_PORT: int
     API_BASE_URL: str = "http://localhost:8000"
+    # Как боты работают с баллами: http (через API) или embedded (crud напрямую)
+    BOT_BACKEND: str = "http"
+
+    # Справочник предметов: дополнительные алиасы ("матеша=Математика,рус=Русский язык")
+    # и можно ли заводить новый предмет по первому баллу (иначе неизвестный предмет — 422)
+    SUBJECT_ALIASES: str = ""
+    SUBJECTS_AUTO_CREATE: bool = True
+
+    # Пул соединений ботов к API
+    API_MAX_CONNECTIONS: int = 100
+    API_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    API_KEEPALIVE_EXPIRY: float = 30.0
+    API_TIMEOUT: float = 10.0
+    API_CONNECT_TIMEOUT: float = 3.0
+    API_RETRIES: int = 3
+    API_RETRY_BACKOFF: float = 0.1
+    API_RETRY_BACKOFF_MAX: float = 2.0
+    # Через сколько секунд без ответа дублировать запись с тем же Idempotency-Key (0 — не дублировать)
+    API_HEDGE_DELAY: float = 0.0
+    API_WARMUP_CONNECTIONS: int = 4
+
+    # Размер чанка массовой загрузки баллов (одна транзакция на чанк) и сколько
+    # поэлементных ошибок возвращать в отчете (остальные только считаются)
+    BULK_CHUNK_SIZE: int = 1000
+    BULK_MAX_ERRORS: int = 100
+
+    # Склейка конкурентных POST /scores/ в пачки: сколько секунд ждать попутчиков,
+    # предельный размер пачки и сколько пачек пишется в БД одновременно
+    SCORE_WRITE_COMBINING: bool = False
+    SCORE_WRITE_WINDOW: float = 0.005
+    SCORE_WRITE_MAX_BATCH: int = 500
+    SCORE_WRITE_FLUSH_CONCURRENCY: int = 4
+
+    # Пачка офлайн-импорта из CSV (python -m app.importer), одна транзакция на пачку
+    IMPORT_BATCH_SIZE: int = 10000
+
+    # Размер пачки серверного курсора при выгрузке /export/scores
+    EXPORT_BATCH_SIZE: int = 1000
+
+    # Idempotency-Key на POST /users/ и /scores/: memory (в процессе), sql (общий для
+    # воркеров, таблица idempotency_keys) или none. IDEMPOTENCY_TTL — сколько секунд
+    # помнить ответ, IDEMPOTENCY_WAIT_TIMEOUT — сколько дубль ждет ответа запроса,
+    # выполняемого другим воркером, IDEMPOTENCY_LOCK_TIMEOUT — через сколько секунд
+    # незавершенный запрос считается брошенным
+    IDEMPOTENCY_BACKEND: str = "memory"
+    IDEMPOTENCY_MAX_ENTRIES: int = 100000
+    IDEMPOTENCY_TTL: float = 3600.0
+    IDEMPOTENCY_WAIT_TIMEOUT: float = 10.0
+    IDEMPOTENCY_LOCK_TIMEOUT: float = 30.0
+    IDEMPOTENCY_PURGE_INTERVAL: float = 600.0
+
+    # Кэш GET /scores/{telegram_id}: memory (в процессе), redis (общий для воркеров) или none
+    CACHE_BACKEND: str = "memory"
+    CACHE_MAX_ENTRIES: int = 10000
+    CACHE_TTL: float = 60.0
+    CACHE_REDIS_URL: str = "redis://localhost:6379/0"
+
+    # Identity map telegram_id -> users.id в crud
+    USER_ID_CACHE_SIZE: int = 100000
+    USER_ID_NEGATIVE_TTL: float = 5.0
+
+    # Логирование: общий уровень, уровни по модулям ("crud=WARNING,bot_tg=INFO"),
+    # JSON-формат, размер очереди и доля пишущихся INFO-строк на каждое сообщение
+    LOG_LEVEL: str = "INFO"
+    LOG_LEVELS: str = ""
+    LOG_JSON: bool = False
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_SAMPLE_RATE: float = 1.0
+    DB_ECHO: bool = False
+
+    # Пул соединений с БД
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_PRE_PING: bool = False
+    DB_POOL_RECYCLE: int = 1800
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_WARMUP_CONNECTIONS: int = 5
+
+    # Реплики для чтения: URL через запятую (пусто — все чтения из основной БД).
+    # DB_READ_YOUR_WRITES_WINDOW — сколько секунд после записи юзера его чтения идут
+    # в основную БД, должно быть больше лага реплик
+    DB_REPLICA_URLS: str = ""
+    DB_REPLICA_HEALTH_INTERVAL: float = 5.0
+    DB_REPLICA_HEALTH_TIMEOUT: float = 2.0
+    DB_READ_YOUR_WRITES_WINDOW: float = 5.0
+
+    # Порт HTTP-сервера с /metrics в процессах ботов (0 — выключен)
+    BOT_METRICS_PORT: int = 0
+
+    # Режим Telegram-бота: polling или webhook (для webhook обязателен TG_WEBHOOK_SECRET)
+    TG_MODE: str = "polling"
+    TG_WEBHOOK_URL: str = ""
+    TG_WEBHOOK_PATH: str = "/tg/webhook"
+    TG_WEBHOOK_SECRET: str = ""
+    TG_WEBHOOK_HOST: str = "0.0.0.0"
+    TG_WEBHOOK_PORT: int = 8080
+    TG_UPDATE_QUEUE_SIZE: int = 1000
+    TG_UPDATE_WORKERS: int = 8
+    TG_ENQUEUE_TIMEOUT: float = 1.0
+
+    # Диспетчер апдейтов ботов: апдейты одного юзера по очереди, разных — параллельно.
+    # BOT_MAX_IN_FLIGHT — одновременно работающих обработчиков, BOT_MAX_PENDING — принятых
+    # и не обработанных апдейтов (дальше прием ждет), BOT_DEDUP_WINDOW — сколько последних
+    # id апдейтов помнить для отсева повторной доставки
+    BOT_ORDERED_DISPATCH: bool = True
+    BOT_MAX_IN_FLIGHT: int = 64
+    BOT_MAX_PENDING: int = 10000
+    BOT_DISPATCH_SHARDS: int = 16
+    BOT_DEDUP_WINDOW: int = 10000
+
+    # FSM Telegram-бота: sql (в общей БД, можно запускать несколько процессов) или memory.
+    # FSM_CACHE_TTL — сколько секунд доверять кэшу между апдейтами: запись в кэш сквозная, апдейты
+    # чата идут по порядку, поэтому в одном процессе кэш не отстает от БД (0 — только внутри
+    # апдейта, если апдейты одного чата могут попасть в разные процессы),
+    # FSM_STATE_TTL — через сколько секунд без действий диалог считается брошенным
+    FSM_STORAGE: str = "sql"
+    FSM_CACHE_SIZE: int = 10000
+    FSM_CACHE_TTL: float = 5.0
+    FSM_STATE_TTL: float = 86400.0
+    FSM_PURGE_INTERVAL: float = 600.0
+
+    # Диалоги VK-бота: лимит записей, TTL брошенного диалога и файл снимка
+    # для переживания рестартов (пусто — без сохранения)
+    VK_STATE_MAX_ENTRIES: int = 100000
+    VK_STATE_TTL: float = 3600.0
+    VK_STATE_FILE: str = ""
+    VK_STATE_SNAPSHOT_INTERVAL: float = 60.0
+
+    # Рассылки: пачка юзеров из курсора, общий лимит платформы (сообщ/с),
+    # минимальный интервал между сообщениями в один чат и повторы при flood wait
+    BROADCAST_BATCH_SIZE: int = 500
+    BROADCAST_MAX_RETRIES: int = 5
+    TG_API_BASE_URL: str = "https://api.telegram.org"
+    TG_BROADCAST_RATE: float = 25.0
+    TG_PER_CHAT_INTERVAL: float = 1.0
+    VK_API_BASE_URL: str = "https://api.vk.com/method"
+    VK_API_VERSION: str = "5.199"
+    VK_BROADCAST_RATE: float = 20.0
+    VK_PER_CHAT_INTERVAL: float = 1.0
+
+    @field_validator("BULK_CHUNK_SIZE")
+    @classmethod
+    def _check_bulk_chunk_size(cls, value: int) -> int:
+        # Чанк уходит одним INSERT ... VALUES: все строки должны влезть в лимит параметров
+        limit = MAX_BIND_PARAMS // SCORE_ROW_PARAMS
+        if not 1 <= value <= limit:
+            raise ValueError(f"BULK_CHUNK_SIZE должен быть от 1 до {limit}")
+        return value
 
     @property
     def DATABASE_URL(self):
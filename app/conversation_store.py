@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Any
+
+from vkbottle import ABCStateDispenser, BaseStateGroup
+from vkbottle.dispatch.dispenser.base import StatePeer, StateRepresentation, get_state_repr
+
+from app.logger import setup_logger
+
+logger = setup_logger("conversation_store")
+
+class _Conversation:
+    # Состояние и данные диалога одной записью
+    __slots__ = ("expires_at", "payload", "state")
+
+    def __init__(self, state: str, payload: dict, expires_at: float):
+        self.state = state
+        self.payload = payload
+        self.expires_at = expires_at
+
+class ConversationStore(ABCStateDispenser):
+    # Хранилище диалогов VK-бота вместо BuiltinStateDispenser + CtxStorage: ограничено
+    # по числу записей и по TTL, запись удаляется при завершении диалога.
+    # Записи упорядочены по последнему изменению, а TTL у всех одинаковый, поэтому
+    # самые старые (и первыми истекающие) всегда в начале OrderedDict.
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 3600.0, path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._data: OrderedDict[int, _Conversation] = OrderedDict()
+        self._snapshot_task: asyncio.Task | None = None
+        self.expired = self.evicted = 0
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._data:
+            peer_id, conversation = next(iter(self._data.items()))
+            if conversation.expires_at < now:
+                self.expired += 1
+            elif len(self._data) > self.max_entries:
+                self.evicted += 1
+            else:
+                break
+            del self._data[peer_id]
+
+    async def get(self, peer_id: int) -> StatePeer | None:
+        conversation = self._data.get(peer_id)
+        if conversation is None:
+            return None
+        if conversation.expires_at < time.monotonic():
+            del self._data[peer_id]
+            self.expired += 1
+            return None
+        return StatePeer(peer_id=peer_id, state=StateRepresentation(conversation.state), payload=conversation.payload)
+
+    async def set(self, peer_id: int, state: BaseStateGroup, **payload: Any):
+        self._data[peer_id] = _Conversation(get_state_repr(state), payload, time.monotonic() + self.ttl)
+        self._data.move_to_end(peer_id)
+        self._evict()
+
+    async def delete(self, peer_id: int):
+        self._data.pop(peer_id, None)
+
+    def memory_bytes(self) -> int:
+        # Оценка памяти под записи (без учета самого OrderedDict), считается при отдаче метрик
+        total = sys.getsizeof(self._data)
+        for conversation in self._data.values():
+            total += sys.getsizeof(conversation) + sys.getsizeof(conversation.state)
+            total += sys.getsizeof(conversation.payload) + sum(
+                sys.getsizeof(k) + sys.getsizeof(v) for k, v in conversation.payload.items()
+            )
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+    def save(self):
+        # Снимок незавершенных диалогов в файл: TTL храним как оставшееся время
+        if not self.path:
+            return
+        self._evict()
+        now = time.monotonic()
+        snapshot = [[peer_id, c.state, c.payload, c.expires_at - now] for peer_id, c in self._data.items()]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"ВК Бот: Не удалось прочитать снимок диалогов {self.path}: {e}")
+            return
+        now = time.monotonic()
+        for peer_id, state, payload, remaining in snapshot:
+            if remaining > 0:
+                self._data[peer_id] = _Conversation(state, payload, now + remaining)
+        self._evict()
+        logger.info(f"ВК Бот: Восстановлено {len(self._data)} незавершенных диалогов")
+
+    async def _snapshot_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.save()
+            except OSError as e:
+                logger.error(f"ВК Бот: Не удалось сохранить снимок диалогов: {e}")
+
+    async def start(self, snapshot_interval: float = 60.0):
+        self.load()
+        if self.path and snapshot_interval > 0:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop(snapshot_interval))
+
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            await asyncio.gather(self._snapshot_task, return_exceptions=True)
+            self._snapshot_task = None
+        self.save()
@@ -1,12 +1,78 @@
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import UTC, datetime
 
+from sqlalchemy import func, literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from app.cache import scores_cache, scores_key, user_id_cache
+from app.config import settings
+from app.database import dialect_insert
 from app.logger import setup_logger
-from app.models import Score, User
+from app.metrics import histogram, timed
+from app.models import Score, ScoreHistory, Subject, SubjectScoreCount, User
 from app.schemas import ScoreCreate, UserCreate
+from app.stats import rank_of, summarize, top_cutoff
+from app.subjects import clean, subject_cache
 
 logger = setup_logger("crud")
 
+crud_latency = histogram("crud_duration_seconds", "Время выполнения функций crud", ("function",))
+
+class UnknownSubjectError(ValueError):
+    pass
+
+def utcnow() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+async def load_subjects(db: AsyncSession):
+    result = await db.execute(select(Subject.id, Subject.key, Subject.name))
+    for subject_id, key, name in result.all():
+        subject_cache.add(subject_id, key, name)
+
+async def resolve_subject_ids(
+    db: AsyncSession, names: list[str], create: bool | None = None
+) -> dict[str, int]:
+    # Имена предметов -> subject_id. Обычно все берется из кэша без запросов; при промахе
+    # перечитываем справочник (предмет мог завести другой воркер), а с create=True
+    # заводим недостающие и сразу коммитим, чтобы id в кэше не пропал при откате
+    if create is None:
+        create = settings.SUBJECTS_AUTO_CREATE
+    resolved = {}
+    missing = []
+    for name in names:
+        subject_id = subject_cache.get_id(name)
+        if subject_id is None:
+            missing.append(name)
+        else:
+            resolved[name] = subject_id
+    if not missing:
+        return resolved
+
+    await load_subjects(db)
+    if create:
+        new = {}
+        for name in missing:
+            key = subject_cache.key(name)
+            if key and subject_cache.get_id(name) is None:
+                new.setdefault(key, {"key": key, "name": clean(name)})
+        if new:
+            insert = dialect_insert(db)
+            stmt = insert(Subject).values(list(new.values()))
+            await db.execute(stmt.on_conflict_do_nothing(index_elements=[Subject.key]))
+            await db.commit()
+            await load_subjects(db)
+            logger.info(f"Добавлены предметы: {', '.join(item['name'] for item in new.values())}")
+
+    for name in missing:
+        subject_id = subject_cache.get_id(name)
+        if subject_id is not None:
+            resolved[name] = subject_id
+    return resolved
+
+async def _ensure_subject_names(db: AsyncSession, subject_ids):
+    if any(subject_cache.get_name(subject_id) is None for subject_id in subject_ids):
+        await load_subjects(db)
+
+@timed(crud_latency, "create_user")
 async def create_user(db: AsyncSession, user_in: UserCreate):
 
     logger.info(f"Запрос на создание пользователя: {user_in.telegram_id}")
@@ -16,6 +82,11 @@ async def create_user(db: AsyncSession, user_in: UserCreate):
 
     if existing_user:
         logger.info(f"Пользователь {user_in.telegram_id} уже существует")
+        if existing_user.platform is None and user_in.platform is not None:
+            # Старые юзеры получают отметку платформы при повторной регистрации
+            existing_user.platform = user_in.platform
+            await db.commit()
+        user_id_cache.add(existing_user.telegram_id, existing_user.id)
         return existing_user
 
     new_user = User(**user_in.model_dump())
@@ -23,6 +94,8 @@ async def create_user(db: AsyncSession, user_in: UserCreate):
     try:
         await db.commit()
         await db.refresh(new_user)
+        user_id_cache.add(new_user.telegram_id, new_user.id)
+        await scores_cache.delete(scores_key(new_user.telegram_id))
         logger.info(f"Создан новый пользователь: ID {new_user.id} (TG: {user_in.telegram_id})")
         return new_user
     except Exception as e:
@@ -30,45 +103,375 @@ async def create_user(db: AsyncSession, user_in: UserCreate):
         await db.rollback()
         raise
 
+# Инкрементальные гистограммы subject_score_counts. Общие для всех путей записи
+# баллов: crud и офлайн-импорта (app.importer)
+def add_histogram_delta(deltas: dict, subject_id: int, score: int, previous_score: int | None):
+    if previous_score == score:
+        return
+    deltas[(subject_id, score)] = deltas.get((subject_id, score), 0) + 1
+    if previous_score is not None:
+        deltas[(subject_id, previous_score)] = deltas.get((subject_id, previous_score), 0) - 1
+
+async def apply_histogram_deltas(db: AsyncSession | AsyncConnection, deltas: dict):
+    # Все изменения гистограмм одним upsert; строки идут в порядке ключа, чтобы
+    # параллельные транзакции брали блокировки в одном порядке и не ловили deadlock
+    rows = [
+        {"subject_id": subject_id, "score": score, "count": delta}
+        for (subject_id, score), delta in sorted(deltas.items())
+        if delta
+    ]
+    if not rows:
+        return
+    insert = dialect_insert(db)
+    stmt = insert(SubjectScoreCount.__table__).values(rows)
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[SubjectScoreCount.subject_id, SubjectScoreCount.score],
+            set_={"count": SubjectScoreCount.count + stmt.excluded.count},
+        )
+    )
+
+@timed(crud_latency, "add_or_update_score")
 async def add_or_update_score(db: AsyncSession, score_in: ScoreCreate):
     logger.info(f"Добавление/обновление баллов для {score_in.telegram_id}: {score_in.subject} = {score_in.score}")
 
-    # Поиск юзера по telegram_id
-    result = await db.execute(select(User).where(User.telegram_id == score_in.telegram_id))
-    user = result.scalar_one_or_none()
+    if user_id_cache.is_missing(score_in.telegram_id):
+        logger.warning(f"Юзер {score_in.telegram_id} не найден (кэш). Невозможно добавить баллы.")
+        return None
+
+    subject_id = (await resolve_subject_ids(db, [score_in.subject])).get(score_in.subject)
+    if subject_id is None:
+        raise UnknownSubjectError(score_in.subject)
 
-    if not user:
+    # Upsert балла одним запросом: INSERT ... ON CONFLICT (user_id, subject_id) DO UPDATE ... RETURNING.
+    # Если users.id уже известен из кэша — вставляем его напрямую, иначе ищем юзера
+    # в том же запросе через INSERT ... SELECT users.id
+    insert = dialect_insert(db)
+    user_id = user_id_cache.get(score_in.telegram_id)
+    if user_id is not None:
+        stmt = insert(Score).values(user_id=user_id, subject_id=subject_id, score=score_in.score)
+    else:
+        source = select(
+            User.id,
+            literal(subject_id, Score.subject_id.type),
+            literal(score_in.score, Score.score.type),
+        ).where(User.telegram_id == score_in.telegram_id)
+        stmt = insert(Score).from_select(["user_id", "subject_id", "score"], source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Score.user_id, Score.subject_id],
+        set_={"score": stmt.excluded.score, "previous_score": Score.score},
+    ).returning(Score)
+
+    result = await db.execute(stmt, execution_options={"populate_existing": True})
+    score = result.scalar_one_or_none()
+
+    if not score:
         logger.warning(f"Юзер {score_in.telegram_id} не найден. Невозможно добавить баллы.")
+        user_id_cache.add_missing(score_in.telegram_id)
+        await db.rollback()
         return None
 
-    # Поиск балла по предмету
-    result = await db.execute(
-        select(Score).where(Score.user_id == user.id, Score.subject == score_in.subject)
+    # Попытка в историю — в той же транзакции, что и последний балл в scores
+    await db.execute(
+        insert(ScoreHistory).values(
+            user_id=score.user_id, subject_id=score.subject_id, score=score.score, created_at=utcnow()
+        )
     )
-    existing_score = result.scalar_one_or_none()
+    # previous_score пуст для новой строки и равен старому баллу при обновлении
+    deltas = {}
+    add_histogram_delta(deltas, score.subject_id, score.score, score.previous_score)
+    await apply_histogram_deltas(db, deltas)
+    await db.commit()
+    user_id_cache.add(score_in.telegram_id, score.user_id)
+    await scores_cache.delete(scores_key(score_in.telegram_id))
+    logger.info(f"Сохранен балл для юзера {score.user_id} по предмету {score.subject}")
+    return score
 
-    if existing_score:
-        logger.info(f"Обновляем существующий балл для юзера {user.id} по предмету {score_in.subject}")
-        existing_score.score = score_in.score
-        await db.commit()
-        return existing_score
-    else:
-        logger.info(f"Создаем новую запись балла для юзера {user.id} по предмету {score_in.subject}")
-        new_score = Score(user_id=user.id, subject=score_in.subject, score=score_in.score)
-        db.add(new_score)
-        await db.commit()
-        await db.refresh(new_score)
-        return new_score
+@timed(crud_latency, "bulk_upsert_scores")
+async def bulk_upsert_scores(db: AsyncSession, items: list[ScoreCreate]) -> set[int]:
+    # Массовый upsert одного чанка в одной транзакции; возвращает неизвестные telegram_id
+    telegram_ids = {item.telegram_id for item in items}
+    user_ids = {}
+    unknown = []
+    for telegram_id in telegram_ids:
+        user_id = user_id_cache.get(telegram_id)
+        if user_id is not None:
+            user_ids[telegram_id] = user_id
+        elif not user_id_cache.is_missing(telegram_id):
+            unknown.append(telegram_id)
 
+    if unknown:
+        result = await db.execute(select(User.telegram_id, User.id).where(User.telegram_id.in_(unknown)))
+        for telegram_id, user_id in result.all():
+            user_ids[telegram_id] = user_id
+            user_id_cache.add(telegram_id, user_id)
+
+    # Неизвестные предметы (если их нельзя заводить) пропускаем — API отсеивает их заранее
+    subject_ids = await resolve_subject_ids(db, list({item.subject for item in items}))
+
+    # Дубликаты (user_id, subject_id) внутри чанка схлопываем: побеждает последняя запись,
+    # иначе Postgres откажется обновлять одну строку дважды в одном INSERT. В историю
+    # попадают все попытки по порядку
+    rows = {}
+    history = []
+    now = utcnow()
+    for item in items:
+        user_id = user_ids.get(item.telegram_id)
+        subject_id = subject_ids.get(item.subject)
+        if user_id is not None and subject_id is not None:
+            rows[(user_id, subject_id)] = {"user_id": user_id, "subject_id": subject_id, "score": item.score}
+            history.append({"user_id": user_id, "subject_id": subject_id, "score": item.score, "created_at": now})
+
+    if rows:
+        insert = dialect_insert(db)
+        stmt = insert(Score.__table__).values(list(rows.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Score.user_id, Score.subject_id],
+            set_={"score": stmt.excluded.score, "previous_score": Score.score},
+        ).returning(Score.subject_id, Score.score, Score.previous_score)
+        deltas = {}
+        for subject_id, score, previous_score in (await db.execute(stmt)).all():
+            add_histogram_delta(deltas, subject_id, score, previous_score)
+        await db.execute(insert(ScoreHistory.__table__), history)
+        await apply_histogram_deltas(db, deltas)
+    await db.commit()
+    await scores_cache.delete(*(scores_key(telegram_id) for telegram_id in user_ids))
+
+    not_found = telegram_ids - user_ids.keys()
+    for telegram_id in not_found:
+        user_id_cache.add_missing(telegram_id)
+    logger.info(f"Массовая загрузка: сохранено {len(rows)} баллов, неизвестных юзеров {len(not_found)}")
+    return not_found
+
+@timed(crud_latency, "get_user_scores")
 async def get_user_scores(db: AsyncSession, telegram_id: int):
     logger.info(f"Запрос списка всех баллов для TG ID: {telegram_id}")
 
-    # Получаем юзера и подгружаем его баллы
+    if user_id_cache.is_missing(telegram_id):
+        return []
+
+    user_id = user_id_cache.get(telegram_id)
+    if user_id is not None:
+        result = await db.execute(select(Score).where(Score.user_id == user_id))
+        scores = result.scalars().all()
+    else:
+        # Получаем юзера и его баллы одним запросом; outer join, чтобы отличить
+        # юзера без баллов от незарегистрированного и заполнить кэш
+        result = await db.execute(
+            select(User.id, Score)
+            .outerjoin(Score, Score.user_id == User.id)
+            .where(User.telegram_id == telegram_id)
+        )
+        rows = result.all()
+        if rows:
+            user_id_cache.add(telegram_id, rows[0][0])
+        elif not db.info.get("replica"):
+            user_id_cache.add_missing(telegram_id)
+        scores = [score for _, score in rows if score is not None]
+    await _ensure_subject_names(db, [score.subject_id for score in scores])
+    logger.info(f"Найдено предметов для {telegram_id}: {len(scores)}")
+    return scores
+
+@timed(crud_latency, "get_user_score_rows")
+async def get_user_score_rows(db: AsyncSession, telegram_id: int) -> list[tuple[str, int]]:
+    # То же, что get_user_scores, но без ORM: только (subject_id, score) Core-кортежами,
+    # имя предмета — из справочника в памяти. Для ответов API, где объекты Score не нужны
+    if user_id_cache.is_missing(telegram_id):
+        return []
+
+    user_id = user_id_cache.get(telegram_id)
+    if user_id is not None:
+        result = await db.execute(select(Score.subject_id, Score.score).where(Score.user_id == user_id))
+        rows = result.all()
+    else:
+        result = await db.execute(
+            select(User.id, Score.subject_id, Score.score)
+            .outerjoin(Score, Score.user_id == User.id)
+            .where(User.telegram_id == telegram_id)
+        )
+        joined = result.all()
+        if joined:
+            user_id_cache.add(telegram_id, joined[0][0])
+        elif not db.info.get("replica"):
+            # Юзера может не быть на реплике из-за лага репликации — такое не кэшируем
+            user_id_cache.add_missing(telegram_id)
+        rows = [(subject_id, score) for _, subject_id, score in joined if subject_id is not None]
+    await _ensure_subject_names(db, [subject_id for subject_id, _ in rows])
+    return [(subject_cache.get_name(subject_id), score) for subject_id, score in rows]
+
+async def _get_histograms(db: AsyncSession, subject_ids: list[int]) -> dict[int, list[tuple[int, int]]]:
+    result = await db.execute(
+        select(SubjectScoreCount.subject_id, SubjectScoreCount.score, SubjectScoreCount.count)
+        .where(SubjectScoreCount.subject_id.in_(subject_ids), SubjectScoreCount.count > 0)
+        .order_by(SubjectScoreCount.subject_id, SubjectScoreCount.score)
+    )
+    histograms = {subject_id: [] for subject_id in subject_ids}
+    for subject_id, score, count in result.all():
+        histograms[subject_id].append((score, count))
+    return histograms
+
+@timed(crud_latency, "get_subject_stats")
+async def get_subject_stats(db: AsyncSession, subject: str) -> dict | None:
+    subject_id = (await resolve_subject_ids(db, [subject], create=False)).get(subject)
+    if subject_id is None:
+        return None
+    counts = (await _get_histograms(db, [subject_id]))[subject_id]
+    summary = summarize(counts)
+    return {"subject": subject_cache.get_name(subject_id), **summary} if summary else None
+
+@timed(crud_latency, "get_user_stats")
+async def get_user_stats(db: AsyncSession, telegram_id: int) -> list[dict]:
+    # Место ученика и сводка по каждому его предмету: баллы юзера + гистограммы, два запроса
     result = await db.execute(
-        select(Score)
-        .join(User)
+        select(Score.subject_id, Score.score)
+        .join(User, User.id == Score.user_id)
         .where(User.telegram_id == telegram_id)
+        .order_by(Score.subject_id)
     )
-    scores = result.scalars().all()
-    logger.info(f"Найдено предметов для {telegram_id}: {len(scores)}")
-    return scores
+    scores = result.all()
+    if not scores:
+        return []
+    await _ensure_subject_names(db, [subject_id for subject_id, _ in scores])
+    histograms = await _get_histograms(db, [subject_id for subject_id, _ in scores])
+    stats = []
+    for subject_id, score in scores:
+        summary = summarize(histograms[subject_id])
+        if summary is None:
+            continue
+        rank, total = rank_of(histograms[subject_id], score)
+        stats.append(
+            {
+                "subject": subject_cache.get_name(subject_id),
+                "score": score,
+                "rank": rank,
+                "total": total,
+                "mean": summary["mean"],
+                "median": summary["percentiles"]["p50"],
+            }
+        )
+    return stats
+
+def _user_id_clause(telegram_id: int):
+    # users.id из кэша или подзапросом по уникальному индексу telegram_id
+    user_id = user_id_cache.get(telegram_id)
+    if user_id is not None:
+        return ScoreHistory.user_id == user_id
+    return ScoreHistory.user_id == select(User.id).where(User.telegram_id == telegram_id).scalar_subquery()
+
+def history_cursor(created_at: datetime, history_id: int) -> str:
+    return f"{created_at.isoformat()}_{history_id}"
+
+def parse_history_cursor(cursor: str) -> tuple[datetime, int]:
+    # ValueError, если курсор не наш
+    created_at, _, history_id = cursor.rpartition("_")
+    return datetime.fromisoformat(created_at), int(history_id)
+
+@timed(crud_latency, "get_score_history")
+async def get_score_history(
+    db: AsyncSession,
+    telegram_id: int,
+    subject_id: int | None = None,
+    limit: int = 20,
+    before: tuple[datetime, int] | None = None,
+) -> list[tuple[int, str, int, datetime]]:
+    # Попытки юзера от новых к старым, (id, предмет, балл, время). Keyset-пагинация:
+    # следующая страница — строки строго раньше (created_at, id) последней строки
+    # предыдущей, это продолжение скана индекса, а не OFFSET
+    query = (
+        select(ScoreHistory.id, ScoreHistory.subject_id, ScoreHistory.score, ScoreHistory.created_at)
+        .where(_user_id_clause(telegram_id))
+        .order_by(ScoreHistory.created_at.desc(), ScoreHistory.id.desc())
+        .limit(limit)
+    )
+    if subject_id is not None:
+        query = query.where(ScoreHistory.subject_id == subject_id)
+    if before is not None:
+        query = query.where(tuple_(ScoreHistory.created_at, ScoreHistory.id) < tuple_(*before))
+    rows = (await db.execute(query)).all()
+    await _ensure_subject_names(db, [row.subject_id for row in rows])
+    return [
+        (history_id, subject_cache.get_name(subject_id), score, created_at)
+        for history_id, subject_id, score, created_at in rows
+    ]
+
+@timed(crud_latency, "get_score_trends")
+async def get_score_trends(db: AsyncSession, telegram_id: int, points: int = 5) -> list[tuple[str, list[int]]]:
+    # Последние points попыток по каждому предмету юзера, от старой к новой. Окно
+    # по (subject_id, created_at) идет по индексу ix_score_history_user_subject_time
+    ranked = (
+        select(
+            ScoreHistory.subject_id,
+            ScoreHistory.score,
+            ScoreHistory.created_at,
+            ScoreHistory.id,
+            func.row_number()
+            .over(
+                partition_by=ScoreHistory.subject_id,
+                order_by=(ScoreHistory.created_at.desc(), ScoreHistory.id.desc()),
+            )
+            .label("position"),
+        )
+        .where(_user_id_clause(telegram_id))
+        .subquery()
+    )
+    result = await db.execute(
+        select(ranked.c.subject_id, ranked.c.score)
+        .where(ranked.c.position <= points)
+        .order_by(ranked.c.subject_id, ranked.c.created_at, ranked.c.id)
+    )
+    trends: dict[int, list[int]] = {}
+    for subject_id, score in result.all():
+        trends.setdefault(subject_id, []).append(score)
+    await _ensure_subject_names(db, trends)
+    return [(subject_cache.get_name(subject_id), scores) for subject_id, scores in trends.items()]
+
+@timed(crud_latency, "get_leaderboard")
+async def get_leaderboard(db: AsyncSession, subject: str, limit: int) -> list[dict]:
+    # По гистограмме находим порог балла для top-N, дальше — диапазонный скан
+    # по индексу (subject_id, score), а не сортировка всех баллов предмета
+    subject_id = (await resolve_subject_ids(db, [subject], create=False)).get(subject)
+    if subject_id is None:
+        return []
+    counts = (await _get_histograms(db, [subject_id]))[subject_id]
+    cutoff = top_cutoff(counts, limit)
+    if cutoff is None:
+        return []
+    result = await db.execute(
+        select(User.first_name, User.last_name, Score.score)
+        .join(User, User.id == Score.user_id)
+        .where(Score.subject_id == subject_id, Score.score >= cutoff)
+        .order_by(Score.score.desc(), Score.id)
+        .limit(limit)
+    )
+    leaderboard = []
+    for first_name, last_name, score in result.all():
+        rank, _ = rank_of(counts, score)
+        leaderboard.append({"rank": rank, "first_name": first_name, "last_name": last_name, "score": score})
+    return leaderboard
+
+async def stream_scores(
+    db: AsyncSession,
+    subject_id: int | None = None,
+    min_score: int | None = None,
+    max_score: int | None = None,
+    batch_size: int = 1000,
+):
+    # Выгрузка всех баллов серверным курсором пачками по batch_size строк.
+    # Фильтры уходят в WHERE, порядок (user_id, subject_id) совпадает с уникальным
+    # индексом, так что сортировки на стороне БД нет
+    query = (
+        select(User.telegram_id, User.first_name, User.last_name, Subject.name, Score.score)
+        .join(User, User.id == Score.user_id)
+        .join(Subject, Subject.id == Score.subject_id)
+        .order_by(Score.user_id, Score.subject_id)
+    )
+    if subject_id is not None:
+        query = query.where(Score.subject_id == subject_id)
+    if min_score is not None:
+        query = query.where(Score.score >= min_score)
+    if max_score is not None:
+        query = query.where(Score.score <= max_score)
+
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    async for batch in result.partitions():
+        yield batch
@@ -1,9 +1,56 @@
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import asyncio
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import QueuePool
 
 from app.config import settings
+from app.logger import setup_logger
+from app.metrics import histogram
+
+# SQL-лог включается явно и идет через общую очередь логов, а не echo=True в stdout
+if settings.DB_ECHO:
+    setup_logger("sqlalchemy.engine")
+
+logger = setup_logger("database")
+
+def engine_options(url: str) -> dict:
+    # Настройки пула и кэша prepared statements asyncpg; для SQLite оставляем значения по умолчанию
+    if not url.startswith("postgresql"):
+        return {}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "connect_args": {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+    }
+
+db_statement_latency = histogram(
+    "db_statement_duration_seconds", "Время выполнения SQL-запросов", ("statement",)
+)
+
+# Время старта храним в контексте выполнения, а не в стеке на соединении: у упавшего
+# запроса after_cursor_execute не вызывается, и стек сдвигал бы замеры следующих
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True)
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "query_start", None)
+    if start is not None:
+        db_statement_latency.observe(time.perf_counter() - start, statement.lstrip().split(" ", 1)[0].upper())
+
+def instrument_engine(db_engine: AsyncEngine) -> AsyncEngine:
+    event.listen(db_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(db_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    return db_engine
+
+engine = instrument_engine(create_async_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL)))
 
 AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
@@ -13,3 +60,42 @@ class Base(DeclarativeBase):
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+def dialect_insert(db: AsyncSession | AsyncConnection):
+    # INSERT ... ON CONFLICT есть и в Postgres, и в SQLite, но конструкции у диалектов разные
+    bind = db.get_bind() if isinstance(db, AsyncSession) else db
+    if bind.dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+async def warmup_pool(db_engine: AsyncEngine, connections: int):
+    # Открываем N соединений одновременно и проверяем каждое, после чего они остаются в пуле
+    if isinstance(db_engine.pool, QueuePool):
+        connections = min(connections, db_engine.pool.size())
+    # Если часть соединений не открылась, открытые все равно возвращаем в пул
+    results = await asyncio.gather(*(db_engine.connect() for _ in range(connections)), return_exceptions=True)
+    opened = [conn for conn in results if not isinstance(conn, BaseException)]
+    try:
+        errors = [error for error in results if isinstance(error, BaseException)]
+        if errors:
+            logger.error(f"Пул БД: не открыто {len(errors)} из {connections} соединений: {errors[0]}")
+            raise errors[0]
+        await asyncio.gather(*(conn.execute(text("SELECT 1")) for conn in opened))
+    finally:
+        await asyncio.gather(*(conn.close() for conn in opened), return_exceptions=True)
+    logger.info(f"Пул БД прогрет: {connections} соединений")
+
+def pool_status(db_engine: AsyncEngine) -> dict:
+    pool = db_engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+    capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+        "capacity": capacity,
+        "saturation": round(pool.checkedout() / capacity, 3) if capacity else 0.0,
+    }
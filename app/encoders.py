@@ -0,0 +1,20 @@
+from collections.abc import Iterable, Sequence
+from typing import TypedDict
+
+from pydantic import BaseModel, TypeAdapter
+
+# Сериализация ответов API из Core-кортежей без создания и валидации экземпляров
+# модели ответа. По полям модели один раз собирается TypedDict и сериализатор
+# pydantic-core для списка таких словарей; на запрос остается только разложить
+# кортежи по ключам. Байты ответа те же, что у TypeAdapter(list[Model]).dump_json.
+
+class RowEncoder:
+    def __init__(self, model: type[BaseModel]):
+        self.fields = tuple(model.model_fields)
+        row = TypedDict(f"{model.__name__}Row", {name: field.annotation for name, field in model.model_fields.items()})
+        self._adapter = TypeAdapter(list[row])
+
+    def encode(self, rows: Iterable[Sequence]) -> bytes:
+        # Порядок значений в кортеже — порядок полей модели
+        fields = self.fields
+        return self._adapter.dump_json([dict(zip(fields, row, strict=True)) for row in rows])
@@ -0,0 +1,32 @@
+import csv
+import io
+import json
+from collections.abc import AsyncIterator, Sequence
+
+# Кодирование выгрузки баллов: на вход — пачки строк из серверного курсора,
+# на выход — байты для StreamingResponse. Одна пачка кодируется целиком в один
+# кусок ответа, поэтому в памяти не больше одной пачки.
+
+EXPORT_COLUMNS = ("telegram_id", "first_name", "last_name", "subject", "score")
+
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+async def csv_chunks(batches: AsyncIterator[Sequence]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue().encode()
+    async for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+
+async def ndjson_chunks(batches: AsyncIterator[Sequence]) -> AsyncIterator[bytes]:
+    async for batch in batches:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row, strict=True)), ensure_ascii=False) + "\n" for row in batch
+        ).encode()
+
+def encode(batches: AsyncIterator[Sequence], fmt: str) -> AsyncIterator[bytes]:
+    return csv_chunks(batches) if fmt == "csv" else ndjson_chunks(batches)
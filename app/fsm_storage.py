@@ -0,0 +1,245 @@
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database import dialect_insert
+from app.logger import setup_logger
+from app.metrics import counter
+from app.models import FSMState
+
+logger = setup_logger("fsm_storage")
+
+fsm_db_reads = counter("fsm_storage_db_reads_total", "Чтения состояний FSM из БД")
+fsm_db_writes = counter("fsm_storage_db_writes_total", "Запросы записи состояний FSM в БД")
+
+# FSM-хранилище aiogram поверх общей БД: состояние и данные диалога лежат в fsm_states,
+# поэтому Telegram-бот переживает рестарты и может работать в несколько процессов.
+#
+# Чтение — не больше одного на апдейт: загруженная запись кэшируется в процессе и берется
+# из кэша до конца апдейта и еще cache_ttl секунд, так что следующий шаг диалога обходится
+# без SELECT. Запись — write-through в кэш, а в БД уходит одним запросом в конце апдейта
+# (FSMFlushMiddleware), сколько бы set_state/update_data ни вызвал обработчик.
+
+def _utcnow() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+class _Scope:
+    # Один апдейт: какие записи уже прочитаны в нем и какие нужно записать в конце
+    __slots__ = ("deferred", "dirty")
+
+    def __init__(self):
+        self.deferred = False
+        self.dirty: dict[str, _Record] = {}
+
+class _Record:
+    __slots__ = ("cached_at", "data", "scope", "state", "updated_at")
+
+    def __init__(self, state: str | None, data: dict, updated_at: datetime, scope: _Scope | None):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+        self.cached_at = time.monotonic()
+        self.scope = scope
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+_current_scope: contextvars.ContextVar[_Scope | None] = contextvars.ContextVar("fsm_scope", default=None)
+
+class SQLStorage(BaseStorage):
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        *,
+        cache_size: int = 10000,
+        cache_ttl: float = 5.0,
+        state_ttl: float = 86400.0,
+        purge_interval: float = 600.0,
+        key_builder: KeyBuilder | None = None,
+    ):
+        # cache_ttl — сколько запись из кэша считается актуальной между апдейтами.
+        # 0 — только в пределах апдейта: нужно, когда апдейты одного чата
+        # обрабатывают разные процессы. state_ttl — через сколько секунд без
+        # изменений брошенный диалог считается завершенным.
+        self.engine = engine
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.state_ttl = state_ttl
+        self.purge_interval = purge_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: OrderedDict[str, _Record] = OrderedDict()
+        self._purge_task: asyncio.Task | None = None
+        self.hits = self.misses = self.evictions = 0
+
+    def _scope(self) -> _Scope:
+        scope = _current_scope.get()
+        if scope is None:
+            scope = _Scope()
+            _current_scope.set(scope)
+        return scope
+
+    def _is_fresh(self, record: _Record, scope: _Scope) -> bool:
+        if record.scope is scope:
+            return True
+        return time.monotonic() - record.cached_at < self.cache_ttl
+
+    def _is_expired(self, record: _Record) -> bool:
+        return record.updated_at < _utcnow() - timedelta(seconds=self.state_ttl)
+
+    def _put(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    async def _load(self, key: str) -> _Record:
+        scope = self._scope()
+        record = self._cache.get(key)
+        if record is not None and self._is_fresh(record, scope):
+            self.hits += 1
+            self._cache.move_to_end(key)
+        else:
+            self.misses += 1
+            fsm_db_reads.inc()
+            async with self.engine.connect() as conn:
+                row = (
+                    await conn.execute(
+                        select(FSMState.state, FSMState.data, FSMState.updated_at).where(FSMState.key == key)
+                    )
+                ).first()
+            if row is None:
+                record = _Record(None, {}, _utcnow(), scope)
+            else:
+                record = _Record(row.state, dict(row.data or {}), row.updated_at, scope)
+            self._put(key, record)
+        record.scope = scope
+        if self._is_expired(record):
+            record.state, record.data = None, {}
+        return record
+
+    async def _save(self, key: str, record: _Record):
+        record.updated_at = _utcnow()
+        scope = self._scope()
+        if scope.deferred:
+            scope.dirty[key] = record
+        else:
+            await self._write({key: record})
+
+    async def _write(self, records: dict[str, _Record]):
+        cleared = [key for key, record in records.items() if record.empty]
+        changed = [
+            {"key": key, "state": record.state, "data": record.data, "updated_at": record.updated_at}
+            for key, record in records.items()
+            if not record.empty
+        ]
+        # Отдельная транзакция не нужна: один запрос в autocommit — один поход в БД
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if changed:
+                fsm_db_writes.inc()
+                insert = dialect_insert(conn)
+                stmt = insert(FSMState).values(changed)
+                await conn.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=[FSMState.key],
+                        set_={
+                            "state": stmt.excluded.state,
+                            "data": stmt.excluded.data,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                    )
+                )
+            if cleared:
+                fsm_db_writes.inc()
+                await conn.execute(delete(FSMState).where(FSMState.key.in_(cleared)))
+
+    async def flush(self):
+        # Записывает в БД все изменения текущего апдейта и закрывает его
+        scope = _current_scope.get()
+        _current_scope.set(None)
+        if scope is not None and scope.dirty:
+            await self._write(scope.dirty)
+
+    def defer_writes(self):
+        self._scope().deferred = True
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._save(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        record = await self._load(storage_key)
+        record.data = dict(data)
+        await self._save(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._load(self.key_builder.build(key))).data.copy()
+
+    async def purge_expired(self) -> int:
+        cutoff = _utcnow() - timedelta(seconds=self.state_ttl)
+        async with self.engine.begin() as conn:
+            result = await conn.execute(delete(FSMState).where(FSMState.updated_at < cutoff))
+        for key in [key for key, record in self._cache.items() if record.updated_at < cutoff]:
+            del self._cache[key]
+        return result.rowcount
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                purged = await self.purge_expired()
+                if purged:
+                    logger.info(f"ТГ Бот: Удалено {purged} брошенных диалогов FSM")
+            except Exception as e:
+                logger.error(f"ТГ Бот: Ошибка очистки состояний FSM: {e}")
+
+    async def start(self):
+        if self._purge_task is None and self.purge_interval > 0:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def close(self) -> None:
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sql",
+            "entries": len(self._cache),
+            "max_entries": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class FSMFlushMiddleware(BaseMiddleware):
+    # Регистрируется на dp.update после встроенного FSM-middleware: все изменения
+    # состояния за апдейт уходят в БД одним запросом после обработчика
+    def __init__(self, storage: SQLStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        self.storage.defer_writes()
+        try:
+            return await handler(event, data)
+        finally:
+            await self.storage.flush()
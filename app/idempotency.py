@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime, timedelta
+from typing import Protocol
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.config import settings
+from app.database import dialect_insert
+from app.logger import setup_logger
+from app.metrics import counter
+from app.models import IdempotencyKey
+
+logger = setup_logger("idempotency")
+
+idempotent_requests = counter("idempotent_requests_total", "Записи с Idempotency-Key по исходу", ("result",))
+
+# Идемпотентные записи: клиент (бот) шлет POST /users/ и /scores/ с заголовком
+# Idempotency-Key, одним на логическую операцию, и может повторять и дублировать
+# запрос сколько угодно — выполнится он один раз. Ответ запоминается на ttl секунд
+# и отдается повторам как есть; повтор того же ключа с другим телом — 422.
+#
+# Конкурентные запросы с одним ключом внутри воркера склеиваются: выполняет первый,
+# остальные ждут его ответа. Между воркерами склейку дает только store=sql: ключ
+# захватывается вставкой строки в idempotency_keys, дубль на другом воркере опрашивает
+# ее до ответа, но не дольше wait_timeout (дальше 409, клиент повторит). Захват, не
+# завершенный за lock_timeout (воркер упал), переходит к следующему запросу.
+#
+# Ответы 5xx не запоминаются: ключ освобождается, и повтор выполнит запись заново.
+
+class IdempotencyKeyReused(Exception):
+    pass
+
+class IdempotencyInProgress(Exception):
+    pass
+
+class StoredResponse:
+    __slots__ = ("body", "status_code")
+
+    def __init__(self, status_code: int, body: bytes):
+        self.status_code = status_code
+        self.body = body
+
+class IdempotencyStore(Protocol):
+    async def begin(self, key: str, fingerprint: str) -> StoredResponse | None: ...
+
+    async def complete(self, key: str, fingerprint: str, response: StoredResponse) -> None: ...
+
+    async def release(self, key: str) -> None: ...
+
+    async def start(self) -> None: ...
+
+    async def close(self) -> None: ...
+
+    def stats(self) -> dict: ...
+
+def _utcnow() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+def fingerprint(route: str, body: bytes) -> str:
+    return hashlib.blake2b(route.encode() + b"\0" + body, digest_size=16).hexdigest()
+
+class MemoryIdempotencyStore:
+    # Ответы в процессе: LRU по числу ключей + TTL. Подходит для одного воркера API
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, str, StoredResponse]] = OrderedDict()
+
+    async def begin(self, key: str, fingerprint: str) -> StoredResponse | None:
+        # Сохраненный ответ или None — ключ свободен, запрос выполняет вызывающий
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, stored_fingerprint, response = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyKeyReused(key)
+        return response
+
+    async def complete(self, key: str, fingerprint: str, response: StoredResponse) -> None:
+        now = time.monotonic()
+        self._data[key] = (now + self.ttl, fingerprint, response)
+        self._data.move_to_end(key)
+        # TTL у всех одинаковый: истекшие ключи — в начале
+        while self._data and (len(self._data) > self.max_entries or next(iter(self._data.values()))[0] < now):
+            self._data.popitem(last=False)
+
+    async def release(self, key: str) -> None:
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self._data), "max_entries": self.max_entries}
+
+class SQLIdempotencyStore:
+    # Ответы в общей БД (idempotency_keys): ключ видят все воркеры API
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        *,
+        ttl: float = 3600.0,
+        wait_timeout: float = 10.0,
+        lock_timeout: float = 30.0,
+        poll_interval: float = 0.05,
+        purge_interval: float = 600.0,
+    ):
+        self.engine = engine
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self._purge_task: asyncio.Task | None = None
+        # locked_at наших захватов: завершить или освободить ключ может только текущий
+        # владелец — после перехвата по lock_timeout старый захват уже ничего не меняет
+        self._claims: dict[str, datetime] = {}
+
+    async def _try_claim(self, key: str, fingerprint: str) -> StoredResponse | None | bool:
+        # None — ключ захвачен нами, ответ — сохранен ранее, False — выполняется другим
+        now = _utcnow()
+        # Каждый шаг — один запрос в autocommit: захват ключа виден другим воркерам сразу
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            insert = dialect_insert(conn)
+            claimed = await conn.execute(
+                insert(IdempotencyKey)
+                .values(
+                    key=key,
+                    fingerprint=fingerprint,
+                    locked_at=now,
+                    expires_at=now + timedelta(seconds=self.ttl),
+                )
+                .on_conflict_do_nothing(index_elements=[IdempotencyKey.key])
+                .returning(IdempotencyKey.key)
+            )
+            if claimed.first() is not None:
+                self._claims[key] = now
+                return None
+            row = (
+                await conn.execute(
+                    select(
+                        IdempotencyKey.fingerprint,
+                        IdempotencyKey.status_code,
+                        IdempotencyKey.body,
+                        IdempotencyKey.locked_at,
+                        IdempotencyKey.expires_at,
+                    ).where(IdempotencyKey.key == key)
+                )
+            ).first()
+            if row is None:
+                return False
+            if row.expires_at < now:
+                await conn.execute(
+                    delete(IdempotencyKey).where(
+                        IdempotencyKey.key == key, IdempotencyKey.expires_at == row.expires_at
+                    )
+                )
+                return False
+            if row.fingerprint != fingerprint:
+                raise IdempotencyKeyReused(key)
+            if row.status_code is not None:
+                return StoredResponse(row.status_code, row.body)
+            if row.locked_at < now - timedelta(seconds=self.lock_timeout):
+                # Захвативший воркер не ответил за lock_timeout — забираем ключ себе
+                taken = await conn.execute(
+                    update(IdempotencyKey)
+                    .where(
+                        IdempotencyKey.key == key,
+                        IdempotencyKey.locked_at == row.locked_at,
+                        IdempotencyKey.status_code.is_(None),
+                    )
+                    .values(locked_at=now)
+                )
+                if taken.rowcount:
+                    self._claims[key] = now
+                    logger.warning(f"Ключ {key} не завершен за {self.lock_timeout} с, запрос выполняется заново")
+                    return None
+            return False
+
+    async def begin(self, key: str, fingerprint: str) -> StoredResponse | None:
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            result = await self._try_claim(key, fingerprint)
+            if result is not False:
+                return result
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress(key)
+            await asyncio.sleep(self.poll_interval)
+
+    def _owned(self, key: str, locked_at: datetime | None):
+        return (
+            IdempotencyKey.key == key,
+            IdempotencyKey.locked_at == locked_at,
+            IdempotencyKey.status_code.is_(None),
+        )
+
+    async def complete(self, key: str, fingerprint: str, response: StoredResponse) -> None:
+        locked_at = self._claims.pop(key, None)
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            result = await conn.execute(
+                update(IdempotencyKey)
+                .where(*self._owned(key, locked_at))
+                .values(
+                    status_code=response.status_code,
+                    body=response.body,
+                    expires_at=_utcnow() + timedelta(seconds=self.ttl),
+                )
+            )
+        if not result.rowcount:
+            logger.warning(f"Ключ {key} перехвачен другим воркером, ответ не сохранен")
+
+    async def release(self, key: str) -> None:
+        locked_at = self._claims.pop(key, None)
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(delete(IdempotencyKey).where(*self._owned(key, locked_at)))
+
+    async def purge_expired(self) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < _utcnow()))
+        return result.rowcount
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                purged = await self.purge_expired()
+                if purged:
+                    logger.info(f"Удалено {purged} истекших ключей идемпотентности")
+            except Exception as e:
+                logger.error(f"Ошибка очистки ключей идемпотентности: {e}")
+
+    async def start(self) -> None:
+        if self._purge_task is None and self.purge_interval > 0:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def close(self) -> None:
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    def stats(self) -> dict:
+        return {"backend": "sql"}
+
+class Idempotency:
+    # Склейка конкурентных запросов с одним ключом в воркере поверх хранилища ответов
+
+    def __init__(self, store: IdempotencyStore):
+        self.store = store
+        self._in_flight: dict[str, tuple[str, asyncio.Future]] = {}
+
+    async def run(
+        self, key: str, fingerprint: str, call: Callable[[], Awaitable[StoredResponse]]
+    ) -> tuple[StoredResponse, bool]:
+        # (ответ, повтор ли это). Исключения call() достаются только первому запросу,
+        # склеенные с ним получают IdempotencyInProgress и повторяют запрос сами
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            leader_fingerprint, future = entry
+            if leader_fingerprint != fingerprint:
+                idempotent_requests.inc("reused")
+                raise IdempotencyKeyReused(key)
+            idempotent_requests.inc("coalesced")
+            response = await asyncio.shield(future)
+            if response is None:
+                raise IdempotencyInProgress(key)
+            return response, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = (fingerprint, future)
+        response = None
+        try:
+            try:
+                stored = await self.store.begin(key, fingerprint)
+            except IdempotencyKeyReused:
+                idempotent_requests.inc("reused")
+                raise
+            except IdempotencyInProgress:
+                idempotent_requests.inc("in_progress")
+                raise
+            if stored is not None:
+                idempotent_requests.inc("replayed")
+                response = stored
+                return stored, True
+
+            try:
+                response = await call()
+            except BaseException:
+                await self._release(key)
+                raise
+            idempotent_requests.inc("executed")
+            if response.status_code >= 500:
+                await self._release(key)
+            else:
+                try:
+                    await self.store.complete(key, fingerprint, response)
+                except Exception as e:
+                    # Запись уже сделана: отвечаем, повтор после lock_timeout выполнит ее снова
+                    logger.error(f"Не удалось сохранить ответ для ключа {key}: {e}")
+            return response, False
+        finally:
+            del self._in_flight[key]
+            future.set_result(response)
+
+    async def _release(self, key: str):
+        try:
+            await self.store.release(key)
+        except Exception as e:
+            logger.error(f"Не удалось освободить ключ {key}: {e}")
+
+    async def start(self):
+        await self.store.start()
+
+    async def close(self):
+        await self.store.close()
+
+    def stats(self) -> dict:
+        return {**self.store.stats(), "in_flight": len(self._in_flight)}
+
+def create_idempotency(engine: AsyncEngine) -> Idempotency | None:
+    if settings.IDEMPOTENCY_BACKEND == "none":
+        return None
+    if settings.IDEMPOTENCY_BACKEND == "sql":
+        logger.info("Ключи идемпотентности: БД")
+        return Idempotency(
+            SQLIdempotencyStore(
+                engine,
+                ttl=settings.IDEMPOTENCY_TTL,
+                wait_timeout=settings.IDEMPOTENCY_WAIT_TIMEOUT,
+                lock_timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT,
+                purge_interval=settings.IDEMPOTENCY_PURGE_INTERVAL,
+            )
+        )
+    return Idempotency(
+        MemoryIdempotencyStore(max_entries=settings.IDEMPOTENCY_MAX_ENTRIES, ttl=settings.IDEMPOTENCY_TTL)
+    )
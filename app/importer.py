@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import csv
+import time
+from collections.abc import Iterator
+
+from pydantic import ValidationError
+from sqlalchemy import BigInteger, Column, DateTime, Integer, MetaData, SmallInteger, String, Table, literal, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession, create_async_engine
+
+from app.cache import scores_cache, scores_key
+from app.config import settings
+from app.crud import add_histogram_delta, apply_histogram_deltas, resolve_subject_ids, utcnow
+from app.database import dialect_insert, engine, engine_options, instrument_engine
+from app.export import EXPORT_COLUMNS
+from app.logger import setup_logger
+from app.models import Score, ScoreHistory, User
+from app.schemas import ScoreCreate, UserCreate
+from app.subjects import subject_cache
+
+logger = setup_logger("importer")
+
+# Офлайн-загрузка исторических баллов из CSV (формат как у /export/scores:
+# telegram_id,first_name,last_name,subject,score) в окно обслуживания.
+#
+#   python -m app.importer results_2024.csv
+#   python -m app.importer results_2024.csv --dry-run
+#
+# Файл читается потоком и загружается пачками по --batch-size строк, каждая пачка —
+# одна транзакция. Недостающие юзеры создаются (имена существующих не меняются),
+# баллы обновляются по правилу "последняя строка побеждает" и пишутся в историю
+# попыток с временем загрузки. В Postgres пачка уходит
+# через COPY во временную таблицу и дальше двумя set-based запросами, в SQLite —
+# executemany. Строки, не прошедшие валидацию, пропускаются и пишутся в лог.
+
+# Сколько ошибок валидации писать в лог целиком, дальше только считаем
+MAX_LOGGED_ERRORS = 20
+
+# Временная таблица пачки для Postgres: живет в сессии соединения, строки
+# удаляются на COMMIT, поэтому между пачками ее не нужно чистить
+STAGING_TABLE = "import_scores_staging"
+
+staging = Table(
+    STAGING_TABLE,
+    MetaData(),
+    Column("telegram_id", BigInteger),
+    Column("first_name", String),
+    Column("last_name", String),
+    Column("subject_id", SmallInteger),
+    Column("score", Integer),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DELETE ROWS",
+)
+
+class ImportRow:
+    __slots__ = ("first_name", "last_name", "line", "score", "subject", "telegram_id")
+
+    def __init__(self, line: int, user: UserCreate, score: ScoreCreate):
+        self.line = line
+        self.telegram_id = user.telegram_id
+        self.first_name = user.first_name
+        self.last_name = user.last_name
+        self.subject = score.subject
+        self.score = score.score
+
+class CSVImport:
+    def __init__(self, db_engine: AsyncEngine, *, batch_size: int = 10000, dry_run: bool = False):
+        self.engine = db_engine
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.progress = {
+            "rows": 0,
+            "imported": 0,
+            "users_created": 0,
+            "invalid": 0,
+            "unknown_subject": 0,
+        }
+        self._new_subjects: dict[str, int] = {}
+
+    def _invalid(self, line: int, error):
+        self.progress["invalid"] += 1
+        if self.progress["invalid"] <= MAX_LOGGED_ERRORS:
+            logger.warning(f"Импорт: Строка {line} пропущена: {error}")
+
+    def read(self, path: str) -> Iterator[list[ImportRow]]:
+        # Пачки провалидированных строк; номер строки — как в файле, с учетом заголовка
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            reader = csv.DictReader(f)
+            missing = set(EXPORT_COLUMNS) - set(reader.fieldnames or ())
+            if missing:
+                raise ValueError(f"В CSV нет колонок: {', '.join(sorted(missing))}")
+            batch = []
+            for record in reader:
+                self.progress["rows"] += 1
+                try:
+                    user = UserCreate.model_validate(record)
+                    score = ScoreCreate.model_validate(record)
+                except ValidationError as e:
+                    self._invalid(reader.line_num, e.errors(include_url=False)[0]["msg"])
+                    continue
+                batch.append(ImportRow(reader.line_num, user, score))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    async def _subject_ids(self, conn: AsyncConnection, batch: list[ImportRow]) -> dict[str, int]:
+        names = list({row.subject for row in batch})
+        async with AsyncSession(bind=conn) as db:
+            if not self.dry_run:
+                return await resolve_subject_ids(db, names)
+            subject_ids = await resolve_subject_ids(db, names, create=False)
+        # В dry-run предметы не заводим, но те, что завелись бы при загрузке, считаем
+        # допустимыми: выдаем им временные отрицательные id по нормализованному имени
+        if settings.SUBJECTS_AUTO_CREATE:
+            for name in names:
+                key = subject_cache.key(name)
+                if key and name not in subject_ids:
+                    subject_ids[name] = -self._new_subjects.setdefault(key, len(self._new_subjects) + 1)
+        return subject_ids
+
+    def _rows(self, batch: list[ImportRow], subject_ids: dict[str, int]) -> dict[tuple[int, int], ImportRow]:
+        rows = {}
+        for row in batch:
+            subject_id = subject_ids.get(row.subject)
+            if subject_id is None:
+                self.progress["unknown_subject"] += 1
+                self._invalid(row.line, f"неизвестный предмет {row.subject!r}")
+                continue
+            rows[(row.telegram_id, subject_id)] = row
+        return rows
+
+    async def _load_postgres(self, conn: AsyncConnection, rows: dict) -> tuple[int, dict]:
+        # Проверка staging-таблицы — первый запрос пачки, он открывает транзакцию
+        # в asyncpg, так что COPY через сырое соединение попадает в нее же
+        await conn.run_sync(lambda sync_conn: staging.create(sync_conn, checkfirst=True))
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            STAGING_TABLE,
+            records=[
+                (row.telegram_id, row.first_name, row.last_name, subject_id, row.score)
+                for (_, subject_id), row in rows.items()
+            ],
+            columns=[column.name for column in staging.columns],
+        )
+
+        insert = dialect_insert(conn)
+        # DISTINCT ON через .distinct(col): postgresql.distinct_on есть только с SQLAlchemy 2.1
+        users = await conn.execute(
+            insert(User.__table__)
+            .from_select(
+                ["telegram_id", "first_name", "last_name"],
+                select(staging.c.telegram_id, staging.c.first_name, staging.c.last_name)
+                .distinct(staging.c.telegram_id)
+                .order_by(staging.c.telegram_id),
+            )
+            .on_conflict_do_nothing(index_elements=[User.telegram_id])
+            .returning(User.id)
+        )
+        created = len(users.all())
+
+        stmt = insert(Score.__table__).from_select(
+            ["user_id", "subject_id", "score"],
+            select(User.id, staging.c.subject_id, staging.c.score).join(
+                User, User.telegram_id == staging.c.telegram_id
+            ),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Score.user_id, Score.subject_id],
+            set_={"score": stmt.excluded.score, "previous_score": Score.score},
+        ).returning(Score.subject_id, Score.score, Score.previous_score)
+        deltas = {}
+        for subject_id, score, previous_score in (await conn.execute(stmt)).all():
+            add_histogram_delta(deltas, subject_id, score, previous_score)
+
+        await conn.execute(
+            insert(ScoreHistory.__table__).from_select(
+                ["user_id", "subject_id", "score", "created_at"],
+                select(User.id, staging.c.subject_id, staging.c.score, literal(utcnow(), DateTime)).join(
+                    User, User.telegram_id == staging.c.telegram_id
+                ),
+            )
+        )
+        return created, deltas
+
+    async def _load_sqlite(self, conn: AsyncConnection, rows: dict) -> tuple[int, dict]:
+        insert = dialect_insert(conn)
+        users = {}
+        for row in rows.values():
+            users.setdefault(
+                row.telegram_id,
+                {"telegram_id": row.telegram_id, "first_name": row.first_name, "last_name": row.last_name},
+            )
+        result = await conn.execute(
+            insert(User.__table__).on_conflict_do_nothing(index_elements=[User.telegram_id]), list(users.values())
+        )
+        created = result.rowcount
+
+        user_ids = dict(
+            (await conn.execute(select(User.telegram_id, User.id).where(User.telegram_id.in_(users)))).all()
+        )
+        stmt = insert(Score.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Score.user_id, Score.subject_id],
+            set_={"score": stmt.excluded.score, "previous_score": Score.score},
+        ).returning(Score.subject_id, Score.score, Score.previous_score)
+        scores = [
+            {"user_id": user_ids[telegram_id], "subject_id": subject_id, "score": row.score}
+            for (telegram_id, subject_id), row in rows.items()
+        ]
+        result = await conn.execute(stmt, scores)
+        deltas = {}
+        for subject_id, score, previous_score in result.all():
+            add_histogram_delta(deltas, subject_id, score, previous_score)
+
+        now = utcnow()
+        await conn.execute(insert(ScoreHistory.__table__), [{**score, "created_at": now} for score in scores])
+        return created, deltas
+
+    async def load(self, conn: AsyncConnection, batch: list[ImportRow]):
+        subject_ids = await self._subject_ids(conn, batch)
+        rows = self._rows(batch, subject_ids)
+        if self.dry_run or not rows:
+            self.progress["imported"] += len(rows)
+            return
+
+        async with conn.begin():
+            if conn.dialect.name == "postgresql":
+                created, deltas = await self._load_postgres(conn, rows)
+            else:
+                created, deltas = await self._load_sqlite(conn, rows)
+            await apply_histogram_deltas(conn, deltas)
+        self.progress["users_created"] += created
+        self.progress["imported"] += len(rows)
+        await scores_cache.delete(*(scores_key(telegram_id) for telegram_id, _ in rows))
+
+    async def run(self, path: str) -> dict:
+        start = time.perf_counter()
+        async with self.engine.connect() as conn:
+            for batch in self.read(path):
+                await self.load(conn, batch)
+                elapsed = time.perf_counter() - start
+                logger.info(
+                    f"Импорт: Прочитано {self.progress['rows']} строк, загружено {self.progress['imported']}, "
+                    f"пропущено {self.progress['invalid']}, {self.progress['rows'] / elapsed:.0f} строк/с"
+                )
+        elapsed = time.perf_counter() - start
+        if self._new_subjects:
+            self.progress["new_subjects"] = len(self._new_subjects)
+        self.progress["duration_s"] = round(elapsed, 2)
+        self.progress["rows_per_s"] = round(self.progress["rows"] / elapsed, 1) if elapsed else 0.0
+        return self.progress
+
+async def run(args) -> dict:
+    db_engine = engine
+    if args.db:
+        db_engine = instrument_engine(create_async_engine(args.db, **engine_options(args.db)))
+    try:
+        return await CSVImport(db_engine, batch_size=args.batch_size, dry_run=args.dry_run).run(args.path)
+    finally:
+        await db_engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description="Загрузка баллов из CSV в БД")
+    parser.add_argument("path", help="CSV с колонками " + ",".join(EXPORT_COLUMNS))
+    parser.add_argument("--db", help="URL БД (по умолчанию из настроек)")
+    parser.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Только проверить файл, ничего не записывая")
+    args = parser.parse_args()
+
+    progress = asyncio.run(run(args))
+    mode = " (dry-run, ничего не записано)" if args.dry_run else ""
+    logger.info(f"Импорт завершен{mode}: {progress}")
+
+if __name__ == "__main__":
+    main()
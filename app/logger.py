@@ -1,17 +1,103 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 
+from app.config import settings
 
-def setup_logger(name: str) -> logging.Logger:
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
+# Логи пишутся через очередь: в event loop только кладем запись в очередь,
+# а вывод в stdout делает фоновый поток QueueListener. Если stdout не успевает,
+# записи отбрасываются и считаются, вместо того чтобы тормозить API и ботов.
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(
+            {
+                "time": self.formatTime(record),
+                "logger": record.name,
+                "level": record.levelname,
+                "message": record.getMessage(),
+            },
+            ensure_ascii=False,
+        )
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class SampledLogger(logging.LoggerAdapter):
+    # Для частых INFO-строк "на каждое сообщение": пропускает каждую N-ю запись
+    # уровня INFO и ниже, предупреждения и ошибки пишутся всегда
+
+    def __init__(self, logger: logging.Logger, rate: float):
+        super().__init__(logger, {})
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._count = 0
+
+    def log(self, level, msg, *args, **kwargs):
+        if level <= logging.INFO:
+            if not self.every or not self.logger.isEnabledFor(level):
+                return
+            self._count += 1
+            if (self._count - 1) % self.every:
+                return
+        super().log(level, msg, *args, **kwargs)
 
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+_handler: DroppingQueueHandler | None = None
+_listener: logging.handlers.QueueListener | None = None
 
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
+def _parse_levels(value: str) -> dict[str, str]:
+    levels = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
 
-    logger.addHandler(handler)
+_module_levels = _parse_levels(settings.LOG_LEVELS)
+
+def _get_handler() -> DroppingQueueHandler:
+    global _handler, _listener
+    if _handler is None:
+        log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        if settings.LOG_JSON:
+            stream_handler.setFormatter(JsonFormatter())
+        else:
+            stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+        _handler = DroppingQueueHandler(log_queue)
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+    return _handler
+
+def stop_logging():
+    # Дописывает накопленные в очереди записи
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+def setup_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(_module_levels.get(name, settings.LOG_LEVEL.upper()))
+
+    handler = _get_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
     return logger
+
+def sampled(logger: logging.Logger) -> SampledLogger:
+    return SampledLogger(logger, settings.LOG_SAMPLE_RATE)
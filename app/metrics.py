@@ -0,0 +1,192 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from functools import wraps
+
+from app.logger import setup_logger
+
+logger = setup_logger("metrics")
+
+# Минимальные метрики в формате Prometheus text без внешних зависимостей.
+# Запись на горячем пути — поиск в словаре и инкремент, текст собирается только при /metrics.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def collect(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in self._values.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+class CallbackGauge:
+    # Значение считывается при отдаче метрик: размеры кэшей, очередей и т.п.
+    # С labelnames callback возвращает словарь {значения меток: значение}
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        callback: Callable[[], float | dict[tuple, float]],
+        type: str = "gauge",
+        labelnames: tuple[str, ...] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.type = type
+        self.labelnames = labelnames
+
+    def collect(self) -> list[str]:
+        if not self.labelnames:
+            return [f"{self.name} {self.callback()}"]
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in self.callback().items()]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def collect(self) -> list[str]:
+        lines = []
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def register(self, metric):
+        # Повторная регистрация того же имени возвращает уже существующую метрику
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    return registry.register(Counter(name, help, labelnames))
+
+def gauge(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+    return registry.register(Gauge(name, help, labelnames))
+
+def callback_gauge(
+    name: str,
+    help: str,
+    callback: Callable[[], float | dict[tuple, float]],
+    type: str = "gauge",
+    labelnames: tuple[str, ...] = (),
+) -> CallbackGauge:
+    return registry.register(CallbackGauge(name, help, callback, type, labelnames))
+
+def histogram(name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+def timed(hist: Histogram, *labels):
+    # Декоратор для корутин: время выполнения в гистограмму
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - start, *labels)
+        return wrapper
+    return decorator
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int, host: str = "0.0.0.0") -> asyncio.Server | None:
+    # Маленький HTTP-сервер с /metrics для процессов ботов (у API есть свой эндпоинт)
+    if port <= 0:
+        return None
+    server = await asyncio.start_server(_handle_metrics_request, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -1,7 +1,20 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    SmallInteger,
+    String,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship
 
 from app.database import Base
+from app.subjects import subject_cache
 
 
 class User(Base):
@@ -11,17 +24,86 @@ class User(Base):
     telegram_id = Column(Integer, unique=True, index=True, nullable=False)
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
+    # Откуда зарегистрирован: "tg" или "vk" (ВК-бот хранит vk_id в telegram_id).
+    # NULL — юзеры до миграции 007 и из импорта, платформа неизвестна
+    platform = Column(String(2), nullable=True)
     scores = relationship("Score", back_populates="user", cascade="all, delete-orphan")
 
+class Subject(Base):
+    __tablename__ = "subjects"
+
+    # В SQLite автоинкремент есть только у INTEGER PRIMARY KEY
+    id = Column(SmallInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    # Нормализованное имя (см. app.subjects.normalize) — по нему ищем и не плодим дубли
+    key = Column(String, unique=True, nullable=False)
+    name = Column(String, nullable=False)
+
 class Score(Base):
     __tablename__ = "scores"
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    subject = Column(String, nullable=False)
+    subject_id = Column(SmallInteger, ForeignKey("subjects.id"), nullable=False)
     score = Column(Integer, nullable=False)
+    # Балл до последнего обновления: upsert возвращает его в RETURNING, чтобы
+    # поправить гистограмму предмета без отдельного SELECT
+    previous_score = Column(Integer, nullable=True)
     user = relationship("User", back_populates="scores")
 
     __table_args__ = (
-        UniqueConstraint('user_id', 'subject', name='_user_subject_uc'),
+        UniqueConstraint('user_id', 'subject_id', name='_user_subject_uc'),
+        Index('ix_scores_subject_score', 'subject_id', 'score'),
+    )
+
+    @property
+    def subject(self) -> str | None:
+        # Имя предмета из справочника в памяти; crud подгружает его до того, как отдать балл
+        return subject_cache.get_name(self.subject_id)
+
+class ScoreHistory(Base):
+    # Все попытки ученика: строка на каждую запись балла, только добавляется.
+    # scores — проекция последней попытки по (юзер, предмет), ее и читают /view_scores
+    __tablename__ = "score_history"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    subject_id = Column(SmallInteger, ForeignKey("subjects.id"), nullable=False)
+    score = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        # Траектория по предмету и keyset-пагинация по (created_at, id) — скан одного
+        # диапазона индекса; второй индекс — для истории по всем предметам сразу
+        Index('ix_score_history_user_subject_time', 'user_id', 'subject_id', 'created_at', 'id'),
+        Index('ix_score_history_user_time', 'user_id', 'created_at', 'id'),
     )
+
+class SubjectScoreCount(Base):
+    # Гистограмма баллов по предмету: сколько учеников имеют каждый балл.
+    # Обновляется инкрементально в crud при каждой записи балла
+    __tablename__ = "subject_score_counts"
+
+    subject_id = Column(SmallInteger, ForeignKey("subjects.id"), primary_key=True)
+    score = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class FSMState(Base):
+    # Состояния диалогов Telegram-бота (aiogram FSM), общие для всех процессов бота
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(JSON, nullable=False, default=dict)
+    updated_at = Column(DateTime, nullable=False, index=True)
+
+class IdempotencyKey(Base):
+    # Ответы на записи с заголовком Idempotency-Key, общие для всех воркеров API.
+    # status_code пуст, пока запрос выполняется: locked_at — когда его взял воркер
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    body = Column(LargeBinary, nullable=True)
+    locked_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
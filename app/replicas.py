@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+from fastapi import Depends, Request
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from app.config import settings
+from app.database import engine_options, get_db, instrument_engine
+from app.logger import setup_logger
+from app.metrics import callback_gauge, counter
+
+logger = setup_logger("replicas")
+
+db_reads_routed = counter("db_reads_routed_total", "Чтения маршрутов только на чтение по целям", ("target",))
+
+# Маршрутизация чтений на реплики БД. Маршруты только на чтение берут сессию через
+# get_read_db: реплика выбирается по кругу из здоровых, запись всегда идет в основную
+# БД через get_db. Реплика, к которой не удалось подключиться, выключается до
+# следующей успешной проверки (раз в health_interval), а запрос уходит в основную БД.
+#
+# Read-your-writes: после записи юзера (POST /users/, /scores/) его чтения по
+# telegram_id sticky_window секунд идут в основную БД — окно должно быть больше лага
+# реплик, иначе прочитанное с реплики старое значение может попасть и в кэш баллов.
+# Окно хранится в процессе: при нескольких воркерах API чтение попадает в основную
+# БД, только если его обслуживает тот же воркер, что и запись.
+
+class _Replica:
+    __slots__ = ("engine", "healthy", "name", "sessionmaker")
+
+    def __init__(self, db_engine: AsyncEngine):
+        self.engine = db_engine
+        self.name = db_engine.url.render_as_string(hide_password=True)
+        self.sessionmaker = async_sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+        self.healthy = True
+
+class ReplicaRouter:
+    def __init__(
+        self,
+        replicas: list[AsyncEngine],
+        *,
+        sticky_window: float = 5.0,
+        health_interval: float = 5.0,
+        health_timeout: float = 2.0,
+    ):
+        self.replicas = [_Replica(replica) for replica in replicas]
+        self.sticky_window = sticky_window
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._next = itertools.count()
+        self._sticky: OrderedDict[int, float] = OrderedDict()
+        self._health_task: asyncio.Task | None = None
+
+    def mark_write(self, telegram_id: int):
+        if not self.replicas:
+            return
+        # Окно у всех одинаковое, поэтому самые старые записи — в начале OrderedDict
+        now = time.monotonic()
+        self._sticky[telegram_id] = now + self.sticky_window
+        self._sticky.move_to_end(telegram_id)
+        while self._sticky:
+            oldest_id, deadline = next(iter(self._sticky.items()))
+            if deadline > now:
+                break
+            del self._sticky[oldest_id]
+
+    def is_sticky(self, telegram_id: int | None) -> bool:
+        deadline = self._sticky.get(telegram_id)
+        return deadline is not None and deadline > time.monotonic()
+
+    def pick(self, telegram_id: int | None = None) -> _Replica | None:
+        # Реплика для чтения или None — читать из основной БД
+        if not self.replicas:
+            return None
+        if telegram_id is not None and self.is_sticky(telegram_id):
+            db_reads_routed.inc("primary_sticky")
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            db_reads_routed.inc("primary_fallback")
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def _set_health(self, replica: _Replica, healthy: bool, error: Exception | None = None):
+        if replica.healthy and not healthy:
+            logger.warning(f"Реплика {replica.name} выключена из чтения: {error}")
+        elif not replica.healthy and healthy:
+            logger.info(f"Реплика {replica.name} снова принимает чтения")
+        replica.healthy = healthy
+
+    async def session(self, replica: _Replica) -> AsyncSession | None:
+        # Сессия с уже открытым соединением к реплике; None — реплика недоступна
+        session = replica.sessionmaker()
+        # Метка для crud: отсутствие строки на реплике может быть лагом репликации
+        session.info["replica"] = True
+        try:
+            async with asyncio.timeout(self.health_timeout):
+                await session.connection()
+        except (DBAPIError, OSError, TimeoutError) as e:
+            await session.close()
+            self._set_health(replica, False, e)
+            db_reads_routed.inc("primary_fallback")
+            return None
+        db_reads_routed.inc("replica")
+        return session
+
+    async def check(self):
+        for replica in self.replicas:
+            try:
+                async with asyncio.timeout(self.health_timeout):
+                    async with replica.engine.connect() as conn:
+                        await conn.execute(text("SELECT 1"))
+            except Exception as e:
+                self._set_health(replica, False, e)
+            else:
+                self._set_health(replica, True)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Ошибка проверки реплик: {e}")
+
+    async def start(self):
+        if self.replicas and self._health_task is None:
+            await self.check()
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def stats(self) -> list[dict]:
+        return [{"replica": replica.name, "healthy": replica.healthy} for replica in self.replicas]
+
+def make_replica_engines(urls: str) -> list[AsyncEngine]:
+    return [
+        instrument_engine(create_async_engine(url, **engine_options(url)))
+        for url in (part.strip() for part in urls.split(","))
+        if url
+    ]
+
+replica_router = ReplicaRouter(
+    make_replica_engines(settings.DB_REPLICA_URLS),
+    sticky_window=settings.DB_READ_YOUR_WRITES_WINDOW,
+    health_interval=settings.DB_REPLICA_HEALTH_INTERVAL,
+    health_timeout=settings.DB_REPLICA_HEALTH_TIMEOUT,
+)
+callback_gauge(
+    "db_replicas_healthy", "Реплики БД, принимающие чтения", lambda: sum(r.healthy for r in replica_router.replicas)
+)
+
+async def get_read_db(request: Request, db: AsyncSession = Depends(get_db)):
+    # Сессия для маршрутов только на чтение. Сессия основной БД из get_db соединение
+    # берет лениво, поэтому, пока чтение идет на реплику, она ничего не стоит
+    if not replica_router.replicas:
+        yield db
+        return
+    # Путь еще не провалидирован FastAPI: некорректный id ответит 422 сам маршрут
+    try:
+        telegram_id = int(request.path_params["telegram_id"])
+    except (KeyError, ValueError):
+        telegram_id = None
+    replica = replica_router.pick(telegram_id)
+    session = await replica_router.session(replica) if replica is not None else None
+    if session is None:
+        yield db
+        return
+    async with session:
+        yield session
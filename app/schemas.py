@@ -1,10 +1,18 @@
-from pydantic import BaseModel, ConfigDict
+from datetime import datetime
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict, Field
+
+# ЕГЭ оценивается по 100-балльной шкале
+SCORE_MIN = 0
+SCORE_MAX = 100
 
 
 class UserCreate(BaseModel):
     telegram_id: int
     first_name: str
     last_name: str
+    platform: Literal["tg", "vk"] | None = None
 
 class UserResponse(UserCreate):
     id: int
@@ -13,9 +21,63 @@ class UserResponse(UserCreate):
 class ScoreCreate(BaseModel):
     telegram_id: int
     subject: str
-    score: int
+    score: int = Field(ge=SCORE_MIN, le=SCORE_MAX)
 
 class ScoreResponse(BaseModel):
     subject: str
     score: int
     model_config = ConfigDict(from_attributes=True)
+
+class ScoreHistoryEntry(BaseModel):
+    subject: str
+    score: int
+    created_at: datetime
+
+class ScoreHistoryPage(BaseModel):
+    items: list[ScoreHistoryEntry]
+    # Курсор следующей (более старой) страницы, None — страниц больше нет
+    next_cursor: str | None = None
+
+class SubjectTrend(BaseModel):
+    subject: str
+    # Последние попытки от старой к новой, последняя — текущий балл
+    scores: list[int]
+
+class BulkItemResult(BaseModel):
+    index: int
+    telegram_id: int | None = None
+    status: str
+    detail: str | None = None
+
+class BulkScoreResponse(BaseModel):
+    total: int = 0
+    upserted: int = 0
+    not_found: int = 0
+    invalid: int = 0
+    failed: int = 0
+    # Поэлементные результаты только для неуспешных записей, успешные не перечисляем;
+    # больше BULK_MAX_ERRORS не храним, сверх них — только счетчик errors_omitted
+    errors: list[BulkItemResult] = []
+    errors_omitted: int = 0
+
+class SubjectStats(BaseModel):
+    subject: str
+    count: int
+    mean: float
+    min: int
+    max: int
+    percentiles: dict[str, int]
+
+class UserSubjectStats(BaseModel):
+    subject: str
+    score: int
+    rank: int
+    total: int
+    mean: float
+    median: int
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    first_name: str
+    last_name: str
+    score: int
@@ -0,0 +1,43 @@
+import math
+
+# Статистика по гистограмме предмета: список (балл, число учеников) по возрастанию балла.
+# Все функции проходят гистограмму целиком — O(диапазона баллов), а не O(числа строк scores).
+
+PERCENTILES = (25, 50, 75, 90)
+
+def percentile(histogram: list[tuple[int, int]], total: int, p: float) -> int:
+    # Метод ближайшего ранга: наименьший балл, у которого накопленная доля >= p%
+    target = max(1, math.ceil(p / 100 * total))
+    cumulative = 0
+    for score, count in histogram:
+        cumulative += count
+        if cumulative >= target:
+            return score
+    return histogram[-1][0]
+
+def summarize(histogram: list[tuple[int, int]]) -> dict | None:
+    total = sum(count for _, count in histogram)
+    if not total:
+        return None
+    return {
+        "count": total,
+        "mean": round(sum(score * count for score, count in histogram) / total, 2),
+        "min": histogram[0][0],
+        "max": histogram[-1][0],
+        "percentiles": {f"p{p}": percentile(histogram, total, p) for p in PERCENTILES},
+    }
+
+def rank_of(histogram: list[tuple[int, int]], score: int) -> tuple[int, int]:
+    # Место с учетом одинаковых баллов: 1 + число учеников со строго большим баллом
+    above = sum(count for value, count in histogram if value > score)
+    total = sum(count for _, count in histogram)
+    return above + 1, total
+
+def top_cutoff(histogram: list[tuple[int, int]], limit: int) -> int | None:
+    # Минимальный балл, при котором в выборку попадает хотя бы limit учеников
+    cumulative = 0
+    for score, count in reversed(histogram):
+        cumulative += count
+        if cumulative >= limit:
+            return score
+    return histogram[0][0] if histogram else None
@@ -0,0 +1,104 @@
+from app.config import settings
+from app.logger import setup_logger
+
+logger = setup_logger("subjects")
+
+# Справочник предметов: в scores хранится smallint subject_id, а имена живут в subjects.
+# Имя, пришедшее от юзера, сначала нормализуется (регистр, пробелы, ё), потом
+# прогоняется через алиасы — так "математика", "Математика " и "матем" дают один id.
+
+SUBJECTS = [
+    "Математика",
+    "Русский язык",
+    "Информатика",
+    "Физика",
+    "Химия",
+    "Биология",
+    "История",
+    "Обществознание",
+    "География",
+    "Литература",
+    "Английский язык",
+    "Немецкий язык",
+    "Французский язык",
+    "Испанский язык",
+    "Китайский язык",
+]
+
+ALIASES = {
+    "матем": "математика",
+    "математика профиль": "математика",
+    "профильная математика": "математика",
+    "русский": "русский язык",
+    "рус яз": "русский язык",
+    "инфа": "информатика",
+    "икт": "информатика",
+    "информатика и икт": "информатика",
+    "физ": "физика",
+    "хим": "химия",
+    "био": "биология",
+    "общество": "обществознание",
+    "общ": "обществознание",
+    "гео": "география",
+    "литра": "литература",
+    "английский": "английский язык",
+    "англ": "английский язык",
+    "немецкий": "немецкий язык",
+    "французский": "французский язык",
+    "испанский": "испанский язык",
+    "китайский": "китайский язык",
+}
+
+def _parse_aliases(value: str) -> dict[str, str]:
+    aliases = {}
+    for item in value.split(","):
+        if "=" in item:
+            alias, name = item.split("=", 1)
+            aliases[normalize(alias)] = normalize(name)
+    return aliases
+
+def clean(name: str) -> str:
+    # Отображаемое имя: без лишних пробелов и с заглавной буквы
+    name = " ".join(name.split())
+    return name[:1].upper() + name[1:]
+
+def normalize(name: str) -> str:
+    return " ".join(name.replace("ё", "е").replace("Ё", "Е").split()).casefold()
+
+class SubjectCache:
+    # name -> id и id -> name в процессе. Предметов единицы-десятки, поэтому храним
+    # весь справочник целиком и перечитываем его из БД только при промахе
+
+    def __init__(self, aliases: dict[str, str]):
+        self.aliases = aliases
+        self._ids: dict[str, int] = {}
+        self._names: dict[int, str] = {}
+        self.hits = self.misses = 0
+
+    def key(self, name: str) -> str:
+        key = normalize(name)
+        return self.aliases.get(key, key)
+
+    def get_id(self, name: str) -> int | None:
+        subject_id = self._ids.get(self.key(name))
+        if subject_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return subject_id
+
+    def get_name(self, subject_id: int) -> str | None:
+        return self._names.get(subject_id)
+
+    def add(self, subject_id: int, key: str, name: str) -> None:
+        self._ids[key] = subject_id
+        self._names[subject_id] = name
+
+    def clear(self) -> None:
+        self._ids.clear()
+        self._names.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._names), "hits": self.hits, "misses": self.misses}
+
+subject_cache = SubjectCache({**ALIASES, **_parse_aliases(settings.SUBJECT_ALIASES)})
@@ -0,0 +1,141 @@
+import asyncio
+import hmac
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+from pydantic import ValidationError
+
+from app.config import settings
+from app.logger import setup_logger
+from app.metrics import counter, gauge
+
+logger = setup_logger("tg_webhook")
+
+updates_queue_depth = gauge("tg_updates_queue_depth", "Апдейты Telegram в очереди на обработку")
+updates_rejected = counter("tg_updates_rejected_total", "Апдейты, отклоненные из-за переполненной очереди")
+updates_failed = counter("tg_updates_failed_total", "Апдейты, упавшие в обработчике")
+
+class WebhookRunner:
+    # Webhook-приемник: проверяет секрет, кладет апдейт в ограниченную очередь и сразу
+    # отвечает Telegram. Очередь разбирают N воркеров. Если очередь полна дольше
+    # enqueue_timeout — отвечаем 503, и Telegram повторит доставку позже (backpressure).
+    # Без секрета приемник не создается: иначе поддельный апдейт мог бы прислать кто угодно.
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        *,
+        secret_token: str = "",
+        path: str = "/tg/webhook",
+        queue_size: int = 1000,
+        workers: int = 8,
+        enqueue_timeout: float = 1.0,
+    ):
+        if not secret_token:
+            raise ValueError("Для webhook-режима нужен TG_WEBHOOK_SECRET")
+        self.dp = dp
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self._tasks: list[asyncio.Task] = []
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        setup_application(app, self.dp, bot=self.bot)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except (ValueError, ValidationError) as e:
+            logger.warning(f"ТГ Бот: Некорректный апдейт в webhook: {e}")
+            return web.Response(status=400)
+
+        try:
+            await asyncio.wait_for(self.queue.put(update), self.enqueue_timeout)
+        except TimeoutError:
+            updates_rejected.inc()
+            logger.warning(
+                f"ТГ Бот: Очередь апдейтов переполнена ({self.queue.qsize()}), апдейт {update.update_id} отклонен"
+            )
+            return web.Response(status=503)
+        updates_queue_depth.set(self.queue.qsize())
+        return web.Response(status=200)
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            updates_queue_depth.set(self.queue.qsize())
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                updates_failed.inc()
+                logger.error(f"ТГ Бот: Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10.0):
+        # Перед остановкой даем воркерам разобрать уже принятые апдейты
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain_timeout)
+            except TimeoutError:
+                logger.warning(f"ТГ Бот: При остановке в очереди осталось {self.queue.qsize()} апдейтов")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _on_startup(self, app: web.Application):
+        await self.start()
+
+    async def _on_shutdown(self, app: web.Application):
+        await self.stop()
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    # С диспетчером апдейтов воркер только раскладывает апдейты по очередям чатов,
+    # и он должен быть один, чтобы не перепутать порядок сообщений одного чата
+    workers = 1 if settings.BOT_ORDERED_DISPATCH else settings.TG_UPDATE_WORKERS
+    runner = WebhookRunner(
+        dp,
+        bot,
+        secret_token=settings.TG_WEBHOOK_SECRET,
+        path=settings.TG_WEBHOOK_PATH,
+        queue_size=settings.TG_UPDATE_QUEUE_SIZE,
+        workers=workers,
+        enqueue_timeout=settings.TG_ENQUEUE_TIMEOUT,
+    )
+    app_runner = web.AppRunner(runner.build_app())
+    await app_runner.setup()
+    site = web.TCPSite(app_runner, settings.TG_WEBHOOK_HOST, settings.TG_WEBHOOK_PORT)
+    await site.start()
+
+    # Накопившиеся за время рестарта апдейты не сбрасываем
+    await bot.set_webhook(
+        f"{settings.TG_WEBHOOK_URL.rstrip('/')}{settings.TG_WEBHOOK_PATH}",
+        secret_token=settings.TG_WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False,
+    )
+    address = f"{settings.TG_WEBHOOK_HOST}:{settings.TG_WEBHOOK_PORT}{settings.TG_WEBHOOK_PATH}"
+    logger.info(f"ТГ Бот: Webhook слушает {address}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await app_runner.cleanup()
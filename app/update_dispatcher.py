@@ -0,0 +1,216 @@
+import asyncio
+import time
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware, Dispatcher
+
+from app.logger import setup_logger
+from app.metrics import callback_gauge, counter, histogram
+
+logger = setup_logger("update_dispatcher")
+
+# Диспетчер апдейтов ботов: апдейты одного юзера (ключ — chat id / peer id) встают
+# в его очередь и выполняются строго по порядку, очереди разных юзеров работают
+# параллельно. Так обработчик следующего сообщения видит состояние диалога, которое
+# записал предыдущий (process_subject -> process_score), даже если сообщения пришли
+# одной пачкой.
+#
+# Ограничения: одновременно выполняется не больше max_in_flight обработчиков, принятых
+# и не обработанных апдейтов не больше max_pending — дальше submit() ждет, и прием
+# апдейтов (polling / webhook) притормаживает.
+#
+# Повторная доставка апдейта с тем же id отбрасывается. Одинаковые команды только
+# на чтение (/view_scores два раза подряд), еще ждущие в очереди юзера, склеиваются
+# в одну. Ключи раскладываются по shards шардам — для метрики отставания: возраст
+# самого старого ждущего апдейта в шарде.
+
+# Команды без побочных эффектов: повтор, ждущий в очереди за такой же, можно не выполнять
+READ_ONLY_COMMANDS = frozenset({"/start", "Начать", "/view_scores", "/history", "/stats"})
+
+dispatch_lag = histogram("bot_update_lag_seconds", "Ожидание апдейта в очереди юзера до обработчика", ("bot",))
+updates_dropped = counter("bot_updates_dropped_total", "Апдейты, отброшенные диспетчером", ("bot", "reason"))
+updates_failed = counter("bot_updates_failed_total", "Апдейты, упавшие в обработчике", ("bot",))
+
+_dispatchers: "weakref.WeakSet[OrderedDispatcher]" = weakref.WeakSet()
+
+def merge_key(text: str | None) -> str | None:
+    # Ключ склейки для апдейта: одинаковые команды только на чтение
+    if not text:
+        return None
+    command = text.split()[0].split("@")[0]
+    return command if command in READ_ONLY_COMMANDS else None
+
+class _Item:
+    __slots__ = ("enqueued_at", "merge_key", "run", "update_id")
+
+    def __init__(self, run: Callable[[], Awaitable], update_id: Hashable, merge_key: Hashable):
+        self.run = run
+        self.update_id = update_id
+        self.merge_key = merge_key
+        self.enqueued_at = time.monotonic()
+
+class OrderedDispatcher:
+    def __init__(
+        self,
+        name: str,
+        *,
+        max_in_flight: int = 64,
+        max_pending: int = 10000,
+        shards: int = 16,
+        dedup_window: int = 10000,
+    ):
+        self.name = name
+        self.shards = shards
+        self.dedup_window = dedup_window
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._pending = asyncio.Semaphore(max_pending)
+        self._queues: dict[Hashable, deque[_Item]] = {}
+        self._workers: set[asyncio.Task] = set()
+        self._seen: OrderedDict[Hashable, None] = OrderedDict()
+        self.running = self.pending = 0
+        _dispatchers.add(self)
+
+    def shard(self, key: Hashable) -> int:
+        return hash(key) % self.shards
+
+    def _is_duplicate(self, update_id: Hashable) -> bool:
+        if update_id is None:
+            return False
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedup_window:
+            self._seen.popitem(last=False)
+        return False
+
+    async def submit(
+        self,
+        key: Hashable | None,
+        run: Callable[[], Awaitable],
+        *,
+        update_id: Hashable = None,
+        merge_key: Hashable = None,
+    ) -> bool:
+        # Ставит апдейт в очередь ключа; False — апдейт отброшен как повтор или склеен.
+        # Апдейт без ключа (не от юзера) получает свою очередь и ни с кем не упорядочен
+        if self._is_duplicate(update_id):
+            updates_dropped.inc(self.name, "duplicate")
+            return False
+        if key is None:
+            key = object()
+        queue = self._queues.get(key)
+        if merge_key is not None and queue and queue[-1].merge_key == merge_key:
+            updates_dropped.inc(self.name, "merged")
+            return False
+
+        await self._pending.acquire()
+        self.pending += 1
+        item = _Item(run, update_id, merge_key)
+        # Пока ждали места, очередь ключа могла опустеть и закрыться
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            return True
+        self._queues[key] = deque([item])
+        worker = asyncio.create_task(self._drain(key))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+        return True
+
+    async def _drain(self, key: Hashable):
+        # Один воркер на ключ: разбирает его очередь и закрывает ее, когда она пуста
+        queue = self._queues[key]
+        while queue:
+            item = queue[0]
+            async with self._in_flight:
+                queue.popleft()
+                dispatch_lag.observe(time.monotonic() - item.enqueued_at, self.name)
+                self.running += 1
+                try:
+                    await item.run()
+                except Exception as e:
+                    updates_failed.inc(self.name)
+                    logger.error(f"{self.name}: Ошибка обработки апдейта {item.update_id}: {e}")
+                finally:
+                    self.running -= 1
+                    self.pending -= 1
+                    self._pending.release()
+        del self._queues[key]
+
+    def shard_lag(self) -> dict[int, float]:
+        # Возраст самого старого ждущего апдейта по шардам, с
+        now = time.monotonic()
+        lag = dict.fromkeys(range(self.shards), 0.0)
+        for key, queue in self._queues.items():
+            if queue:
+                shard = self.shard(key)
+                lag[shard] = max(lag[shard], now - queue[0].enqueued_at)
+        return lag
+
+    async def close(self, timeout: float = 10.0):
+        # Дожидаемся уже принятых апдейтов перед остановкой
+        if not self._workers:
+            return
+        done, pending = await asyncio.wait(set(self._workers), timeout=timeout)
+        if pending:
+            logger.warning(f"{self.name}: При остановке не обработано {self.pending} апдейтов")
+            for worker in pending:
+                worker.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "running": self.running,
+            "keys": len(self._queues),
+            "max_lag_s": round(max(self.shard_lag().values(), default=0.0), 3),
+        }
+
+def _shard_lags() -> dict[tuple, float]:
+    return {
+        (dispatcher.name, shard): round(lag, 3)
+        for dispatcher in _dispatchers
+        for shard, lag in dispatcher.shard_lag().items()
+    }
+
+callback_gauge(
+    "bot_dispatch_shard_lag_seconds",
+    "Возраст самого старого ждущего апдейта в шарде",
+    _shard_lags,
+    labelnames=("bot", "shard"),
+)
+callback_gauge(
+    "bot_dispatch_pending",
+    "Принятые и не обработанные апдейты ботов",
+    lambda: {(dispatcher.name,): dispatcher.pending for dispatcher in _dispatchers},
+    labelnames=("bot",),
+)
+
+class OrderedUpdateMiddleware(BaseMiddleware):
+    # Для aiogram: отдает остаток цепочки dp.update (FSM, фильтры, обработчик) в очередь
+    # чата. feed_update при этом возвращается сразу, поэтому polling запускается с
+    # handle_as_tasks=False — порядок приема апдейтов и есть порядок в очередях
+    def __init__(self, dispatcher: OrderedDispatcher):
+        self.dispatcher = dispatcher
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat is not None else user.id if user is not None else None
+        message = getattr(event, "message", None)
+        await self.dispatcher.submit(
+            key,
+            lambda: handler(event, data),
+            update_id=event.update_id,
+            merge_key=merge_key(message.text if message is not None else None),
+        )
+
+def setup_ordered_dispatch(dp: Dispatcher, dispatcher: OrderedDispatcher):
+    # Встроенный FSM-middleware читает состояние чата до обработчика, поэтому он должен
+    # работать уже внутри очереди: ставим его после нашего. Ключ очереди берем из
+    # event_chat, его выставляет UserContextMiddleware, он остается первым
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(OrderedUpdateMiddleware(dispatcher))
+    dp.update.outer_middleware(dp.fsm)
@@ -1,14 +1,79 @@
-import httpx
-from vkbottle import BaseStateGroup, CtxStorage
+import time
+from functools import partial
+
+from vkbottle import ABCPolling, BaseMiddleware, BaseStateGroup
 from vkbottle.bot import Bot, Message
 
+from app.api_client import ApiError
+from app.backend import backend
 from app.config import settings
-from app.logger import setup_logger
+from app.conversation_store import ConversationStore
+from app.logger import sampled, setup_logger
+from app.metrics import callback_gauge, histogram, start_metrics_server
+from app.schemas import SCORE_MAX
+from app.update_dispatcher import OrderedDispatcher, merge_key
 
 logger = setup_logger("vk_bot")
+msg_logger = sampled(logger)
+
+handler_latency = histogram("bot_handler_duration_seconds", "Время работы обработчиков бота", ("bot", "handler"))
+
+class HandlerMetricsMiddleware(BaseMiddleware[Message]):
+    async def pre(self):
+        self.start = time.perf_counter()
+
+    async def post(self):
+        elapsed = time.perf_counter() - self.start
+        for handler in self.handlers:
+            name = getattr(getattr(handler, "handler", None), "__name__", type(handler).__name__)
+            handler_latency.observe(elapsed, "vk", name)
+
+conversations = ConversationStore(
+    max_entries=settings.VK_STATE_MAX_ENTRIES, ttl=settings.VK_STATE_TTL, path=settings.VK_STATE_FILE
+)
+callback_gauge("vk_conversations", "Незавершенные диалоги VK-бота", lambda: conversations.stats()["entries"])
+callback_gauge("vk_conversations_memory_bytes", "Оценка памяти под диалоги VK-бота", conversations.memory_bytes)
+callback_gauge(
+    "vk_conversations_expired_total", "Диалоги VK-бота, удаленные по TTL", lambda: conversations.expired, "counter"
+)
+callback_gauge(
+    "vk_conversations_evicted_total", "Диалоги VK-бота, вытесненные по лимиту", lambda: conversations.evicted, "counter"
+)
+
+class OrderedBot(Bot):
+    # Polling vkbottle запускает задачу на каждое событие, и два сообщения юзера могут
+    # обогнать друг друга в диалоге. Здесь события раскладываются по очередям peer_id
+    def __init__(self, *args, update_dispatcher: OrderedDispatcher | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_dispatcher = update_dispatcher
+
+    async def run_polling(self, custom_polling: ABCPolling | None = None):
+        if self.update_dispatcher is None:
+            return await super().run_polling(custom_polling)
+        polling = custom_polling or self.polling
+        async for event in polling.listen():
+            for update in event.get("updates", []):
+                obj = update.get("object") or {}
+                message = obj.get("message") or {}
+                await self.update_dispatcher.submit(
+                    message.get("peer_id") or obj.get("peer_id") or obj.get("user_id"),
+                    partial(self.process_event, update, polling.api),
+                    update_id=update.get("event_id"),
+                    merge_key=merge_key(message.get("text")),
+                )
+
+update_dispatcher = None
+if settings.BOT_ORDERED_DISPATCH:
+    update_dispatcher = OrderedDispatcher(
+        "vk",
+        max_in_flight=settings.BOT_MAX_IN_FLIGHT,
+        max_pending=settings.BOT_MAX_PENDING,
+        shards=settings.BOT_DISPATCH_SHARDS,
+        dedup_window=settings.BOT_DEDUP_WINDOW,
+    )
 
-bot = Bot(token=settings.VK_TOKEN)
-ctx_storage = CtxStorage()
+bot = OrderedBot(token=settings.VK_TOKEN, state_dispenser=conversations, update_dispatcher=update_dispatcher)
+bot.labeler.message_view.register_middleware(HandlerMetricsMiddleware)
 
 class RegisterState(BaseStateGroup):
     NAME = 0
@@ -19,25 +84,27 @@ class ScoreState(BaseStateGroup):
 
 @bot.on.private_message(text=["/start", "Начать"])
 async def start_handler(message: Message):
-    logger.info(f"ВК Бот: Юзер {message.from_id} вызвал /start")
+    msg_logger.info(f"ВК Бот: Юзер {message.from_id} вызвал /start")
     await message.answer(
         "Привет! Это ЕГЭ Трекер.\n"
         "Команды:\n"
         "/register - Регистрация\n"
         "/enter_scores - Ввести баллы\n"
-        "/view_scores - Мои баллы"
+        "/view_scores - Мои баллы\n"
+        "/history - Динамика баллов\n"
+        "/stats - Мое место среди учеников"
     )
 
 # Регистрация
 @bot.on.private_message(text="/register")
 async def register_start(message: Message):
-    logger.info(f"ВК Бот: Юзер {message.from_id} начал регистрацию")
+    msg_logger.info(f"ВК Бот: Юзер {message.from_id} начал регистрацию")
     await message.answer("Введите Имя и Фамилию:")
     await bot.state_dispenser.set(message.peer_id, RegisterState.NAME)
 
 @bot.on.private_message(state=RegisterState.NAME)
 async def register_process(message: Message):
-    logger.info(f"ВК Бот: Юзер {message.from_id} ввел данные для регистрации: {message.text}")
+    msg_logger.info(f"ВК Бот: Юзер {message.from_id} ввел данные для регистрации: {message.text}")
     parts = message.text.split()
     if len(parts) < 2:
         logger.warning(f"ВК Бот: Неверный формат имени от {message.from_id}")
@@ -47,63 +114,57 @@ async def register_process(message: Message):
     first_name, last_name = parts[0], parts[1]
     vk_id = message.from_id
 
-    async with httpx.AsyncClient() as client:
-        payload = {"telegram_id": vk_id, "first_name": first_name, "last_name": last_name}
-        try:
-            logger.info(f"ВК Бот: Отправка запроса в API для регистрации {vk_id}")
-            resp = await client.post(f"{settings.API_BASE_URL}/users/", json=payload)
-            if resp.status_code == 200:
-                logger.info(f"ВК Бот: Юзер {vk_id} успешно зарегистрирован")
-                await message.answer(f"Ученик {first_name} {last_name} зарегистрирован!")
-            else:
-                logger.error(f"ВК Бот: Ошибка API {resp.status_code} при регистрации {vk_id}")
-                await message.answer("Ошибка регистрации.")
-        except Exception as e:
-            logger.error(f"ВК Бот: Ошибка соединения с API: {e}")
-            await message.answer("Ошибка соединения с сервером.")
+    try:
+        msg_logger.info(f"ВК Бот: Отправка запроса в API для регистрации {vk_id}")
+        await backend.register_user(vk_id, first_name, last_name, platform="vk")
+        msg_logger.info(f"ВК Бот: Юзер {vk_id} успешно зарегистрирован")
+        await message.answer(f"Ученик {first_name} {last_name} зарегистрирован!")
+    except ApiError as e:
+        logger.error(f"ВК Бот: Ошибка API {e.status_code} при регистрации {vk_id}")
+        await message.answer("Ошибка регистрации.")
+    except Exception as e:
+        logger.error(f"ВК Бот: Ошибка соединения с API: {e}")
+        await message.answer("Ошибка соединения с сервером.")
 
     await bot.state_dispenser.delete(message.peer_id)
 
 # Ввод баллов
 @bot.on.private_message(text="/enter_scores")
 async def enter_scores_start(message: Message):
-    logger.info(f"ВК Бот: Юзер {message.from_id} начал ввод баллов")
+    msg_logger.info(f"ВК Бот: Юзер {message.from_id} начал ввод баллов")
     await message.answer("Напишите название предмета (например: Математика):")
     await bot.state_dispenser.set(message.peer_id, ScoreState.SUBJECT)
 
 @bot.on.private_message(state=ScoreState.SUBJECT)
 async def enter_scores_subject(message: Message):
-    logger.info(f"ВК Бот: Юзер {message.from_id} выбрал предмет: {message.text}")
-    ctx_storage.set(f"{message.peer_id}_subject", message.text)
+    msg_logger.info(f"ВК Бот: Юзер {message.from_id} выбрал предмет: {message.text}")
     await message.answer("Теперь введите балл (число):")
-    await bot.state_dispenser.set(message.peer_id, ScoreState.SCORE)
+    await bot.state_dispenser.set(message.peer_id, ScoreState.SCORE, subject=message.text)
 
 @bot.on.private_message(state=ScoreState.SCORE)
 async def enter_scores_value(message: Message):
-    if not message.text.isdigit():
-        logger.warning(f"ВК Бот: Юзер {message.from_id} ввел не число в баллах: {message.text}")
-        await message.answer("Введите число!")
+    if not message.text.isdigit() or int(message.text) > SCORE_MAX:
+        logger.warning(f"ВК Бот: Юзер {message.from_id} ввел некорректные баллы: {message.text}")
+        await message.answer(f"Введите число от 0 до {SCORE_MAX}!")
         return
 
     score = int(message.text)
-    subject = ctx_storage.get(f"{message.peer_id}_subject")
+    subject = message.state_peer.payload["subject"]
     vk_id = message.from_id
 
-    async with httpx.AsyncClient() as client:
-        payload = {"telegram_id": vk_id, "subject": subject, "score": score}
-        try:
-            logger.info(f"ВК Бот: Отправка баллов в API для {vk_id} ({subject}: {score})")
-            resp = await client.post(f"{settings.API_BASE_URL}/scores/", json=payload)
-            if resp.status_code == 200:
-                logger.info(f"ВК Бот: Баллы для {vk_id} сохранены успешно")
-                await message.answer(f"Сохранено: {subject} - {score}")
-            elif resp.status_code == 404:
-                logger.warning(f"ВК Бот: Юзер {vk_id} пытался ввести баллы без регистрации")
-                await message.answer("Сначала зарегистрируйтесь! (/register)")
-            else:
-                logger.error(f"ВК Бот: API вернул код {resp.status_code} при вводе баллов")
-        except Exception as e:
-            logger.error(f"ВК Бот: Ошибка API при вводе баллов: {e}")
+    try:
+        msg_logger.info(f"ВК Бот: Отправка баллов в API для {vk_id} ({subject}: {score})")
+        result = await backend.add_score(vk_id, subject, score)
+        if result is not None:
+            msg_logger.info(f"ВК Бот: Баллы для {vk_id} сохранены успешно")
+            await message.answer(f"Сохранено: {subject} - {score}")
+        else:
+            logger.warning(f"ВК Бот: Юзер {vk_id} пытался ввести баллы без регистрации")
+            await message.answer("Сначала зарегистрируйтесь! (/register)")
+    except ApiError as e:
+        logger.error(f"ВК Бот: API вернул код {e.status_code} при вводе баллов")
+    except Exception as e:
+        logger.error(f"ВК Бот: Ошибка API при вводе баллов: {e}")
 
     await bot.state_dispenser.delete(message.peer_id)
 
@@ -111,23 +172,72 @@ async def enter_scores_value(message: Message):
 @bot.on.private_message(text="/view_scores")
 async def view_scores(message: Message):
     vk_id = message.from_id
-    logger.info(f"ВК Бот: Юзер {vk_id} запросил просмотр баллов")
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.get(f"{settings.API_BASE_URL}/scores/{vk_id}")
-            if resp.status_code == 200:
-                scores = resp.json()
-                logger.info(f"ВК Бот: Получено {len(scores)} записей для {vk_id}")
-                if not scores:
-                    await message.answer("Баллов нет.")
-                    return
-                text = "\n".join([f"{s['subject']}: {s['score']}" for s in scores])
-                await message.answer(f"Ваши баллы:\n{text}")
-            else:
-                logger.error(f"ВК Бот: API вернул код {resp.status_code} при просмотре баллов")
-                await message.answer("Не удалось получить данные.")
-        except Exception as e:
-            logger.error(f"ВК Бот: Ошибка при просмотре баллов: {e}")
+    msg_logger.info(f"ВК Бот: Юзер {vk_id} запросил просмотр баллов")
+    try:
+        scores = await backend.get_scores(vk_id)
+        msg_logger.info(f"ВК Бот: Получено {len(scores)} записей для {vk_id}")
+        if not scores:
+            await message.answer("Баллов нет.")
+            return
+        text = "\n".join([f"{s.subject}: {s.score}" for s in scores])
+        await message.answer(f"Ваши баллы:\n{text}")
+    except ApiError as e:
+        logger.error(f"ВК Бот: API вернул код {e.status_code} при просмотре баллов")
+        await message.answer("Не удалось получить данные.")
+    except Exception as e:
+        logger.error(f"ВК Бот: Ошибка при просмотре баллов: {e}")
+
+# Статистика
+@bot.on.private_message(text="/stats")
+async def stats_handler(message: Message):
+    vk_id = message.from_id
+    msg_logger.info(f"ВК Бот: Юзер {vk_id} запросил статистику")
+    try:
+        stats = await backend.get_stats(vk_id)
+        if not stats:
+            await message.answer("Баллов нет.")
+            return
+        text = "\n".join(
+            f"{s.subject}: {s.score} — место {s.rank} из {s.total} (средний {s.mean}, медиана {s.median})"
+            for s in stats
+        )
+        await message.answer(f"Ваше место по предметам:\n{text}")
+    except ApiError as e:
+        logger.error(f"ВК Бот: API вернул код {e.status_code} при запросе статистики")
+        await message.answer("Не удалось получить данные.")
+    except Exception as e:
+        logger.error(f"ВК Бот: Ошибка при запросе статистики: {e}")
+
+# Динамика баллов
+@bot.on.private_message(text="/history")
+async def history_handler(message: Message):
+    vk_id = message.from_id
+    msg_logger.info(f"ВК Бот: Юзер {vk_id} запросил динамику баллов")
+    try:
+        trends = await backend.get_trends(vk_id)
+        if not trends:
+            await message.answer("Баллов нет.")
+            return
+        lines = []
+        for trend in trends:
+            line = f"{trend.subject}: {' → '.join(map(str, trend.scores))}"
+            if len(trend.scores) > 1:
+                line += f" ({trend.scores[-1] - trend.scores[0]:+d})"
+            lines.append(line)
+        await message.answer("Динамика по предметам:\n" + "\n".join(lines))
+    except ApiError as e:
+        logger.error(f"ВК Бот: API вернул код {e.status_code} при запросе динамики")
+        await message.answer("Не удалось получить данные.")
+    except Exception as e:
+        logger.error(f"ВК Бот: Ошибка при запросе динамики: {e}")
+
 if __name__ == "__main__":
     logger.info("ВК Бот: Запуск бота...")
+    bot.loop_wrapper.on_startup.append(start_metrics_server(settings.BOT_METRICS_PORT))
+    bot.loop_wrapper.on_startup.append(backend.start(warmup_connections=settings.API_WARMUP_CONNECTIONS))
+    bot.loop_wrapper.on_startup.append(conversations.start(settings.VK_STATE_SNAPSHOT_INTERVAL))
+    if update_dispatcher is not None:
+        bot.loop_wrapper.on_shutdown.append(update_dispatcher.close())
+    bot.loop_wrapper.on_shutdown.append(conversations.close())
+    bot.loop_wrapper.on_shutdown.append(backend.close())
     bot.run_forever()
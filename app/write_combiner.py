@@ -0,0 +1,110 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import crud
+from app.logger import setup_logger
+from app.metrics import counter, histogram
+from app.schemas import ScoreCreate
+from app.subjects import subject_cache
+
+logger = setup_logger("write_combiner")
+
+score_write_batch_size = histogram(
+    "score_write_batch_size", "Записей баллов в пачке склейки записи", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500)
+)
+score_write_flush_latency = histogram("score_write_flush_seconds", "Время записи одной пачки баллов")
+score_writes_collapsed = counter(
+    "score_writes_collapsed_total", "Записи баллов, перекрытые более поздней в той же пачке"
+)
+
+# Склейка конкурентных POST /scores/: записи копятся не дольше window секунд или до
+# max_batch уникальных (юзер, предмет), затем пачка уходит одним multi-row upsert
+# в одной транзакции (crud.bulk_upsert_scores). Повтор того же (юзер, предмет) в
+# пачке заменяет предыдущий в scores, а в историю попадают обе попытки — как если бы
+# записи выполнились по очереди. Каждый вызывающий получает свой результат:
+# сохранено или юзер не найден.
+
+class ScoreWriteCombiner:
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        *,
+        window: float = 0.005,
+        max_batch: int = 500,
+        flush_concurrency: int = 4,
+    ):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._semaphore = asyncio.Semaphore(flush_concurrency)
+        self._pending: list[ScoreCreate] = []
+        self._keys: set[tuple[int, str]] = set()
+        self._waiters: list[tuple[int, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+        self._in_flight = 0
+
+    @property
+    def queue_depth(self) -> int:
+        # Вызовы, ждущие записи: в текущей пачке и в уже отправленных
+        return len(self._waiters) + self._in_flight
+
+    async def submit(self, score_in: ScoreCreate) -> bool:
+        # True — балл сохранен, False — юзер не зарегистрирован
+        future = asyncio.get_running_loop().create_future()
+        key = (score_in.telegram_id, subject_cache.key(score_in.subject))
+        if key in self._keys:
+            score_writes_collapsed.inc()
+        self._keys.add(key)
+        self._pending.append(score_in)
+        self._waiters.append((score_in.telegram_id, future))
+        if len(self._keys) >= self.max_batch:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush_now)
+        return await future
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._waiters:
+            return
+        batch, waiters = self._pending, self._waiters
+        self._pending, self._keys, self._waiters = [], set(), []
+        self._in_flight += len(waiters)
+        task = asyncio.create_task(self._flush(batch, waiters))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: list[ScoreCreate], waiters: list[tuple[int, asyncio.Future]]):
+        # Строки пачки в порядке ключа: параллельные пачки берут блокировки в одном порядке.
+        # Сортировка устойчивая, повторы одного ключа остаются в порядке отправки
+        batch.sort(key=lambda item: (item.telegram_id, subject_cache.key(item.subject)))
+        score_write_batch_size.observe(len(batch))
+        try:
+            async with self._semaphore:
+                with score_write_flush_latency.time():
+                    async with self.session_factory() as db:
+                        not_found = await crud.bulk_upsert_scores(db, batch)
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки из {len(batch)} баллов: {e}")
+            for _, future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._in_flight -= len(waiters)
+        for telegram_id, future in waiters:
+            if not future.done():
+                future.set_result(telegram_id not in not_found)
+
+    async def close(self):
+        # Дописываем накопленное перед остановкой
+        self._flush_now()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"queue_depth": self.queue_depth, "pending": len(self._keys), "flushes": len(self._flushes)}
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import os
+import socket
+import tempfile
+
+import uvicorn
+
+from app.api import app
+from app.api_client import ApiClient
+from app.backend import EmbeddedBackend
+from app.cache import scores_cache, user_id_cache
+from app.database import get_db
+from benchmarks.harness import (
+    StatementCounter,
+    compare,
+    make_engine,
+    reset_schema,
+    run_metadata,
+    run_scenario,
+    sessionmaker,
+    write_results,
+)
+
+# Сравнение задержки команд бота в двух режимах: http (ApiClient -> uvicorn app.api:app по TCP)
+# и embedded (EmbeddedBackend -> crud в том же процессе). Обе ветки работают с одной БД.
+#
+#   python -m benchmarks.bench_backends --requests 2000 --concurrency 20 --out backends.json
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def bench_backend(name: str, backend, args, counter: StatementCounter, id_base: int) -> dict:
+    await scores_cache.clear()
+    user_id_cache.clear()
+    results = {}
+
+    async def register(i):
+        await backend.register_user(id_base + i, "Bench", str(i))
+        return True
+
+    async def add_score(i):
+        return await backend.add_score(id_base + i, "Математика", i % 101) is not None
+
+    async def get_scores(i):
+        return len(await backend.get_scores(id_base + i)) == 1
+
+    for command, make_request in (("register", register), ("add_score", add_score), ("get_scores", get_scores)):
+        results[f"{name}_{command}"] = await run_scenario(
+            f"{name}_{command}", args.requests, args.concurrency, make_request, counter
+        )
+    return results
+
+async def run(args) -> dict:
+    db_url = args.db or f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = make_engine(db_url)
+    await reset_schema(engine)
+    session_factory = sessionmaker(engine)
+    counter = StatementCounter(engine)
+
+    async def override_get_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    scenarios = {}
+    http = ApiClient(f"http://127.0.0.1:{port}", max_connections=args.concurrency)
+    await http.start(warmup_connections=args.concurrency)
+    scenarios.update(await bench_backend("http", http, args, counter, id_base=1_000_000))
+    await http.close()
+
+    embedded = EmbeddedBackend(session_factory)
+    scenarios.update(await bench_backend("embedded", embedded, args, counter, id_base=2_000_000))
+
+    server.should_exit = True
+    await server_task
+    app.dependency_overrides.clear()
+    await engine.dispose()
+    return {
+        "meta": run_metadata(
+            benchmark="backends", db=engine.dialect.name, requests=args.requests, concurrency=args.concurrency
+        ),
+        "scenarios": scenarios,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк режимов бота: http против embedded")
+    parser.add_argument("--db", help="URL БД (по умолчанию временный SQLite-файл)")
+    parser.add_argument("--requests", type=int, default=1000, help="Команд на сценарий")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--out", help="Файл для JSON с результатами")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    write_results(args.out, results)
+    if args.baseline:
+        compare(args.baseline, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import uvicorn
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from app import bot_tg, vk_bot
+from app.api import app
+from app.api_client import ApiClient
+from app.backend import EmbeddedBackend
+from app.cache import scores_cache, user_id_cache
+from app.config import settings
+from app.database import get_db
+from app.metrics import registry
+from app.subjects import subject_cache
+from benchmarks.bench_backends import free_port
+from benchmarks.fake_platforms import FakePlatform, FakeTelegramAPI, FakeVKAPI
+from benchmarks.harness import compare, make_engine, percentile, reset_schema, run_metadata, sessionmaker, write_results
+
+# Сквозной нагрузочный прогон ботов: фейковые Telegram Bot API и VK API на localhost,
+# настоящие обработчики app.bot_tg и app.vk_bot (с FSM в той же БД), настоящий
+# app.api на uvicorn и SQLite. Каждый виртуальный юзер проходит сценарий
+# /register -> /enter_scores (несколько предметов) -> /view_scores, юзеры стартуют
+# с заданной частотой.
+#
+#   python -m benchmarks.bench_bots --users 200 --rate 50 --out bots.json
+#   python -m benchmarks.bench_bots --platforms tg --backend embedded
+#
+# Задержка — от появления сообщения в long polling до ответа бота в фейковый API.
+# Юзер отвечает не мгновенно (--think-time): бот отвечает до того, как состояние FSM
+# записано в конце апдейта, и без диспетчера апдейтов (BOT_ORDERED_DISPATCH=false)
+# следующее сообщение может его обогнать.
+# Модули ботов создают Bot при импорте, поэтому BOT_TOKEN должен быть правдоподобным
+# (например, BOT_TOKEN=42:SIM), в сеть запросы не уходят.
+
+TG_TOKEN = "42:SIM"
+VK_USER_ID_BASE = 10_000_000
+SUBJECTS = ["Математика", "Физика", "Информатика"]
+
+def conversation(user_index: int, subjects: int) -> list[tuple[str, str]]:
+    # (сообщение юзера, подстрока, которую должен содержать ответ)
+    steps = [("/register", "Имя"), (f"Sim User{user_index}", "зарегистрирован")]
+    for i in range(subjects):
+        subject = SUBJECTS[(user_index + i) % len(SUBJECTS)]
+        score = (user_index * 7 + i) % 101
+        steps += [("/enter_scores", "предмет"), (subject, "балл"), (str(score), subject)]
+    steps.append(("/view_scores", "Ваши баллы"))
+    return steps
+
+class PlatformReport:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: list[float] = []
+        self.errors = self.timeouts = self.conversations = 0
+
+    async def run_user(self, platform: FakePlatform, user_id: int, user_index: int, args):
+        for step, (text, expected) in enumerate(conversation(user_index, args.subjects)):
+            if step and args.think_time:
+                await asyncio.sleep(args.think_time)
+            start = time.perf_counter()
+            try:
+                reply = await platform.say(user_id, text, timeout=args.timeout)
+            except TimeoutError:
+                self.timeouts += 1
+                return
+            self.latencies.append(time.perf_counter() - start)
+            if expected not in reply:
+                self.errors += 1
+                return
+        self.conversations += 1
+
+    def summary(self, duration: float, handler_calls: int) -> dict:
+        latencies = sorted(self.latencies)
+        result = {
+            "conversations": self.conversations,
+            "messages": len(latencies),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "duration_s": round(duration, 3),
+            "rps": round(len(latencies) / duration, 1) if duration else 0.0,
+            "handler_calls_per_s": round(handler_calls / duration, 1) if duration else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+        print(
+            f"{self.name:<4} {result['conversations']:>6} диалогов  {result['rps']:>8} сообщ/с  "
+            f"p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  p99 {result['p99_ms']:>8} ms  "
+            f"ошибок {self.errors}, таймаутов {self.timeouts}",
+            flush=True,
+        )
+        return result
+
+def handler_calls(bot_name: str) -> int:
+    # Сколько раз отработали обработчики бота — bot_handler_duration_seconds_count из вывода /metrics
+    calls = 0
+    for line in registry.render().splitlines():
+        sample, _, value = line.rpartition(" ")
+        if sample.startswith("bot_handler_duration_seconds_count{") and f'bot="{bot_name}"' in sample:
+            calls += int(float(value))
+    return calls
+
+async def drive(name: str, platform: FakePlatform, id_base: int, args) -> dict:
+    report = PlatformReport(name)
+    calls_before = handler_calls(name)
+    started = time.perf_counter()
+    tasks = []
+    for i in range(args.users):
+        # Юзеры приходят равномерно с частотой --rate в секунду
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(report.run_user(platform, id_base + i, i, args)))
+    await asyncio.gather(*tasks)
+    return report.summary(time.perf_counter() - started, handler_calls(name) - calls_before)
+
+async def run(args) -> dict:
+    db_url = args.db or f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = make_engine(db_url)
+    await reset_schema(engine)
+    session_factory = sessionmaker(engine)
+
+    async def override_get_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    await scores_cache.clear()
+    user_id_cache.clear()
+    subject_cache.clear()
+
+    server = None
+    if args.backend == "embedded":
+        backend = EmbeddedBackend(session_factory)
+    else:
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        backend = ApiClient(f"http://127.0.0.1:{port}", max_connections=args.api_connections)
+    # Обработчики ботов берут backend из своего модуля
+    bot_tg.backend = vk_bot.backend = backend
+    if bot_tg.fsm_storage is not None:
+        bot_tg.fsm_storage.engine = engine
+
+    scenarios = {}
+    if "tg" in args.platforms:
+        fake_tg = FakeTelegramAPI()
+        await fake_tg.start()
+        tg = Bot(TG_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(fake_tg.url)))
+        bot_tg.dp.include_router(bot_tg.router)
+        polling = asyncio.create_task(
+            bot_tg.dp.start_polling(
+                tg, handle_signals=False, polling_timeout=1, handle_as_tasks=bot_tg.update_dispatcher is None
+            )
+        )
+        scenarios["tg"] = await drive("tg", fake_tg, 1, args)
+        await bot_tg.dp.stop_polling()
+        await polling
+        if bot_tg.update_dispatcher is not None:
+            await bot_tg.update_dispatcher.close()
+        await fake_tg.close()
+
+    if "vk" in args.platforms:
+        fake_vk = FakeVKAPI()
+        await fake_vk.start()
+        vk_bot.bot.api.API_URL = f"{fake_vk.url}/method/"
+        vk_polling = vk_bot.bot.polling
+        # Номер последнего события фейкового сервера на диск не сохраняем
+        vk_polling.save_server_ts = lambda server: None
+        vk_polling.wait = 1
+        polling = asyncio.create_task(vk_bot.bot.run_polling(custom_polling=vk_polling))
+        scenarios["vk"] = await drive("vk", fake_vk, VK_USER_ID_BASE, args)
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        if vk_bot.update_dispatcher is not None:
+            await vk_bot.update_dispatcher.close()
+        await vk_bot.bot.api.http_client.close()
+        await fake_vk.close()
+
+    await backend.close()
+    if server is not None:
+        server.should_exit = True
+        await server_task
+    app.dependency_overrides.clear()
+    await engine.dispose()
+    return {
+        "meta": run_metadata(
+            benchmark="bots",
+            db=engine.dialect.name,
+            backend=args.backend,
+            users=args.users,
+            rate=args.rate,
+            subjects=args.subjects,
+            ordered_dispatch=settings.BOT_ORDERED_DISPATCH,
+        ),
+        "scenarios": scenarios,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон ботов через фейковые Telegram и VK API")
+    parser.add_argument("--db", help="URL БД (по умолчанию временный SQLite-файл)")
+    parser.add_argument("--platforms", nargs="+", choices=["tg", "vk"], default=["tg", "vk"])
+    parser.add_argument("--backend", choices=["http", "embedded"], default="http")
+    parser.add_argument("--users", type=int, default=100, help="Виртуальных юзеров на платформу")
+    parser.add_argument("--rate", type=float, default=20.0, help="Новых юзеров в секунду")
+    parser.add_argument("--subjects", type=int, default=2, help="Предметов в сценарии ввода баллов")
+    parser.add_argument(
+        "--think-time", type=float, default=0.2, help="Пауза юзера перед следующим сообщением, с (в задержку не входит)"
+    )
+    parser.add_argument("--timeout", type=float, default=10.0, help="Сколько ждать ответа бота, с")
+    parser.add_argument("--api-connections", type=int, default=100)
+    parser.add_argument("--out", help="Файл для JSON с результатами")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    write_results(args.out, results)
+    if args.baseline:
+        compare(args.baseline, results)
+
+if __name__ == "__main__":
+    main()
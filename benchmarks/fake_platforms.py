@@ -0,0 +1,186 @@
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+# Локальные фейковые Telegram Bot API и VK API для нагрузочного прогона ботов.
+# Сервер отдает ботам "входящие" сообщения через long polling (getUpdates / Bots Long Poll)
+# и принимает их ответы (sendMessage / messages.send). Драйвер пишет от имени юзера
+# через say() и ждет ответа бота в этот чат.
+#
+# aiogram: Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base(fake.url)))
+# vkbottle: bot.api.API_URL = f"{fake.url}/method/"
+
+class FakePlatform:
+    def __init__(self):
+        self.url = ""
+        self.received = 0
+        self._updates: list[dict] = []
+        self._new_updates = asyncio.Event()
+        self._replies: dict[int, asyncio.Queue[str]] = {}
+        self._message_ids = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+
+    def build_app(self) -> web.Application:
+        raise NotImplementedError
+
+    def make_update(self, user_id: int, text: str) -> dict:
+        raise NotImplementedError
+
+    async def say(self, user_id: int, text: str, timeout: float = 10.0) -> str:
+        # Сообщение от юзера боту; возвращает первый ответ бота в этот чат
+        queue = self._replies.setdefault(user_id, asyncio.Queue())
+        self._updates.append(self.make_update(user_id, text))
+        self._new_updates.set()
+        return await asyncio.wait_for(queue.get(), timeout)
+
+    def reply(self, chat_id: int, text: str):
+        self.received += 1
+        self._replies.setdefault(chat_id, asyncio.Queue()).put_nowait(text)
+
+    async def wait_updates(self, timeout: float) -> list[dict]:
+        # Long polling: отдаем накопившееся или ждем первого апдейта не дольше timeout
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except TimeoutError:
+                return []
+        updates, self._updates = self._updates, []
+        return updates
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+class FakeTelegramAPI(FakePlatform):
+    def __init__(self):
+        super().__init__()
+        self._update_ids = itertools.count(1)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def make_update(self, user_id: int, text: str) -> dict:
+        user = {"id": user_id, "is_bot": False, "first_name": "Sim"}
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": text,
+            },
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Sim", "username": "sim_bot"}
+        elif method == "getUpdates":
+            # Подтвержденные апдейты (offset) уже удалены из очереди в wait_updates
+            result = await self.wait_updates(float(data.get("timeout", 0)))
+        elif method == "sendMessage":
+            chat_id = int(data["chat_id"])
+            self.reply(chat_id, data["text"])
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data["text"],
+            }
+        elif method in ("deleteWebhook", "setMyCommands", "close"):
+            result = True
+        else:
+            return web.json_response(
+                {"ok": False, "error_code": 404, "description": f"Not Found: method {method} not found"}, status=404
+            )
+        return web.json_response({"ok": True, "result": result})
+
+class FakeVKAPI(FakePlatform):
+    GROUP_ID = 1
+
+    def __init__(self):
+        super().__init__()
+        self._ts = itertools.count(1)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/method/{method}", self.handle)
+        app.router.add_post("/longpoll", self.longpoll)
+        return app
+
+    def make_update(self, user_id: int, text: str) -> dict:
+        message_id = next(self._message_ids)
+        return {
+            "group_id": self.GROUP_ID,
+            "type": "message_new",
+            "event_id": f"sim{message_id}",
+            "v": "5.199",
+            "object": {
+                "message": {
+                    "id": message_id,
+                    "conversation_message_id": message_id,
+                    "date": int(time.time()),
+                    "from_id": user_id,
+                    "peer_id": user_id,
+                    "out": 0,
+                    "version": message_id,
+                    "text": text,
+                    "attachments": [],
+                    "fwd_messages": [],
+                    "important": False,
+                    "is_hidden": False,
+                    "random_id": 0,
+                },
+                "client_info": {
+                    "button_actions": ["text"],
+                    "keyboard": True,
+                    "inline_keyboard": True,
+                    "carousel": False,
+                    "lang_id": 0,
+                },
+            },
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if method == "groups.getById":
+            response = {
+                "groups": [{"id": self.GROUP_ID, "name": "Sim", "screen_name": "sim", "type": "group", "is_closed": 0}],
+                "profiles": [],
+            }
+        elif method == "groups.getLongPollServer":
+            response = {"key": "sim", "server": f"{self.url}/longpoll", "ts": str(next(self._ts))}
+        elif method == "messages.send":
+            response = []
+            for peer_id in str(data.get("peer_ids") or data.get("peer_id")).split(","):
+                self.reply(int(peer_id), data.get("message", ""))
+                message_id = next(self._message_ids)
+                response.append(
+                    {"peer_id": int(peer_id), "message_id": message_id, "conversation_message_id": message_id}
+                )
+        else:
+            error = {"error_code": 3, "error_msg": f"Unknown method passed: {method}", "request_params": []}
+            return web.Response(text=json.dumps({"error": error}), content_type="application/json")
+        return web.Response(text=json.dumps({"response": response}), content_type="application/json")
+
+    async def longpoll(self, request: web.Request) -> web.Response:
+        updates = await self.wait_updates(float(request.query.get("wait", 25)))
+        return web.json_response({"ts": str(next(self._ts)), "updates": updates})
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import platform
+import subprocess
+import time
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from app.database import Base
+
+# Общие утилиты бенчмарков: движок БД, подсчет SQL-запросов, прогон сценария
+# с заданной конкурентностью и сводка латентностей в JSON.
+
+def make_engine(url: str) -> AsyncEngine:
+    if url.startswith("sqlite"):
+        return create_async_engine(url, connect_args={"timeout": 30})
+    return create_async_engine(url, pool_size=20, max_overflow=20)
+
+async def reset_schema(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+def sessionmaker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+class StatementCounter:
+    def __init__(self, engine: AsyncEngine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+async def run_scenario(
+    name: str,
+    requests: int,
+    concurrency: int,
+    make_request: Callable[[int], Awaitable[bool]],
+    counter: StatementCounter | None = None,
+) -> dict:
+    # make_request(i) выполняет i-й запрос и возвращает True при успехе
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < requests:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                ok = await make_request(index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    statements_before = counter.count if counter else 0
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    cpu = time.process_time() - cpu_started
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "requests": requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "duration_s": round(duration, 4),
+        "rps": round(requests / duration, 1) if duration else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        # CPU процесса (клиент, приложение и драйвер БД вместе) в пересчете на запрос
+        "cpu_ms_per_request": round(cpu / requests * 1000, 3) if requests else 0.0,
+    }
+    if counter:
+        result["statements_per_request"] = round((counter.count - statements_before) / requests, 3)
+    print(
+        f"{name:<24} {result['rps']:>10} req/s  p50 {result['p50_ms']:>8} ms  "
+        f"p95 {result['p95_ms']:>8} ms  p99 {result['p99_ms']:>8} ms  errors {errors}",
+        flush=True,
+    )
+    return result
+
+def run_metadata(**params) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=False
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(UTC).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        **params,
+    }
+
+def write_results(path: str | None, results: dict):
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Результаты записаны в {path}")
+    else:
+        print(text)
+
+def compare(baseline_path: str, current: dict):
+    # Сравнение с прошлым прогоном (например, с другого коммита)
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"Сравнение с {baseline_path} ({baseline['meta'].get('commit')}):")
+    for name, result in current["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if not old:
+            continue
+        for key in ("rps", "p50_ms", "p99_ms", "cpu_ms_per_request", "statements_per_request"):
+            if key in result and key in old and old[key]:
+                delta = (result[key] - old[key]) / old[key] * 100
+                print(f"  {name:<24} {key:<24} {old[key]:>10} -> {result[key]:>10} ({delta:+.1f}%)")
@@ -4,7 +4,9 @@ from httpx import ASGITransport, AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from app.api import app
+from app.cache import scores_cache, user_id_cache
 from app.database import Base, get_db
+from app.subjects import subject_cache
 
 TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
@@ -15,6 +17,8 @@ TestingSessionLocal = async_sessionmaker(engine_test, class_=AsyncSession, expir
 async def db_session():
     async with engine_test.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    user_id_cache.clear()
+    subject_cache.clear()
 
     async with TestingSessionLocal() as session:
         yield session
@@ -28,6 +32,7 @@ async def client(db_session):
         yield db_session
 
     app.dependency_overrides[get_db] = override_get_db
+    await scores_cache.clear()
 
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
         yield ac
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 
@@ -40,3 +42,197 @@ async def test_get_scores(client):
     assert len(data) == 1
     assert data[0]["subject"] == "Math"
     assert data[0]["score"] == 85
+
+@pytest.mark.asyncio
+async def test_add_scores_bulk_json(client, monkeypatch):
+    from app.config import settings
+    monkeypatch.setattr(settings, "BULK_CHUNK_SIZE", 2)
+    await client.post("/users/", json={"telegram_id": 1, "first_name": "T", "last_name": "U"})
+    await client.post("/users/", json={"telegram_id": 2, "first_name": "T", "last_name": "U"})
+
+    response = await client.post("/scores/bulk", json=[
+        {"telegram_id": 1, "subject": "Math", "score": 70},
+        {"telegram_id": 1, "subject": "Math", "score": 80},
+        {"telegram_id": 2, "subject": "Physics", "score": 60},
+        {"telegram_id": 3, "subject": "Math", "score": 50},
+        {"telegram_id": 2, "subject": "Math"},
+    ])
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["total"], data["upserted"], data["not_found"], data["invalid"]) == (5, 3, 1, 1)
+    assert [(e["index"], e["status"]) for e in data["errors"]] == [(3, "not_found"), (4, "invalid")]
+
+    scores = (await client.get("/scores/1")).json()
+    assert scores == [{"subject": "Math", "score": 80}]
+
+@pytest.mark.asyncio
+async def test_add_scores_bulk_ndjson(client):
+    await client.post("/users/", json={"telegram_id": 1, "first_name": "T", "last_name": "U"})
+
+    body = (
+        '{"telegram_id": 1, "subject": "Math", "score": 70}\n'
+        "not json\n"
+        '{"telegram_id": 1, "subject": "Physics", "score": 65}\n'
+    )
+    response = await client.post("/scores/bulk", content=body, headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["total"], data["upserted"], data["invalid"]) == (3, 2, 1)
+    assert data["errors"][0]["index"] == 1
+
+    response = await client.post("/scores/bulk", content="[{", headers={"content-type": "application/json"})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_add_scores_bulk_caps_errors_and_reports_partial_commit(client, monkeypatch):
+    from app.config import Settings, settings
+    monkeypatch.setattr(settings, "BULK_CHUNK_SIZE", 2)
+    monkeypatch.setattr(settings, "BULK_MAX_ERRORS", 3)
+    await client.post("/users/", json={"telegram_id": 1, "first_name": "T", "last_name": "U"})
+
+    body = "".join(f'{{"telegram_id": {100 + i}, "subject": "Math", "score": 50}}\n' for i in range(10))
+    response = await client.post("/scores/bulk", content=body, headers={"content-type": "application/x-ndjson"})
+    data = response.json()
+    assert (data["not_found"], len(data["errors"]), data["errors_omitted"]) == (10, 3, 7)
+
+    # Тело оборвалось после первого чанка: он уже записан, и отчет об этом приходит с 400
+    body = (
+        '[{"telegram_id": 1, "subject": "Math", "score": 70}, '
+        '{"telegram_id": 1, "subject": "Physics", "score": 60}, {'
+    )
+    response = await client.post("/scores/bulk", content=body, headers={"content-type": "application/json"})
+    assert response.status_code == 400
+    assert response.json()["detail"]["report"]["upserted"] == 2
+    assert len((await client.get("/scores/1")).json()) == 2
+
+    with pytest.raises(ValueError, match="BULK_CHUNK_SIZE"):
+        Settings(BULK_CHUNK_SIZE=20000)
+
+@pytest.mark.asyncio
+async def test_get_scores_cache_and_etag(client):
+    from app.cache import scores_cache
+    await client.post("/users/", json={"telegram_id": 12345, "first_name": "T", "last_name": "U"})
+    await client.post("/scores/", json={"telegram_id": 12345, "subject": "Math", "score": 85})
+
+    first = await client.get("/scores/12345")
+    etag = first.headers["ETag"]
+    hits = scores_cache.stats()["hits"]
+
+    cached = await client.get("/scores/12345", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert scores_cache.stats()["hits"] == hits + 1
+
+    await client.post("/scores/", json={"telegram_id": 12345, "subject": "Math", "score": 90})
+    updated = await client.get("/scores/12345", headers={"If-None-Match": etag})
+    assert updated.status_code == 200
+    assert updated.headers["ETag"] != etag
+    assert updated.json() == [{"subject": "Math", "score": 90}]
+
+@pytest.mark.asyncio
+async def test_stats_endpoints(client):
+    for telegram_id, score in ((1, 55), (2, 75), (3, 95)):
+        user = {"telegram_id": telegram_id, "first_name": "T", "last_name": str(telegram_id)}
+        await client.post("/users/", json=user)
+        await client.post("/scores/", json={"telegram_id": telegram_id, "subject": "Физика", "score": score})
+
+    response = await client.get("/stats/Физика")
+    assert response.status_code == 200
+    assert response.json()["mean"] == 75.0
+
+    response = await client.get("/stats/Физика/top", params={"limit": 2})
+    assert [entry["last_name"] for entry in response.json()] == ["3", "2"]
+
+    response = await client.get("/users/2/stats")
+    assert response.json()[0]["rank"] == 2
+
+    assert (await client.get("/stats/Химия")).status_code == 404
+    bad = await client.post("/scores/", json={"telegram_id": 1, "subject": "Физика", "score": 101})
+    assert bad.status_code == 422
+
+@pytest.mark.asyncio
+async def test_export_scores_streams_csv_and_ndjson(client):
+    for telegram_id, score in ((1, 40), (2, 70), (3, 90)):
+        user = {"telegram_id": telegram_id, "first_name": "T", "last_name": str(telegram_id)}
+        await client.post("/users/", json=user)
+        await client.post("/scores/", json={"telegram_id": telegram_id, "subject": "Физика", "score": score})
+        await client.post("/scores/", json={"telegram_id": telegram_id, "subject": "Химия", "score": score - 10})
+
+    response = await client.get("/export/scores")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0] == "telegram_id,first_name,last_name,subject,score"
+    assert len(lines) == 7
+
+    response = await client.get(
+        "/export/scores", params={"format": "ndjson", "subject": "физика", "min_score": 50, "max_score": 80}
+    )
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows == [{"telegram_id": 2, "first_name": "T", "last_name": "2", "subject": "Физика", "score": 70}]
+
+    assert (await client.get("/export/scores", params={"subject": "Астрономия"})).status_code == 404
+
+@pytest.mark.asyncio
+async def test_score_writes_are_combined(client, monkeypatch):
+    import asyncio
+
+    from app import api
+    from app.write_combiner import ScoreWriteCombiner
+    from tests.conftest import TestingSessionLocal
+    from tests.test_metrics import metric_value
+
+    writer = ScoreWriteCombiner(TestingSessionLocal, window=0.05, max_batch=100)
+    monkeypatch.setattr(api, "score_writer", writer)
+    for telegram_id in (1, 2):
+        await client.post("/users/", json={"telegram_id": telegram_id, "first_name": "T", "last_name": "U"})
+    # Предмет уже в справочнике: запросы доходят до склейки в порядке отправки
+    await client.post("/scores/", json={"telegram_id": 2, "subject": "Math", "score": 10})
+
+    payloads = [
+        {"telegram_id": 1, "subject": "Math", "score": 50},
+        {"telegram_id": 1, "subject": "math ", "score": 60},
+        {"telegram_id": 2, "subject": "Math", "score": 70},
+        {"telegram_id": 3, "subject": "Math", "score": 80},
+    ]
+    batches = metric_value("score_write_batch_size_count")
+    responses = await asyncio.gather(*(client.post("/scores/", json=payload) for payload in payloads))
+    assert [r.status_code for r in responses] == [200, 200, 200, 404]
+    # Каждый получает свой балл, хотя первая запись перекрыта второй в той же пачке
+    assert [r.json()["score"] for r in responses[:3]] == [50, 60, 70]
+    assert metric_value("score_write_batch_size_count") == batches + 1
+    assert writer.queue_depth == 0
+
+    assert (await client.get("/scores/1")).json() == [{"subject": "Math", "score": 60}]
+    assert (await client.get("/scores/2")).json() == [{"subject": "Math", "score": 70}]
+    stats = (await client.get("/stats/Math")).json()
+    assert (stats["count"], stats["min"], stats["max"]) == (2, 60, 70)
+    history = (await client.get("/scores/1/history")).json()
+    assert [item["score"] for item in history["items"]] == [60, 50]
+
+@pytest.mark.asyncio
+async def test_score_history_pages_and_trends(client):
+    await client.post("/users/", json={"telegram_id": 1, "first_name": "T", "last_name": "U"})
+    for subject, score in (("Math", 50), ("Physics", 40), ("Math", 60), ("Math", 70), ("Physics", 45)):
+        await client.post("/scores/", json={"telegram_id": 1, "subject": subject, "score": score})
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2} | ({"cursor": cursor} if cursor else {})
+        page = (await client.get("/scores/1/history", params=params)).json()
+        seen += [(item["subject"], item["score"]) for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == [("Physics", 45), ("Math", 70), ("Math", 60), ("Physics", 40), ("Math", 50)]
+
+    page = (await client.get("/scores/1/history", params={"subject": "math", "limit": 2})).json()
+    assert [item["score"] for item in page["items"]] == [70, 60]
+    page = (await client.get("/scores/1/history", params={"subject": "math", "cursor": page["next_cursor"]})).json()
+    assert ([item["score"] for item in page["items"]], page["next_cursor"]) == ([50], None)
+
+    assert (await client.get("/scores/1/history", params={"subject": "Chemistry"})).status_code == 404
+    assert (await client.get("/scores/1/history", params={"cursor": "garbage"})).status_code == 400
+    assert (await client.get("/scores/2/history")).json() == {"items": [], "next_cursor": None}
+
+    trends = (await client.get("/scores/1/trends", params={"points": 2})).json()
+    assert trends == [{"subject": "Math", "scores": [60, 70]}, {"subject": "Physics", "scores": [40, 45]}]
@@ -0,0 +1,46 @@
+import httpx
+import pytest
+from httpx import ASGITransport
+
+from app.api import app
+from app.api_client import ApiClient, ApiError
+
+
+@pytest.mark.asyncio
+async def test_api_client_roundtrip(client):
+    api = ApiClient("http://test", transport=ASGITransport(app=app))
+    await api.start(warmup_connections=2)
+
+    user = await api.register_user(777, "Test", "User")
+    assert user.telegram_id == 777
+
+    assert await api.add_score(888, "Math", 50) is None
+    saved = await api.add_score(777, "Math", 90)
+    assert saved.score == 90
+
+    scores = await api.get_scores(777)
+    assert [(s.subject, s.score) for s in scores] == [("Math", 90)]
+
+    await api.close()
+
+@pytest.mark.asyncio
+async def test_api_client_retries_connect_errors():
+    calls = 0
+
+    def handler(request: httpx.Request):
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(500, text="boom")
+
+    api = ApiClient("http://test", transport=httpx.MockTransport(handler), retries=3, retry_backoff=0)
+    with pytest.raises(ApiError) as exc:
+        await api.get_scores(1)
+    assert exc.value.status_code == 500
+    assert calls == 3
+
+    calls = -10
+    with pytest.raises(httpx.ConnectError):
+        await api.get_scores(1)
+    await api.close()
@@ -0,0 +1,42 @@
+import pytest
+from httpx import ASGITransport
+
+from app.api import app
+from app.api_client import ApiClient, ApiError
+from app.backend import EmbeddedBackend
+from app.config import settings
+from tests.conftest import TestingSessionLocal
+
+
+@pytest.mark.asyncio
+async def test_embedded_backend_matches_http_contract(db_session):
+    backend = EmbeddedBackend(TestingSessionLocal)
+
+    user = await backend.register_user(777, "Test", "User")
+    assert (user.telegram_id, user.first_name) == (777, "Test")
+
+    assert await backend.add_score(888, "Math", 50) is None
+    saved = await backend.add_score(777, "Math", 90)
+    assert (saved.subject, saved.score) == ("Math", 90)
+
+    scores = await backend.get_scores(777)
+    assert [(s.subject, s.score) for s in scores] == [("Math", 90)]
+
+    await backend.add_score(777, "Math", 95)
+    trends = await backend.get_trends(777)
+    assert [(t.subject, t.scores) for t in trends] == [("Math", [90, 95])]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["http", "embedded"])
+async def test_unknown_subject_is_api_error_in_both_backends(client, monkeypatch, mode):
+    monkeypatch.setattr(settings, "SUBJECTS_AUTO_CREATE", False)
+    if mode == "http":
+        backend = ApiClient("http://test", transport=ASGITransport(app=app))
+    else:
+        backend = EmbeddedBackend(TestingSessionLocal)
+    await backend.register_user(777, "Test", "User")
+    with pytest.raises(ApiError) as exc:
+        await backend.add_score(777, "Astrology", 50)
+    assert exc.value.status_code == 422
+    if mode == "http":
+        await backend.close()
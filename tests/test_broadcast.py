@@ -0,0 +1,119 @@
+import json
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app import crud
+from app.broadcast import Broadcast, RateLimiter, TelegramSender, TokenBucket
+from app.schemas import ScoreCreate, UserCreate
+from tests.conftest import TestingSessionLocal
+
+
+def fake_bot_api(blocked: set[int], flood_once: set[int]):
+    # Локальный фейковый Bot API: 403 для заблокировавших бота, один 429 на чат из flood_once
+    delivered = []
+
+    async def send_message(request: web.Request):
+        payload = await request.json()
+        chat_id = payload["chat_id"]
+        if chat_id in blocked:
+            return web.json_response({"ok": False, "description": "Forbidden: bot was blocked"}, status=403)
+        if chat_id in flood_once:
+            flood_once.discard(chat_id)
+            return web.json_response({"ok": False, "parameters": {"retry_after": 0}}, status=429)
+        delivered.append(chat_id)
+        return web.json_response({"ok": True, "result": {}})
+
+    app = web.Application()
+    app.router.add_post("/bot42:TEST/sendMessage", send_message)
+    return app, delivered
+
+async def seed(db_session, count: int):
+    for telegram_id in range(1, count + 1):
+        user = UserCreate(telegram_id=telegram_id, first_name="T", last_name="U", platform="tg")
+        await crud.create_user(db_session, user)
+        if telegram_id % 2:
+            await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=telegram_id, subject="Физика", score=80))
+
+def make_broadcast(server: TestServer, **kwargs) -> Broadcast:
+    sender = TelegramSender("42:TEST", str(server.make_url("")))
+    return Broadcast(sender, RateLimiter(1000, 0), "Напоминание", session_factory=TestingSessionLocal, **kwargs)
+
+@pytest.mark.asyncio
+async def test_broadcast_retries_flood_wait_and_skips_blocked(db_session):
+    await seed(db_session, 10)
+    app, delivered = fake_bot_api(blocked={3}, flood_once={5})
+    async with TestServer(app) as server:
+        progress = await make_broadcast(server, batch_size=4).run()
+
+    assert sorted(delivered) == [1, 2, 4, 5, 6, 7, 8, 9, 10]
+    assert (progress["sent"], progress["skipped"], progress["failed"]) == (9, 1, 0)
+    assert progress["last_user_id"] == 10
+
+@pytest.mark.asyncio
+async def test_broadcast_resumes_from_checkpoint_and_filters_subject(db_session, tmp_path):
+    await seed(db_session, 10)
+    checkpoint = tmp_path / "broadcast.json"
+    app, delivered = fake_bot_api(blocked=set(), flood_once=set())
+    async with TestServer(app) as server:
+        broadcast = make_broadcast(server, subject="Физика", batch_size=2, checkpoint_path=str(checkpoint))
+        checkpoint.write_text(json.dumps({**broadcast.progress, "last_user_id": 4, "sent": 2}))
+        progress = await broadcast.run()
+
+    assert delivered == [5, 7, 9]
+    assert progress["sent"] == 5
+    assert json.loads(checkpoint.read_text())["last_user_id"] == 9
+
+@pytest.mark.asyncio
+async def test_broadcast_retries_non_json_errors_per_chat(db_session):
+    await seed(db_session, 4)
+    attempts = {}
+    delivered = []
+
+    async def send_message(request: web.Request):
+        chat_id = (await request.json())["chat_id"]
+        attempts[chat_id] = attempts.get(chat_id, 0) + 1
+        # Прокси перед Bot API отвечает HTML: чат 2 — один раз, чат 3 — всегда
+        if chat_id == 2 and attempts[chat_id] == 1:
+            return web.Response(text="<html>502 Bad Gateway</html>", status=502, content_type="text/html")
+        if chat_id == 3:
+            return web.Response(text="<html>Forbidden</html>", status=403, content_type="text/html")
+        delivered.append(chat_id)
+        return web.json_response({"ok": True, "result": {}})
+
+    app = web.Application()
+    app.router.add_post("/bot42:TEST/sendMessage", send_message)
+    async with TestServer(app) as server:
+        progress = await make_broadcast(server, max_retries=2, retry_backoff=0).run()
+
+    assert sorted(delivered) == [1, 2, 4]
+    assert (progress["sent"], progress["skipped"], progress["failed"]) == (3, 0, 1)
+    assert attempts[3] == 3
+
+@pytest.mark.asyncio
+async def test_broadcast_sends_only_to_own_platform(db_session):
+    await seed(db_session, 2)
+    # vk_id из ВК-бота и юзер из импорта без отметки платформы
+    await crud.create_user(db_session, UserCreate(telegram_id=3, first_name="V", last_name="K", platform="vk"))
+    await crud.create_user(db_session, UserCreate(telegram_id=4, first_name="I", last_name="M"))
+    app, delivered = fake_bot_api(blocked=set(), flood_once=set())
+    async with TestServer(app) as server:
+        await make_broadcast(server).run()
+        assert sorted(delivered) == [1, 2]
+        delivered.clear()
+        await make_broadcast(server, include_unknown_platform=True).run()
+        assert sorted(delivered) == [1, 2, 4]
+
+    # Повторная регистрация проставляет платформу старому юзеру
+    user = await crud.create_user(db_session, UserCreate(telegram_id=4, first_name="I", last_name="M", platform="tg"))
+    assert user.platform == "tg"
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        await bucket.acquire()
+    assert time.monotonic() - start >= 0.09
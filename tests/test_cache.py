@@ -0,0 +1,22 @@
+import pytest
+
+from app.cache import MemoryCache
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_lru_and_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("app.cache.time.monotonic", lambda: now)
+    cache = MemoryCache(max_entries=2, ttl=10)
+
+    await cache.set("a", b"1")
+    await cache.set("b", b"2")
+    assert await cache.get("a") == b"1"
+    await cache.set("c", b"3")
+    assert await cache.get("b") is None
+    assert await cache.get("a") == b"1"
+
+    now += 11
+    assert await cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (2, 2, 1)
@@ -0,0 +1,50 @@
+import pytest
+from vkbottle import BaseStateGroup
+
+from app.conversation_store import ConversationStore
+
+
+class ScoreState(BaseStateGroup):
+    SUBJECT = 0
+    SCORE = 1
+
+@pytest.mark.asyncio
+async def test_state_and_payload_live_together_until_conversation_ends():
+    store = ConversationStore()
+    await store.set(1, ScoreState.SCORE, subject="Математика")
+
+    peer = await store.get(1)
+    assert peer.state == ScoreState.SCORE
+    assert peer.payload == {"subject": "Математика"}
+
+    await store.delete(1)
+    assert await store.get(1) is None
+    assert store.stats()["entries"] == 0
+
+@pytest.mark.asyncio
+async def test_store_is_bounded_by_size_and_ttl():
+    store = ConversationStore(max_entries=3, ttl=60)
+    for peer_id in range(5):
+        await store.set(peer_id, ScoreState.SUBJECT)
+    assert [peer_id for peer_id in store._data] == [2, 3, 4]
+    assert store.stats()["evicted"] == 2
+    assert store.memory_bytes() > 0
+
+    expiring = ConversationStore(ttl=-1)
+    await expiring.set(10, ScoreState.SUBJECT)
+    assert await expiring.get(10) is None
+    assert expiring.stats()["entries"] == 0
+    assert expiring.stats()["expired"] == 1
+
+@pytest.mark.asyncio
+async def test_snapshot_restores_in_flight_conversations(tmp_path):
+    path = str(tmp_path / "vk_state.json")
+    store = ConversationStore(path=path)
+    await store.set(7, ScoreState.SCORE, subject="Физика")
+    await store.close()
+
+    restored = ConversationStore(path=path)
+    await restored.start(snapshot_interval=0)
+    peer = await restored.get(7)
+    assert peer.state == ScoreState.SCORE
+    assert peer.payload == {"subject": "Физика"}
@@ -0,0 +1,171 @@
+import pytest
+from pydantic import TypeAdapter
+from sqlalchemy import event
+
+from app import crud
+from app.api import scores_encoder
+from app.schemas import ScoreCreate, ScoreResponse, UserCreate
+from tests.conftest import engine_test
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.engine = engine.sync_engine
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+def score_writes(counter: StatementCounter) -> list[str]:
+    # Запросы к scores без обновления гистограмм subject_score_counts и истории
+    return [
+        statement
+        for statement in counter.statements
+        if "subject_score_counts" not in statement and "score_history" not in statement
+    ]
+
+@pytest.mark.asyncio
+async def test_add_or_update_score_is_single_statement(db_session):
+    await crud.create_user(db_session, UserCreate(telegram_id=1, first_name="T", last_name="U"))
+    # Предмет заводится в справочнике при первом упоминании; дальше id берется из кэша
+    await crud.resolve_subject_ids(db_session, ["Math"])
+
+    with StatementCounter(engine_test) as counter:
+        score = await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="Math", score=70))
+    assert score.score == 70
+    assert len(score_writes(counter)) == 1
+    assert len(counter.statements) == 3
+
+    with StatementCounter(engine_test) as counter:
+        score = await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="Math", score=95))
+    assert score.score == 95
+    assert len(score_writes(counter)) == 1
+    assert len(counter.statements) == 3
+
+    # Балл не изменился — гистограмму не трогаем, но попытка остается в истории
+    with StatementCounter(engine_test) as counter:
+        await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="Math", score=95))
+    assert len(counter.statements) == 2
+
+    with StatementCounter(engine_test) as counter:
+        assert await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=2, subject="Math", score=1)) is None
+    assert len(counter.statements) == 1
+
+    scores = await crud.get_user_scores(db_session, 1)
+    assert [(s.subject, s.score) for s in scores] == [("Math", 95)]
+
+@pytest.mark.asyncio
+async def test_user_id_cache_skips_user_lookup(db_session):
+    from app.cache import user_id_cache
+
+    with StatementCounter(engine_test) as counter:
+        assert await crud.get_user_scores(db_session, 5) == []
+        assert await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=5, subject="Math", score=1)) is None
+    assert len(counter.statements) == 1
+    assert user_id_cache.stats()["negative_hits"] == 1
+
+    user = await crud.create_user(db_session, UserCreate(telegram_id=5, first_name="T", last_name="U"))
+    assert user_id_cache.get(5) == user.id
+    await crud.resolve_subject_ids(db_session, ["Math"])
+
+    with StatementCounter(engine_test) as counter:
+        await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=5, subject="Math", score=60))
+        scores = await crud.get_user_scores(db_session, 5)
+    assert [(s.subject, s.score) for s in scores] == [("Math", 60)]
+    assert len(score_writes(counter)) == 2
+    assert all("users" not in statement for statement in counter.statements)
+
+@pytest.mark.asyncio
+async def test_histograms_follow_score_changes(db_session):
+    for telegram_id, score in ((1, 60), (2, 80), (3, 80), (4, 100)):
+        user = UserCreate(telegram_id=telegram_id, first_name="T", last_name=str(telegram_id))
+        await crud.create_user(db_session, user)
+        await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=telegram_id, subject="Math", score=score))
+    await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="Math", score=90))
+    await crud.bulk_upsert_scores(
+        db_session,
+        [ScoreCreate(telegram_id=2, subject="Math", score=70), ScoreCreate(telegram_id=2, subject="Physics", score=50)],
+    )
+
+    stats = await crud.get_subject_stats(db_session, "Math")
+    assert (stats["count"], stats["mean"], stats["min"], stats["max"]) == (4, 85.0, 70, 100)
+    assert stats["percentiles"]["p50"] == 80
+
+    user_stats = await crud.get_user_stats(db_session, 2)
+    assert [(s["subject"], s["rank"], s["total"]) for s in user_stats] == [("Math", 4, 4), ("Physics", 1, 1)]
+
+    top = await crud.get_leaderboard(db_session, "Math", 2)
+    assert [(entry["rank"], entry["score"]) for entry in top] == [(1, 100), (2, 90)]
+    assert await crud.get_subject_stats(db_session, "Chemistry") is None
+
+@pytest.mark.asyncio
+async def test_subject_names_are_normalized_to_one_id(db_session):
+    await crud.create_user(db_session, UserCreate(telegram_id=1, first_name="T", last_name="U"))
+    await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="математика", score=70))
+    await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="  Математика ", score=80))
+    await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="матем", score=90))
+
+    scores = await crud.get_user_scores(db_session, 1)
+    assert [(s.subject, s.score) for s in scores] == [("Математика", 90)]
+
+    ids = await crud.resolve_subject_ids(db_session, ["МАТЕМАТИКА", "Химия"], create=False)
+    assert ids == {"МАТЕМАТИКА": scores[0].subject_id}
+
+@pytest.mark.asyncio
+async def test_score_rows_match_orm_path(db_session):
+    await crud.create_user(db_session, UserCreate(telegram_id=1, first_name="T", last_name="U"))
+    for subject, score in (("Математика", 70), ("Физика", 55)):
+        await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject=subject, score=score))
+
+    with StatementCounter(engine_test) as counter:
+        rows = await crud.get_user_score_rows(db_session, 1)
+    assert len(counter.statements) == 1
+    orm = await crud.get_user_scores(db_session, 1)
+    assert rows == [(s.subject, s.score) for s in orm]
+
+    # Те же байты, что давала сериализация через модель ответа, — ETag не меняется
+    adapter = TypeAdapter(list[ScoreResponse])
+    assert scores_encoder.encode(rows) == adapter.dump_json(adapter.validate_python(orm, from_attributes=True))
+
+    # Юзер не в кэше: юзер и баллы одним запросом, незарегистрированный запоминается
+    from app.cache import user_id_cache
+
+    user_id_cache.clear()
+    with StatementCounter(engine_test) as counter:
+        assert await crud.get_user_score_rows(db_session, 1) == rows
+        assert await crud.get_user_score_rows(db_session, 2) == []
+        assert await crud.get_user_score_rows(db_session, 2) == []
+    assert len(counter.statements) == 2
+
+@pytest.mark.asyncio
+async def test_history_keeps_every_attempt(db_session):
+    await crud.create_user(db_session, UserCreate(telegram_id=1, first_name="T", last_name="U"))
+    for score in (60, 70, 70):
+        await crud.add_or_update_score(db_session, ScoreCreate(telegram_id=1, subject="Math", score=score))
+    # Повтор в одной пачке: в scores последний, в истории оба
+    await crud.bulk_upsert_scores(
+        db_session,
+        [
+            ScoreCreate(telegram_id=1, subject="Math", score=80),
+            ScoreCreate(telegram_id=1, subject="Physics", score=50),
+            ScoreCreate(telegram_id=1, subject="Math", score=85),
+            ScoreCreate(telegram_id=2, subject="Math", score=1),
+        ],
+    )
+
+    scores = await crud.get_user_scores(db_session, 1)
+    assert sorted((s.subject, s.score) for s in scores) == [("Math", 85), ("Physics", 50)]
+    history = await crud.get_score_history(db_session, 1)
+    assert [(subject, score) for _, subject, score, _ in history] == [
+        ("Math", 85), ("Physics", 50), ("Math", 80), ("Math", 70), ("Math", 70), ("Math", 60)
+    ]
+    assert await crud.get_score_trends(db_session, 1, points=3) == [("Math", [70, 80, 85]), ("Physics", [50])]
+    assert await crud.get_score_history(db_session, 2) == []
+    assert await crud.get_score_trends(db_session, 2) == []
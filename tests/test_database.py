@@ -0,0 +1,56 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from app.database import pool_status, warmup_pool
+
+
+@pytest.mark.asyncio
+async def test_warmup_pool_opens_connections(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", pool_size=3, max_overflow=1)
+
+    await warmup_pool(engine, 5)
+    status = pool_status(engine)
+    assert (status["size"], status["checked_in"], status["checked_out"], status["capacity"]) == (3, 3, 0, 4)
+
+    async with engine.connect():
+        assert pool_status(engine)["saturation"] == 0.25
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_warmup_pool_returns_opened_connections_on_failure(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", pool_size=3, max_overflow=0)
+    connect = AsyncEngine.connect
+    calls = 0
+
+    async def refused():
+        raise ConnectionRefusedError("refused")
+
+    def flaky_connect(self):
+        # Второе соединение не открывается, остальные открываются
+        nonlocal calls
+        calls += 1
+        return refused() if calls == 2 else connect(self)
+
+    monkeypatch.setattr(AsyncEngine, "connect", flaky_connect)
+    with pytest.raises(ConnectionRefusedError):
+        await warmup_pool(engine, 3)
+    assert pool_status(engine)["checked_out"] == 0
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_statement_timing_survives_failed_statements(tmp_path):
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    from app.database import instrument_engine
+    from tests.test_metrics import metric_value
+
+    engine = instrument_engine(create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'timing.db'}"))
+    async with engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            await conn.execute(text("SELECT * FROM missing_table"))
+        assert "query_start" not in conn.info
+        before = metric_value("db_statement_duration_seconds_count", statement="SELECT")
+        await conn.execute(text("SELECT 1"))
+    assert metric_value("db_statement_duration_seconds_count", statement="SELECT") == before + 1
+    await engine.dispose()
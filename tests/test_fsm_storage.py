@@ -0,0 +1,96 @@
+import pytest
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Message, Update
+
+from app.config import settings
+from app.fsm_storage import FSMFlushMiddleware, SQLStorage
+from tests.conftest import engine_test
+from tests.test_crud import StatementCounter
+from tests.test_tg_webhook import fake_update
+
+
+class Form(StatesGroup):
+    subject = State()
+    score = State()
+
+def make_dispatcher(storage: SQLStorage):
+    router = Router()
+    saved = []
+
+    @router.message(Command("go"))
+    async def start(message: Message, state: FSMContext):
+        await state.set_state(Form.subject)
+
+    @router.message(Form.subject, F.text)
+    async def subject(message: Message, state: FSMContext):
+        await state.update_data(subject=message.text)
+        await state.set_state(Form.score)
+
+    @router.message(Form.score, F.text)
+    async def score(message: Message, state: FSMContext):
+        data = await state.get_data()
+        saved.append((data["subject"], message.text))
+        await state.clear()
+
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(FSMFlushMiddleware(storage))
+    dp.include_router(router)
+    return dp, saved
+
+async def feed(dp: Dispatcher, bot: Bot, update_id: int, text: str):
+    await dp.feed_update(bot, Update.model_validate(fake_update(update_id, text), context={"bot": bot}))
+
+@pytest.mark.asyncio
+async def test_conversation_survives_restart_with_one_write_per_transition(db_session):
+    bot = Bot(token="42:TEST")
+    dp, _ = make_dispatcher(SQLStorage(engine_test, cache_ttl=settings.FSM_CACHE_TTL, purge_interval=0))
+
+    with StatementCounter(engine_test) as counter:
+        await feed(dp, bot, 1, "/go")
+    # одно чтение состояния и одна запись перехода
+    assert len(counter.statements) == 2
+    with StatementCounter(engine_test) as counter:
+        await feed(dp, bot, 2, "Math")
+    # следующий апдейт чата берет состояние из кэша: только запись
+    assert len(counter.statements) == 1
+    assert not counter.statements[0].lstrip().upper().startswith("SELECT")
+
+    # "Рестарт": новый процесс с пустым кэшем продолжает диалог с того же места
+    dp, saved = make_dispatcher(SQLStorage(engine_test, purge_interval=0))
+    with StatementCounter(engine_test) as counter:
+        await feed(dp, bot, 3, "90")
+    assert len(counter.statements) == 2
+    assert saved == [("Math", "90")]
+
+    storage = SQLStorage(engine_test, purge_interval=0)
+    key = StorageKey(bot_id=42, chat_id=1, user_id=1)
+    assert await storage.get_state(key) is None
+    assert await storage.get_data(key) == {}
+
+@pytest.mark.asyncio
+async def test_abandoned_conversations_expire(db_session):
+    storage = SQLStorage(engine_test, state_ttl=60, purge_interval=0)
+    key = StorageKey(bot_id=42, chat_id=7, user_id=7)
+    await storage.set_state(key, Form.score)
+    await storage.set_data(key, {"subject": "Math"})
+    await storage.flush()
+    assert await storage.get_state(key) == Form.score.state
+
+    storage._cache.clear()
+    await storage.flush()
+    storage.state_ttl = 0
+    assert await storage.get_state(key) is None
+    assert await storage.purge_expired() == 1
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded(db_session):
+    storage = SQLStorage(engine_test, cache_size=2, cache_ttl=60, purge_interval=0)
+    for user_id in range(5):
+        await storage.set_state(StorageKey(bot_id=42, chat_id=user_id, user_id=user_id), Form.subject)
+    stats = storage.stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 3
@@ -0,0 +1,156 @@
+import asyncio
+
+import httpx
+import pytest
+from sqlalchemy import func, select
+
+from app import api, crud
+from app.api_client import ApiClient
+from app.idempotency import (
+    Idempotency,
+    IdempotencyInProgress,
+    IdempotencyKeyReused,
+    SQLIdempotencyStore,
+    StoredResponse,
+)
+from app.models import ScoreHistory
+from tests.test_replicas import sqlite_file
+
+
+async def history_rows(db_session) -> int:
+    return (await db_session.execute(select(func.count()).select_from(ScoreHistory))).scalar_one()
+
+@pytest.mark.asyncio
+async def test_retried_write_is_applied_once(client, db_session):
+    user = {"telegram_id": 1, "first_name": "T", "last_name": "U"}
+    first = await client.post("/users/", json=user, headers={"Idempotency-Key": "u-1"})
+    again = await client.post("/users/", json=user, headers={"Idempotency-Key": "u-1"})
+    assert again.json() == first.json()
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+
+    score = {"telegram_id": 1, "subject": "Math", "score": 70}
+    for _ in range(3):
+        response = await client.post("/scores/", json=score, headers={"Idempotency-Key": "s-1"})
+        assert response.json() == {"subject": "Math", "score": 70}
+    assert await history_rows(db_session) == 1
+
+    # Тот же ключ с другим телом — ошибка клиента, записи нет
+    response = await client.post("/scores/", json=score | {"score": 80}, headers={"Idempotency-Key": "s-1"})
+    assert response.status_code == 422
+    # 4xx тоже запоминается: повтор не ходит в БД
+    missing = {"telegram_id": 2, "subject": "Math", "score": 1}
+    assert (await client.post("/scores/", json=missing, headers={"Idempotency-Key": "s-2"})).status_code == 404
+    await client.post("/users/", json=user | {"telegram_id": 2})
+    response = await client.post("/scores/", json=missing, headers={"Idempotency-Key": "s-2"})
+    assert (response.status_code, response.headers["Idempotent-Replayed"]) == (404, "true")
+
+    # Без ключа — как раньше
+    await client.post("/scores/", json=score)
+    await client.post("/scores/", json=score)
+    assert await history_rows(db_session) == 3
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_are_coalesced(client, db_session, monkeypatch):
+    await client.post("/users/", json={"telegram_id": 1, "first_name": "T", "last_name": "U"})
+    calls = 0
+    add_or_update_score = crud.add_or_update_score
+
+    async def slow_add(db, score_in):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return await add_or_update_score(db, score_in)
+
+    monkeypatch.setattr(crud, "add_or_update_score", slow_add)
+    score = {"telegram_id": 1, "subject": "Math", "score": 70}
+    responses = await asyncio.gather(
+        *(client.post("/scores/", json=score, headers={"Idempotency-Key": "dup"}) for _ in range(5))
+    )
+    assert [r.status_code for r in responses] == [200] * 5
+    assert sum(r.headers.get("Idempotent-Replayed") == "true" for r in responses) == 4
+    assert calls == 1
+    assert await history_rows(db_session) == 1
+    assert api.idempotency.stats()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_sql_store_coalesces_across_workers(tmp_path):
+    engine = await sqlite_file(tmp_path / "keys.db")
+    # Два воркера API: у каждого своя склейка, общая только таблица ключей
+    workers = [Idempotency(SQLIdempotencyStore(engine, poll_interval=0.01, wait_timeout=1.0)) for _ in range(2)]
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return StoredResponse(200, b'{"ok":true}')
+
+    results = await asyncio.gather(workers[0].run("k", "fp", call), workers[1].run("k", "fp", call))
+    assert calls == 1
+    assert sorted(replayed for _, replayed in results) == [False, True]
+    assert {response.body for response, _ in results} == {b'{"ok":true}'}
+
+    with pytest.raises(IdempotencyKeyReused):
+        await workers[1].run("k", "other", call)
+
+    # 5xx не запоминается: повтор выполняется заново
+    async def fail():
+        return StoredResponse(503, b"")
+
+    await workers[0].run("f", "fp", fail)
+    assert (await workers[1].run("f", "fp", call))[1] is False
+
+    # Воркер упал, не ответив: дубль ждет wait_timeout, после lock_timeout ключ перехватывается
+    store = SQLIdempotencyStore(engine, poll_interval=0.01, wait_timeout=0.05, lock_timeout=0.1)
+    assert await store.begin("lost", "fp") is None
+    with pytest.raises(IdempotencyInProgress):
+        await store.begin("lost", "fp")
+    await asyncio.sleep(0.1)
+    new_owner = SQLIdempotencyStore(engine, poll_interval=0.01, wait_timeout=0.05, lock_timeout=0.1)
+    assert await new_owner.begin("lost", "fp") is None
+    # Опоздавший ответ старого владельца не перетирает захват нового
+    await store.complete("lost", "fp", StoredResponse(200, b"stale"))
+    await store.release("lost")
+    with pytest.raises(IdempotencyInProgress):
+        await store.begin("lost", "fp")
+    await new_owner.complete("lost", "fp", StoredResponse(200, b"fresh"))
+    assert (await store.begin("lost", "fp")).body == b"fresh"
+
+    expired = SQLIdempotencyStore(engine, ttl=-1)
+    assert await expired.begin("old", "fp") is None
+    await expired.complete("old", "fp", StoredResponse(200, b""))
+    assert await expired.purge_expired() == 1
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_client_retries_and_hedges_writes_with_one_key():
+    keys = []
+    release = asyncio.Event()
+
+    async def handler(request: httpx.Request):
+        keys.append(request.headers["Idempotency-Key"])
+        if len(keys) == 1:
+            # Первый запрос завис: ответ придет по дублю
+            await release.wait()
+        if len(keys) == 2:
+            raise httpx.ReadTimeout("timeout", request=request)
+        if len(keys) == 3:
+            return httpx.Response(503)
+        if request.url.path == "/users/":
+            return httpx.Response(200, json={"id": 1, "telegram_id": 1, "first_name": "T", "last_name": "U"})
+        return httpx.Response(200, json={"subject": "Math", "score": 70})
+
+    api_client = ApiClient(
+        "http://test", transport=httpx.MockTransport(handler), retry_backoff=0, hedge_delay=0.01
+    )
+    saved = await api_client.add_score(1, "Math", 70)
+    assert saved.score == 70
+    assert len(keys) == 4 and len(set(keys)) == 1
+
+    keys.clear()
+    release.set()
+    api_client.hedge_delay = 0
+    await api_client.register_user(1, "T", "U")
+    assert len(set(keys)) == 1
+    await api_client.close()
@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy import select
+
+from app import crud
+from app.config import settings
+from app.importer import CSVImport
+from app.models import Score, ScoreHistory, SubjectScoreCount, User
+from app.schemas import ScoreCreate, UserCreate
+from tests.conftest import engine_test
+
+CSV = """telegram_id,first_name,last_name,subject,score
+1,Иван,Иванов,Математика,70
+2,Петр,Петров,Математика,80
+1,Иван,Иванов,Физика,60
+3,Анна,Сидорова,матем,101
+x,Битая,Строка,Математика,50
+2,Петр,Петров,математика ,90
+4,Мария,Кузнецова,Физика,55
+"""
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "scores.csv"
+    path.write_text(CSV, encoding="utf-8")
+    return str(path)
+
+@pytest.mark.asyncio
+async def test_import_creates_users_and_upserts_scores(db_session, csv_path):
+    # Существующему юзеру имя не переписываем, у него уже есть балл, который обновится
+    await crud.create_user(db_session, UserCreate(telegram_id=1, first_name="Ваня", last_name="И"))
+    await crud.bulk_upsert_scores(db_session, [ScoreCreate(telegram_id=1, subject="Математика", score=10)])
+
+    progress = await CSVImport(engine_test, batch_size=3).run(csv_path)
+    assert progress["rows"] == 7
+    assert progress["invalid"] == 2
+    # Повтор (2, Математика) в другой пачке просто обновляет балл
+    assert progress["imported"] == 5
+    assert progress["users_created"] == 2
+    assert progress["rows_per_s"] > 0
+
+    users = dict((await db_session.execute(select(User.telegram_id, User.first_name))).all())
+    assert users == {1: "Ваня", 2: "Петр", 4: "Мария"}
+    scores = await crud.get_user_scores(db_session, 1)
+    assert sorted((s.subject, s.score) for s in scores) == [("Математика", 70), ("Физика", 60)]
+    assert [(s.subject, s.score) for s in await crud.get_user_scores(db_session, 2)] == [("Математика", 90)]
+
+    # Гистограммы совпадают с таблицей баллов
+    histogram = (
+        await db_session.execute(
+            select(SubjectScoreCount.subject_id, SubjectScoreCount.score).where(SubjectScoreCount.count > 0)
+        )
+    ).all()
+    actual = (await db_session.execute(select(Score.subject_id, Score.score))).all()
+    assert sorted(histogram) == sorted(actual)
+
+    # В историю ложатся все попытки, включая перекрытые в той же загрузке
+    history = await crud.get_score_history(db_session, 2)
+    assert [(subject, score) for _, subject, score, _ in history] == [("Математика", 90), ("Математика", 80)]
+    assert len((await db_session.execute(select(ScoreHistory.id))).all()) == 6
+
+@pytest.mark.asyncio
+async def test_import_dry_run_writes_nothing(db_session, csv_path, monkeypatch):
+    progress = await CSVImport(engine_test, dry_run=True).run(csv_path)
+    assert progress["rows"] == 7
+    # Предметов в справочнике еще нет: в dry-run они не заводятся, но считаются
+    assert progress["new_subjects"] == 2
+    assert progress["imported"] == 4
+    assert (await db_session.execute(select(User))).first() is None
+
+    monkeypatch.setattr(settings, "SUBJECTS_AUTO_CREATE", False)
+    progress = await CSVImport(engine_test, dry_run=True).run(csv_path)
+    assert progress["unknown_subject"] == 5
+    assert progress["imported"] == 0
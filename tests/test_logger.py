@@ -0,0 +1,22 @@
+import logging
+
+from app.logger import SampledLogger, setup_logger
+
+
+def test_setup_logger_is_idempotent():
+    first = setup_logger("test_logger")
+    second = setup_logger("test_logger")
+    assert first is second
+    assert len(second.handlers) == 1
+
+def test_sampled_logger_keeps_every_nth_info(caplog):
+    logger = logging.getLogger("test_sampled")
+    logger.setLevel(logging.INFO)
+    sampled = SampledLogger(logger, rate=0.25)
+
+    with caplog.at_level(logging.INFO, logger="test_sampled"):
+        for i in range(8):
+            sampled.info(f"message {i}")
+        sampled.warning("always")
+
+    assert [r.getMessage() for r in caplog.records] == ["message 0", "message 4", "always"]
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from app.metrics import Histogram, registry, start_metrics_server
+
+
+def metric_value(name: str, **labels) -> float:
+    # Сумма сэмплов name с такими метками из того же текста, что отдает /metrics
+    total = 0.0
+    for line in registry.render().splitlines():
+        if line.startswith("#"):
+            continue
+        sample, value = line.rsplit(" ", 1)
+        sample_name, _, sample_labels = sample.partition("{")
+        if sample_name == name and all(f'{key}="{label}"' in sample_labels for key, label in labels.items()):
+            total += float(value)
+    return total
+
+def test_histogram_renders_cumulative_buckets():
+    hist = Histogram("test_seconds", "test", ("route",), buckets=(0.1, 1.0))
+    hist.observe(0.05, "/a")
+    hist.observe(0.5, "/a")
+    hist.observe(5, "/a")
+
+    lines = hist.collect()
+    assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/a"} 3' in lines
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_reports_route_templates(client):
+    await client.get("/scores/12345")
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    expected = 'http_request_duration_seconds_count{method="GET",route="/scores/{telegram_id}",status="200"}'
+    assert expected in response.text
+    assert 'crud_duration_seconds_count{function="get_user_score_rows"}' in response.text
+
+@pytest.mark.asyncio
+async def test_bot_metrics_server():
+    server = await start_metrics_server(0)
+    assert server is None
+
+    server = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+
+    server = await start_metrics_server(port, host="127.0.0.1")
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"# TYPE" in response
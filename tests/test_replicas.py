@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from app import replicas
+from app.api import app
+from app.cache import scores_cache, user_id_cache
+from app.database import Base, get_db
+from app.replicas import ReplicaRouter
+from app.subjects import subject_cache
+
+
+async def sqlite_file(path) -> AsyncEngine:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return engine
+
+@pytest.fixture
+async def primary(tmp_path):
+    # Основная БД и реплика — два SQLite-файла; репликации нет, поэтому по содержимому
+    # ответа видно, из какой БД он прочитан
+    engine = await sqlite_file(tmp_path / "primary.db")
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def override_get_db():
+        async with sessions() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    await scores_cache.clear()
+    user_id_cache.clear()
+    subject_cache.clear()
+    yield engine
+    app.dependency_overrides.clear()
+    await engine.dispose()
+
+async def register_with_score(client: AsyncClient, telegram_id: int):
+    await client.post("/users/", json={"telegram_id": telegram_id, "first_name": "Иван", "last_name": "Иванов"})
+    response = await client.post("/scores/", json={"telegram_id": telegram_id, "subject": "Математика", "score": 80})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_reads_go_to_replica_except_right_after_own_write(primary, tmp_path, monkeypatch):
+    router = ReplicaRouter([await sqlite_file(tmp_path / "replica.db")], sticky_window=0.2)
+    monkeypatch.setattr(replicas, "replica_router", router)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        await register_with_score(client, 1)
+        # Свою запись юзер видит сразу: чтение в окне read-your-writes идет в основную БД
+        stats = (await client.get("/users/1/stats")).json()
+        assert [(s["subject"], s["score"]) for s in stats] == [("Математика", 80)]
+
+        # Окно кончилось — чтение с реплики, куда запись не доехала
+        await asyncio.sleep(0.25)
+        assert (await client.get("/users/1/stats")).json() == []
+        assert (await client.get("/stats/Математика")).status_code == 404
+
+        # Незарегистрированный на реплике юзер не попадает в негативный кэш основной БД
+        assert (await client.get("/scores/1")).json() == []
+        assert not user_id_cache.is_missing(1)
+    await router.close()
+
+@pytest.mark.asyncio
+async def test_falls_back_to_primary_when_replica_is_down(primary, tmp_path, monkeypatch):
+    # Каталога нет — SQLite не может открыть файл реплики
+    missing = tmp_path / "down" / "replica.db"
+    router = ReplicaRouter([create_async_engine(f"sqlite+aiosqlite:///{missing}")], sticky_window=0)
+    monkeypatch.setattr(replicas, "replica_router", router)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        await register_with_score(client, 1)
+        stats = (await client.get("/users/1/stats")).json()
+        assert [(s["subject"], s["score"]) for s in stats] == [("Математика", 80)]
+        assert router.stats() == [{"replica": f"sqlite+aiosqlite:///{missing}", "healthy": False}]
+        assert router.pick() is None
+
+        # Проверка здоровья возвращает реплику в ротацию, когда она поднялась
+        missing.parent.mkdir()
+        async with router.replicas[0].engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await router.check()
+        assert router.stats()[0]["healthy"]
+        assert (await client.get("/users/1/stats")).json() == []
+    await router.close()
+
+@pytest.mark.asyncio
+async def test_round_robin_skips_unhealthy_replicas(tmp_path):
+    engines = [await sqlite_file(tmp_path / f"replica{i}.db") for i in range(3)]
+    router = ReplicaRouter(engines)
+    assert [router.pick().engine for _ in range(6)] == engines * 2
+
+    router.replicas[1].healthy = False
+    assert {router.pick().engine for _ in range(4)} == {engines[0], engines[2]}
+    router.mark_write(7)
+    assert router.pick(7) is None
+    assert router.pick(8) is not None
+    await router.close()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("with_replica", [False, True])
+async def test_non_integer_id_is_rejected_by_validation(primary, tmp_path, monkeypatch, with_replica):
+    engines = [await sqlite_file(tmp_path / "replica.db")] if with_replica else []
+    router = ReplicaRouter(engines)
+    monkeypatch.setattr(replicas, "replica_router", router)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        for path in ("/scores/abc", "/scores/abc/history", "/scores/abc/trends", "/users/abc/stats"):
+            assert (await client.get(path)).status_code == 422
+    await router.close()
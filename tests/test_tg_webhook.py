@@ -0,0 +1,65 @@
+import pytest
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer
+
+from app.tg_webhook import WebhookRunner
+
+
+def fake_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+def make_runner(**kwargs):
+    received = []
+    router = Router()
+
+    @router.message(F.text)
+    async def on_text(message: Message):
+        received.append(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    runner = WebhookRunner(dp, Bot(token="42:TEST"), secret_token="s3cret", path="/hook", **kwargs)
+    return runner, received
+
+@pytest.mark.asyncio
+async def test_webhook_verifies_secret_and_feeds_updates():
+    runner, received = make_runner(workers=2)
+    async with TestClient(TestServer(runner.build_app())) as client:
+        response = await client.post("/hook", json=fake_update(1, "hi"))
+        assert response.status == 401
+        response = await client.post(
+            "/hook", json=fake_update(1, "hi"), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+        )
+        assert response.status == 401
+
+        for i in range(5):
+            response = await client.post(
+                "/hook", json=fake_update(i + 2, f"msg {i}"), headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+            )
+            assert response.status == 200
+        await runner.queue.join()
+
+    assert sorted(received) == [f"msg {i}" for i in range(5)]
+
+@pytest.mark.asyncio
+async def test_webhook_applies_backpressure_when_queue_is_full():
+    runner, received = make_runner(workers=0, queue_size=1, enqueue_timeout=0.01)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+    async with TestClient(TestServer(runner.build_app())) as client:
+        assert (await client.post("/hook", json=fake_update(1, "a"), headers=headers)).status == 200
+        assert (await client.post("/hook", json=fake_update(2, "b"), headers=headers)).status == 503
+    assert runner.queue.qsize() == 1
+
+def test_webhook_requires_secret():
+    with pytest.raises(ValueError, match="TG_WEBHOOK_SECRET"):
+        WebhookRunner(Dispatcher(), Bot(token="42:TEST"), secret_token="")
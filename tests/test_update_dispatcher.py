@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import Message, Update
+
+from app.metrics import registry
+from app.update_dispatcher import OrderedDispatcher, merge_key, setup_ordered_dispatch
+from tests.test_tg_webhook import fake_update
+
+
+@pytest.mark.asyncio
+async def test_same_key_runs_in_order_different_keys_in_parallel():
+    dispatcher = OrderedDispatcher("test", max_in_flight=3)
+    log = []
+    running = peak = 0
+
+    async def handle(key, i):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        # Поздние апдейты быстрее ранних: без очереди порядок бы перемешался
+        await asyncio.sleep(0.01 * (3 - i))
+        log.append((key, i))
+        running -= 1
+
+    for i in range(3):
+        for key in range(5):
+            await dispatcher.submit(key, lambda key=key, i=i: handle(key, i), update_id=(key, i))
+    await dispatcher.close()
+
+    for key in range(5):
+        assert [i for k, i in log if k == key] == [0, 1, 2]
+    assert peak == 3
+    assert dispatcher.stats() == {"pending": 0, "running": 0, "keys": 0, "max_lag_s": 0.0}
+
+@pytest.mark.asyncio
+async def test_duplicates_dropped_read_only_commands_merged():
+    dispatcher = OrderedDispatcher("test", shards=4)
+    gate = asyncio.Event()
+    handled = []
+
+    async def handle(text):
+        await gate.wait()
+        if text == "boom":
+            raise RuntimeError(text)
+        handled.append(text)
+
+    assert await dispatcher.submit(1, lambda: handle("boom"), update_id=1)
+    assert not await dispatcher.submit(1, lambda: handle("boom"), update_id=1)
+    assert await dispatcher.submit(1, lambda: handle("/view_scores"), update_id=2, merge_key="/view_scores")
+    assert not await dispatcher.submit(1, lambda: handle("/view_scores"), update_id=3, merge_key="/view_scores")
+    assert await dispatcher.submit(1, lambda: handle("50"), update_id=4)
+    assert await dispatcher.submit(1, lambda: handle("/view_scores"), update_id=5, merge_key="/view_scores")
+
+    await asyncio.sleep(0.02)
+    lag = dispatcher.shard_lag()
+    assert lag[dispatcher.shard(1)] >= 0.02
+    assert sum(1 for value in lag.values() if value > 0) == 1
+    assert f'bot_dispatch_shard_lag_seconds{{bot="test",shard="{dispatcher.shard(1)}"}}' in registry.render()
+
+    # Упавший обработчик не останавливает очередь юзера
+    gate.set()
+    await dispatcher.close()
+    assert handled == ["/view_scores", "50", "/view_scores"]
+
+def test_merge_key_only_for_read_only_commands():
+    assert merge_key("/view_scores@ege_bot") == "/view_scores"
+    assert merge_key("/enter_scores") is None
+    assert merge_key("Математика") is None
+    assert merge_key(None) is None
+
+class Form(StatesGroup):
+    waiting = State()
+
+@pytest.mark.asyncio
+async def test_aiogram_updates_of_one_chat_see_previous_state():
+    received = []
+    router = Router()
+
+    @router.message(Command("ask"))
+    async def ask(message: Message, state: FSMContext):
+        # Обработчик отвечает юзеру раньше, чем меняет состояние
+        await asyncio.sleep(0.02)
+        await state.set_state(Form.waiting)
+
+    @router.message(Form.waiting, F.text)
+    async def answer(message: Message, state: FSMContext):
+        received.append(message.text)
+        await state.clear()
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    dispatcher = OrderedDispatcher("test")
+    setup_ordered_dispatch(dp, dispatcher)
+    bot = Bot(token="42:TEST")
+
+    # Оба апдейта приходят одной пачкой, как из getUpdates
+    await dp.feed_update(bot, Update.model_validate(fake_update(1, "/ask")))
+    await dp.feed_update(bot, Update.model_validate(fake_update(2, "42")))
+    await dispatcher.close()
+    assert received == ["42"]